@@ -366,8 +366,7 @@ class NFSUtil(Host):
             pktcall = self.pktt.match(src + dst + match + "NFS.argop == %d" % op, maxindex=maxindex)
             if pktcall and not call_only:
                 # Find reply
-                xid = pktcall.rpc.xid
-                pktreply = self.pktt.match("RPC.xid == %d and %s NFS.resop == %d" % (xid, mstatus, op), maxindex=maxindex)
+                pktreply = self.pktt.get_reply(pktcall, "%sNFS.resop == %d" % (mstatus, op), maxindex=maxindex)
                 if pktreply:
                     break
             else:
@@ -451,13 +450,12 @@ class NFSUtil(Host):
             pktcall = self.pktt.match(src + dst + " and NFS.argop == %d and %s" % (OP_OPEN, file_str), maxindex=maxindex)
             if not pktcall:
                 return (None, None, None)
-            xid = pktcall.rpc.xid
-            open_str = "RPC.xid == %d and NFS.status == 0 and NFS.resop == %d" % (xid, OP_OPEN)
+            open_str = "NFS.status == 0 and NFS.resop == %d" % OP_OPEN
             if deleg_type is not None:
                 open_str += " and NFS.delegation.deleg_type == %d" % deleg_type
 
             # Find OPEN reply to get filehandle of file
-            pktreply = self.pktt.match(open_str, maxindex=maxindex)
+            pktreply = self.pktt.get_reply(pktcall, open_str, maxindex=maxindex)
             if not pktreply:
                 continue
 
@@ -501,11 +499,10 @@ class NFSUtil(Host):
         pkt = self.pktt.match(dst + " and NFS.fh == '%s' and NFS.argop == %d" % (self.pktt.escape(filehandle), OP_LAYOUTGET))
         if not pkt:
             return (None, None, None)
-        xid = pkt.rpc.xid
         layoutget = pkt.NFSop
 
         # Find LAYOUTGET reply
-        pkt = self.pktt.match("RPC.xid == %d and NFS.resop == %d" % (xid, OP_LAYOUTGET))
+        pkt = self.pktt.get_reply(pkt, "NFS.resop == %d" % OP_LAYOUTGET)
         if pkt is None:
             return (layoutget, None, None)
         layoutget_res = pkt.NFSop
@@ -614,8 +611,7 @@ class NFSUtil(Host):
         pktcall = self.pktt.match(self.cb_dst + " and NFS.argop == %d" % OP_CB_LAYOUTRECALL)
         if pktcall:
             # Find reply
-            xid = pktcall.rpc.xid
-            pktreply = self.pktt.match("RPC.xid == %d and NFS.resop == %d and NFS.status == %d" % (xid, OP_CB_LAYOUTRECALL, status))
+            pktreply = self.pktt.get_reply(pktcall, "NFS.resop == %d and NFS.status == %d" % (OP_CB_LAYOUTRECALL, status))
         else:
             self.test(False, "CB_LAYOUTRECALL was not found")
             return
@@ -1036,8 +1032,15 @@ class NFSUtil(Host):
         save_index = self.pktt.index
         xids = []
         offsets = {}
-        good_pattern = 0
-        bad_pattern = 0
+        # Pattern and orphan reply counters, a dictionary is used so they
+        # can be updated by the match callback
+        stats = {
+            'good_pattern': 0,
+            'bad_pattern':  0,
+            'norphan': 0,     # I/O replies with no matching call
+            'lorphan': 0,     # Orphan replies up to the last I/O reply
+            'lindex':  None,  # Packet index of the last I/O reply
+        }
         self.test_offsets = []  # Save the offsets sent to the server on I/O
         self.test_counts = []   # Save the counts received from the server
         xid_counts = {}         # Map counts on I/O calls
@@ -1058,12 +1061,8 @@ class NFSUtil(Host):
         # Get I/O type: iomode == 1 (READ), else (WRITE)
         io_op = OP_READ if iomode == LAYOUTIOMODE4_READ else OP_WRITE
 
-        # Find all I/O requests for MDS or current DS
-        while True:
-            # Find I/O request
-            pkt = self.pktt.match(src + dst + fh + " and NFS.argop == %d" % io_op, maxindex=maxindex)
-            if not pkt:
-                break
+        def io_call(pkt):
+            """Process I/O request"""
             xids.append(pkt.rpc.xid)
             nfsop = pkt.NFSop
             self.test_offsets.append(nfsop.offset)
@@ -1085,9 +1084,9 @@ class NFSUtil(Host):
             else:
                 data = self.data_pattern(file_offset, len(nfsop.data), pattern=pattern)
                 if data != nfsop.data:
-                    bad_pattern += 1
+                    stats['bad_pattern'] += 1
                 else:
-                    good_pattern += 1
+                    stats['good_pattern'] += 1
                 size = len(nfsop.data)
             if self.max_iosize < size:
                 self.max_iosize = size
@@ -1096,8 +1095,75 @@ class NFSUtil(Host):
             if ds_index is not None and not self.verify_stripe(file_offset, size, ds_index):
                 self.test_stripe = False
 
-        # Rewind trace file to saved packet index
-        self.pktt.rewind(save_index)
+        def io_reply(pkt):
+            """Process I/O reply"""
+            xid = pkt.rpc.xid
+            xids.remove(xid)
+            stats['lindex'] = pkt.record.index
+            stats['lorphan'] = stats['norphan']
+            nfsop = pkt.NFSop
+
+            self.test_counts.append(nfsop.count)
+            xid_counts.pop(xid, None)
+            if iomode == LAYOUTIOMODE4_READ:
+                offset = offsets[xid]
+
+                # Get real file offset
+                file_offset = self.get_abs_offset(offset, ds_index)
+
+                data = self.data_pattern(file_offset, len(nfsop.data), pattern=pattern)
+                if data != nfsop.data:
+                    stats['bad_pattern'] += 1
+                else:
+                    stats['good_pattern'] += 1
+            else:
+                if pkt.nfs.status == NFS4_OK:
+                    if not self.dsismds:
+                        self.mdsd_lcommit = True
+                    if nfsop.committed < FILE_SYNC4:
+                        # Need layout commit if reply is not FILE_SYNC4
+                        self.need_lcommit = True
+                    if nfsop.committed == UNSTABLE4:
+                        # Need commit if reply is UNSTABLE4
+                        self.need_commit = True
+                    if self.writeverf is None:
+                        self.writeverf = nfsop.verifier
+                    if self.writeverf != nfsop.verifier:
+                        self.test_verf = False
+                else:
+                    # Server returned error for this I/O operation
+                    errstr = nfsstat4.get(pkt.nfs.status)
+                    if self.error_hash.get(errstr) is None:
+                        self.error_hash[errstr] = 1
+                    else:
+                        self.error_hash[errstr] += 1
+
+        def io_match(name, pkt):
+            """Process each packet matched in the trace file"""
+            if name == "ioreply":
+                if pkt.record.index != stats['lindex']:
+                    # Call was not found for this reply
+                    stats['norphan'] += 1
+            elif pkt.rpc.type == 0:
+                io_call(pkt)
+            else:
+                io_reply(pkt)
+
+        # Find all I/O requests for MDS or current DS together with their
+        # replies in a single pass of the trace file, all I/O replies are
+        # also searched to count the replies with no matching call. The
+        # packets are processed as they are matched so none is kept
+        expr = src + dst + fh + " and NFS.argop == %d" % io_op
+        rexpr = "NFS.resop == %d" % io_op
+        exprs = {"io": (expr, rexpr), "ioreply": rexpr}
+        nmatch = self.pktt.match_many(exprs, maxindex=maxindex, rewind=False, callback=io_match)
+        good_pattern = stats['good_pattern']
+        bad_pattern = stats['bad_pattern']
+
+        # Rewind trace file to the packet after the last I/O reply or to
+        # the saved packet index if no replies were found
+        lindex = stats['lindex']
+        self.pktt.rewind(save_index if lindex is None else lindex + 1)
 
         if iomode == LAYOUTIOMODE4_RW:
             self.dprint('DBG7', "WRITE bad/good pattern %d/%d" % (bad_pattern, good_pattern))
@@ -1106,60 +1172,13 @@ class NFSUtil(Host):
             elif bad_pattern > 0:
                 self.warning("Some WRITE packets were not capture properly")
 
-        if len(xids) == 0:
+        if nmatch["io"] == 0:
             return 0
 
-        # Find all I/O replies for MDS or current DS
-        while True:
-            # Find I/O reply
-            pkt = self.pktt.match("NFS.resop == %d" % io_op, maxindex=maxindex)
-            if not pkt:
-                break
-            xid = pkt.rpc.xid
-            if xid in xids:
-                xids.remove(xid)
-                nfsop = pkt.NFSop
-
-                self.test_counts.append(nfsop.count)
-                xid_counts.pop(xid, None)
-                if iomode == LAYOUTIOMODE4_READ:
-                    offset = offsets[xid]
-
-                    # Get real file offset
-                    file_offset = self.get_abs_offset(offset, ds_index)
+        # Count all I/O replies with no matching call up to the last reply
+        # of the I/O requests, or all of them if any reply is missing
+        self.test_niomiss += stats['norphan'] if xids else stats['lorphan']
 
-                    data = self.data_pattern(file_offset, len(nfsop.data), pattern=pattern)
-                    if data != nfsop.data:
-                        bad_pattern += 1
-                    else:
-                        good_pattern += 1
-                else:
-                    if pkt.nfs.status == NFS4_OK:
-                        if not self.dsismds:
-                            self.mdsd_lcommit = True
-                        if nfsop.committed < FILE_SYNC4:
-                            # Need layout commit if reply is not FILE_SYNC4
-                            self.need_lcommit = True
-                        if nfsop.committed == UNSTABLE4:
-                            # Need commit if reply is UNSTABLE4
-                            self.need_commit = True
-                        if self.writeverf is None:
-                            self.writeverf = nfsop.verifier
-                        if self.writeverf != nfsop.verifier:
-                            self.test_verf = False
-                    else:
-                        # Server returned error for this I/O operation
-                        errstr = nfsstat4.get(pkt.nfs.status)
-                        if self.error_hash.get(errstr) is None:
-                            self.error_hash[errstr] = 1
-                        else:
-                            self.error_hash[errstr] += 1
-
-                if len(xids) == 0:
-                    break
-            else:
-                # Call was not found for this reply
-                self.test_niomiss += 1
         # Add the number of calls with no replies
         self.test_niomiss += len(xids)
         nops = good_pattern + bad_pattern + self.test_niomiss
@@ -1198,39 +1217,44 @@ class NFSUtil(Host):
         dst = self.pktt.ip_tcp_dst_expr(ipaddr, port)
         fh = "NFS.fh == '%s'" % self.pktt.escape(filehandle)
         save_index = self.pktt.index
-        xids = []
         if init:
             self.test_commit_full = True
             self.test_no_commit   = False
             self.test_commit_verf = True
 
-        while True:
-            # Find COMMIT request for current DS
-            pkt = self.pktt.match(dst + " and " + fh + " and NFS.argop == %d" % OP_COMMIT)
-            if not pkt:
-                break
-            xids.append(pkt.rpc.xid)
+        # Packet index of the last COMMIT reply, a dictionary is used so
+        # it can be updated by the match callback
+        stats = {'lindex': None}
+
+        def commit_match(name, pkt):
+            """Process each COMMIT request and reply matched"""
             nfscommit = pkt.NFSop
-            if nfscommit.offset != 0 or nfscommit.count != 0:
-                self.test_commit_full = False
+            if pkt.rpc.type == 0:
+                if nfscommit.offset != 0 or nfscommit.count != 0:
+                    self.test_commit_full = False
+            else:
+                # Got COMMIT reply for current DS
+                stats['lindex'] = pkt.record.index
+                if self.writeverf != nfscommit.verifier:
+                    self.test_commit_verf = False
 
-        ncommits = len(xids)
+        # Find all COMMIT requests for current DS together with their
+        # replies in a single pass of the trace file
+        expr = dst + " and " + fh + " and NFS.argop == %d" % OP_COMMIT
+        rexpr = "NFS.resop == %d" % OP_COMMIT
+        nmatch = self.pktt.match_many({"commit": (expr, rexpr)}, rewind=False, callback=commit_match)
+
+        ncommits = nmatch["commit"]
         if ncommits == 0:
             # No COMMIT was found
             self.test_no_commit = True
+            self.pktt.rewind(save_index)
             return 0
 
-        # Rewind trace file to saved packet index
-        self.pktt.rewind(save_index)
-        while True:
-            # Find COMMIT reply for current DS
-            pkt = self.pktt.match("NFS.resop == %d" % OP_COMMIT)
-            if not pkt:
-                break
-            if pkt.rpc.xid in xids:
-                nfscommit = pkt.NFSop
-                if self.writeverf != nfscommit.verifier:
-                    self.test_commit_verf = False
+        # Rewind trace file to the packet after the last COMMIT reply or
+        # to the saved packet index if no replies were found
+        last_index = stats['lindex']
+        self.pktt.rewind(save_index if last_index is None else last_index + 1)
 
         return ncommits
 
@@ -1264,7 +1288,7 @@ class NFSUtil(Host):
             if not pkt:
                 return
 
-            xid = pkt.rpc.xid
+            pktcall = pkt
             layoutcommit = pkt.NFSop
             range_expr = layoutcommit.offset == 0 and layoutcommit.length in (filesize, NFS4_UINT64_MAX)
             self.test(range_expr, "LAYOUTCOMMIT should be sent to MDS with correct file range")
@@ -1281,7 +1305,7 @@ class NFSUtil(Host):
             self.test(getattr_arg.request & (1 << FATTR4_SIZE), "GETATTR asking for file size is sent within LAYOUTCOMMIT compound")
 
             # Find LAYOUTCOMMIT reply
-            pkt = self.pktt.match("RPC.xid == %d and NFS.resop == %d" % (xid, OP_LAYOUTCOMMIT))
+            pkt = self.pktt.get_reply(pktcall, "NFS.resop == %d" % OP_LAYOUTCOMMIT)
             layoutcommit = pkt.NFSop
             if layoutcommit.newsize.sizechanged:
                 self.test(True, "LAYOUTCOMMIT reply file size changed should be set")
@@ -37,6 +37,7 @@ class Header(BaseObj):
     """Header object"""
     # Class attributes
     _attrlist = ("size", "last_fragment")
+    _slotlist = ("data_size",)
 
     def __init__(self, size, last_fragment):
         """Constructor which takes the size and last fragment as inputs"""
@@ -135,6 +136,7 @@ class RPC(GSS):
                  "procedure", "reply_status", "credential", "verifier",
                  "accepted_status", "prog_mismatch", "rejected_status",
                  "rpc_mismatch", "auth_status")
+    _slotlist = ("fragment_hdr", "data", "_rpc", "_pktt", "_proto", "_state", "_payload")
 
     def __init__(self, pktt, proto, state=True):
         """Constructor
@@ -153,6 +155,7 @@ class RPC(GSS):
         self._pktt = pktt
         self._proto = proto
         self._state = state
+        self._payload = None
 
         try:
             self._rpc_header()
@@ -245,14 +248,14 @@ class RPC(GSS):
             # Do not save state
             return
 
-        xid = self.xid
+        rpc_key = pktt.rpc_key(pktt.pkt, self)
         if self.type == CALL:
             # Save call packet in the xid map
-            pktt._rpc_xid_map[xid] = pktt.pkt
+            pktt._rpc_xid_map[rpc_key] = pktt.pkt
             pktt.pkt_call = None
         elif self.type == REPLY:
             try:
-                pkt_call = pktt._rpc_xid_map.get(self.xid, None)
+                pkt_call = pktt._rpc_xid_map.get(rpc_key, None)
                 pktt.pkt_call = pkt_call
                 rpc_header = pkt_call.rpc
 
@@ -298,6 +301,54 @@ class RPC(GSS):
             out = BaseObj.__str__(self)
         return out
 
+    def defer_payload(self):
+        """Skip the RPC load and save the state needed to decode it later.
+           The RPC load is decoded on the first access to any of its layers
+           in the packet object, e.g., pkt.nfs. The RPC load is decoded right
+           away if the RPC program is not supported since there is nothing
+           to decode other than the raw data.
+           Return True if the RPC load has been deferred.
+        """
+        program = self.program
+        if program not in (100003, 100005, 100021, 100000) and \
+           (program is None or program < 0x40000000 or program >= 0x60000000):
+            return self.decode_payload()
+
+        pktt = self._pktt
+        unpack = pktt.unpack
+        offset = unpack.tell()
+        # The working buffer is saved, it is never modified in place so the
+        # RPC load is available even if the working buffer is replaced
+        self._payload = (unpack.__class__, unpack._data, offset, pktt.pkt, pktt.pkt_call)
+        pktt.pkt._lazy = self._decode_deferred
+
+        # Move the offset pointer to the end of the RPC load
+        if self._proto == 6:
+            unpack.seek(offset + self.fragment_hdr.data_size)
+        else:
+            unpack.seek(offset + unpack.size())
+        return True
+
+    def _decode_deferred(self):
+        """Decode the RPC load saved by defer_payload()"""
+        payload = self._payload
+        if payload is None:
+            return
+        self._payload = None
+        unpack_class, data, offset, pkt, pkt_call = payload
+        pktt = self._pktt
+
+        # Save current state of the packet trace object
+        saved = (pktt.unpack, pktt.pkt, pktt.pkt_call)
+        try:
+            pktt.unpack = unpack_class(data)
+            pktt.unpack.seek(offset)
+            pktt.pkt = pkt
+            pktt.pkt_call = pkt_call
+            self.decode_payload()
+        finally:
+            pktt.unpack, pktt.pkt, pktt.pkt_call = saved
+
     def decode_payload(self):
         """Decode RPC load
 
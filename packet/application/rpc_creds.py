@@ -30,6 +30,7 @@ class AuthNone(BaseObj):
     # Class attributes
     flavor = AUTH_NONE
     _itemlist = ("flavor",)
+    _slotlist = _itemlist
 
     def __init__(self, unpack):
         """Constructor which takes the Unpack object as input"""
@@ -41,6 +42,7 @@ class AuthSys(BaseObj):
     # Class attributes
     flavor = AUTH_SYS
     _itemlist = ("flavor", "size", "stamp", "machine", "uid", "gid", "gids")
+    _slotlist = _itemlist
 
     def __init__(self, unpack):
         """Constructor which takes the Unpack object as input"""
@@ -57,6 +59,7 @@ class GSS_Credential(BaseObj):
     flavor = RPCSEC_GSS
     _itemlist = ("flavor", "size", "gss_version", "gss_proc", "gss_seq_num",
                  "gss_service", "gss_context")
+    _slotlist = _itemlist
 
     def __init__(self, unpack):
         """Constructor which takes the Unpack object as input"""
@@ -72,6 +75,7 @@ class GSS_Verifier(BaseObj):
     # Class attributes
     flavor = RPCSEC_GSS
     _itemlist = ("flavor", "size", "gss_token")
+    _slotlist = _itemlist
 
     def __init__(self, unpack):
         """Constructor which takes the Unpack object as input"""
@@ -0,0 +1,263 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Block-compressed gzip module
+
+Provides the objects to read and write block-compressed gzip files (BGZF)
+as created by bgzip. A BGZF file is a series of gzip members, each one
+compressing at most 64KB of data and having its compressed size in the
+"BC" extra field of the gzip header. Any gzip reader can decompress these
+files but since every block can be decompressed on its own, a reader can
+seek to any uncompressed offset by decompressing a single block.
+
+The block index maps the uncompressed offset of every block to its
+compressed offset. It is loaded from the ".gzi" sidecar file created by
+"bgzip -i" or by this module if it exists, otherwise it is built when the
+file is opened by reading the headers of all blocks.
+"""
+import os
+import sys
+import zlib
+import array
+import struct
+from bisect import bisect_right
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Maximum number of uncompressed bytes in a block
+BLOCK_SIZE = 0xff00
+
+# Gzip header of a block with the "BC" extra field, the block size minus
+# one is appended to the header
+_HEADER = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+_HEADER_SIZE = 18
+
+# Empty block marking the end of the file
+_EOF_BLOCK = _HEADER + "\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+def _block_size(header):
+    """Return the compressed size of the block given its gzip header or
+       None if the header is not the header of a block
+    """
+    if len(header) < _HEADER_SIZE or header[:4] != "\x1f\x8b\x08\x04":
+        return None
+    xlen = struct.unpack("<H", header[10:12])[0]
+    offset = 12
+    while offset + 4 <= 12 + xlen and offset + 4 <= len(header):
+        si1, si2, slen = struct.unpack("<ccH", header[offset:offset+4])
+        if si1 == "B" and si2 == "C" and slen == 2:
+            return struct.unpack("<H", header[offset+4:offset+6])[0] + 1
+        offset += 4 + slen
+    return None
+
+def is_bgzf(fh):
+    """Return True if the file object is a block-compressed gzip file,
+       the file pointer is positioned at the start of the file
+    """
+    fh.seek(0)
+    header = fh.read(_HEADER_SIZE)
+    fh.seek(0)
+    return _block_size(header) is not None
+
+class BGZFile(object):
+    """Block-compressed gzip file reader
+
+       Usage:
+           from packet.bgzf import BGZFile
+
+           x = BGZFile(open("/traces/tracefile.cap.gz", "rb"))
+
+           # Size of uncompressed data
+           size = x.size
+
+           # Read data at the given uncompressed offset, only the block
+           # where the offset is found is decompressed
+           x.seek(offset)
+           data = x.read(count)
+    """
+    def __init__(self, fileobj, ifile=None):
+        """Constructor
+
+           Initialize object's private data.
+
+           fileobj:
+               File object of the block-compressed gzip file
+           ifile:
+               Name of block index file [default: file name + ".gzi"]
+        """
+        self.fileobj = fileobj
+        self.size    = 0      # Size of uncompressed data
+        self._coffsets = array.array("L")  # Compressed offset of each block
+        self._uoffsets = array.array("L")  # Uncompressed offset of each block
+        self._block  = -1     # Index of block in the block buffer
+        self._data   = ""     # Block buffer
+        self._offset = 0      # Current uncompressed offset
+
+        fileobj.seek(0, os.SEEK_END)
+        self._csize = fileobj.tell()
+        if ifile is None and hasattr(fileobj, "name"):
+            ifile = fileobj.name + ".gzi"
+        if not self._load_index(ifile):
+            self._scan(0, 0)
+
+    def _load_index(self, ifile):
+        """Load the block index from the given index file. Only the blocks
+           after the last block in the index are scanned. Return False if
+           the index file does not exist or it is not valid.
+        """
+        try:
+            if ifile is None or os.stat(ifile).st_mtime < os.fstat(self.fileobj.fileno()).st_mtime:
+                # Index file does not exist or it is stale
+                return False
+            with open(ifile, "rb") as fd:
+                header = fd.read(8)
+                if len(header) < 8:
+                    return False
+                count = struct.unpack("<Q", header)[0]
+                if os.fstat(fd.fileno()).st_size != 8 + 16*count:
+                    # Index file is truncated or it is not valid
+                    return False
+                data = struct.unpack("<%dQ" % (2*count), fd.read(16*count))
+        except (IOError, OSError):
+            return False
+        # The first block is not included in the index
+        self._coffsets.append(0)
+        self._uoffsets.append(0)
+        self._coffsets.extend(data[0::2])
+        self._uoffsets.extend(data[1::2])
+        # Get the size of the last block in the index and of any other
+        # block appended after the index was created
+        coffset = self._coffsets.pop()
+        uoffset = self._uoffsets.pop()
+        self._scan(coffset, uoffset)
+        return True
+
+    def _scan(self, coffset, uoffset):
+        """Add all blocks starting at the given offsets to the block index"""
+        fileobj = self.fileobj
+        while coffset < self._csize:
+            fileobj.seek(coffset)
+            bsize = _block_size(fileobj.read(_HEADER_SIZE))
+            if bsize is None:
+                raise IOError("Invalid BGZF block at offset %d" % coffset)
+            fileobj.seek(coffset + bsize - 4)
+            isize = struct.unpack("<I", fileobj.read(4))[0]
+            if isize > 0:
+                self._coffsets.append(coffset)
+                self._uoffsets.append(uoffset)
+            coffset += bsize
+            uoffset += isize
+        self.size = uoffset
+
+    def _load_block(self, index):
+        """Decompress the block given by index into the block buffer"""
+        coffset = self._coffsets[index]
+        self.fileobj.seek(coffset)
+        data = self.fileobj.read(_HEADER_SIZE)
+        bsize = _block_size(data)
+        data += self.fileobj.read(bsize - _HEADER_SIZE)
+        xlen = struct.unpack("<H", data[10:12])[0]
+        self._data = zlib.decompress(data[12+xlen:-8], -15)
+        self._block = index
+
+    def read(self, count=-1):
+        """Read at most count bytes from the current offset"""
+        if count < 0:
+            count = self.size - self._offset
+        out = []
+        while count > 0 and self._offset < self.size:
+            index = self._block
+            if index < 0 or self._offset < self._uoffsets[index] or \
+               self._offset >= self._uoffsets[index] + len(self._data):
+                # Offset is not in the block buffer
+                index = bisect_right(self._uoffsets, self._offset) - 1
+                self._load_block(index)
+            start = self._offset - self._uoffsets[index]
+            data = self._data[start:start+count]
+            out.append(data)
+            self._offset += len(data)
+            count -= len(data)
+        return "".join(out)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Set the current uncompressed offset"""
+        if whence == os.SEEK_CUR:
+            offset += self._offset
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._offset = max(0, offset)
+
+    def tell(self):
+        """Return the current uncompressed offset"""
+        return self._offset
+
+    def close(self):
+        """Close the file"""
+        self.fileobj.close()
+
+def compress(tfile, zfile=None, level=6, index=True):
+    """Compress the given file into a block-compressed gzip file
+
+       tfile:
+           Name of file to compress
+       zfile:
+           Name of block-compressed gzip file [default: tfile + ".gz"]
+       level:
+           Compression level [default: 6]
+       index:
+           Create the block index file zfile + ".gzi" [default: True]
+
+       Returns the name of the block-compressed gzip file.
+    """
+    if zfile is None:
+        zfile = tfile + ".gz"
+    offsets = []
+    coffset = 0
+    uoffset = 0
+    with open(tfile, "rb") as fd:
+        with open(zfile, "wb") as zfd:
+            while True:
+                data = fd.read(BLOCK_SIZE)
+                if len(data) == 0:
+                    break
+                if uoffset > 0:
+                    offsets.append((coffset, uoffset))
+                cobj = zlib.compressobj(level, zlib.DEFLATED, -15)
+                cdata = cobj.compress(data) + cobj.flush()
+                bsize = _HEADER_SIZE + len(cdata) + 8
+                zfd.write(_HEADER + struct.pack("<H", bsize - 1))
+                zfd.write(cdata)
+                zfd.write(struct.pack("<iI", zlib.crc32(data), len(data)))
+                coffset += bsize
+                uoffset += len(data)
+            zfd.write(_EOF_BLOCK)
+    if index:
+        with open(zfile + ".gzi", "wb") as ifd:
+            ifd.write(struct.pack("<Q", len(offsets)))
+            for item in offsets:
+                ifd.write(struct.pack("<QQ", *item))
+    return zfile
+
+if __name__ == '__main__':
+    # Compress every trace file given
+    if len(sys.argv) < 2:
+        print "Usage: python -m packet.bgzf <tracefile> [<tracefile> ...]"
+        exit(1)
+    for tfile in sys.argv[1:]:
+        zfile = compress(tfile)
+        print "%s: %d -> %d bytes" % (zfile, os.stat(tfile).st_size, os.stat(zfile).st_size)
@@ -0,0 +1,168 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Inotify module
+
+Provides the object to wait for any file in a directory to be created or
+modified. Linux inotify is used when available so the caller is woken up
+as soon as a file changes. Otherwise, the directory is polled with an
+adaptive backoff: the wait time starts small and it is doubled on every
+wait up to a maximum, it goes back to the minimum when the caller finds
+new data.
+"""
+import os
+import time
+import errno
+import select
+import ctypes
+import ctypes.util
+
+from utilites.baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Inotify events
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+
+# Inotify flags
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC  = 0o2000000
+
+# Events of interest
+IN_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# Minimum and maximum wait times in seconds when polling
+POLL_MIN = 0.01
+POLL_MAX = 1.0
+
+def _libc():
+    """Return the C library if it supports inotify, None otherwise"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except Exception:
+        return None
+
+class Watcher(BaseObj):
+    """Directory watcher object
+
+       Usage:
+           from packet.inotify import Watcher
+
+           x = Watcher("/traces")
+
+           # Wait at most 5 seconds for any file in the directory to
+           # be created or modified, returns False on timeout
+           x.wait(5)
+
+           # New data was found, reset the polling backoff
+           x.reset()
+
+           # Stop watching the directory
+           x.close()
+
+       Object definition:
+
+       Watcher(
+           path    = string, # Directory being watched
+           inotify = bool,   # Using inotify, otherwise polling
+       )
+    """
+    # Class attributes
+    _attrlist = ("path", "inotify")
+
+    def __init__(self, path):
+        """Constructor
+
+           Initialize object's private data.
+
+           path:
+               Directory to watch
+        """
+        self.path    = path
+        self.inotify = False
+        self._fd     = None
+        self._delay  = POLL_MIN
+
+        libc = _libc()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, path, IN_EVENTS) >= 0:
+                    self._fd = fd
+                    self.inotify = True
+                else:
+                    os.close(fd)
+        if not self.inotify:
+            self.dprint('PKT1', "Inotify is not available, polling %s" % path)
+
+    def __del__(self):
+        """Destructor
+
+           Stop watching the directory.
+        """
+        self.close()
+
+    def wait(self, timeout=None):
+        """Wait for any file in the directory to be created or modified.
+           Return False if the timeout expired without any changes. When
+           polling, the wait time is given by the backoff and True is
+           returned since changes cannot be detected.
+
+           timeout:
+               Maximum number of seconds to wait, wait forever if None
+        """
+        if self._fd is not None:
+            try:
+                rlist = select.select([self._fd], [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                return True
+            if not rlist:
+                return False
+            # Discard all events, the caller just checks for new data
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            return True
+
+        delay = self._delay
+        if timeout is not None:
+            delay = min(delay, timeout)
+        time.sleep(delay)
+        self._delay = min(2*self._delay, POLL_MAX)
+        return True
+
+    def reset(self):
+        """Reset the polling backoff to its minimum wait time"""
+        self._delay = POLL_MIN
+
+    def close(self):
+        """Stop watching the directory"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
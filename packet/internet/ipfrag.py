@@ -0,0 +1,216 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+IP fragment reassembly module
+
+Provides the object to reassemble IPv4 and IPv6 fragmented datagrams.
+Fragments are kept by datagram, where each datagram is identified by
+the source and destination addresses, the identification and the
+protocol. Once all fragments of a datagram have been seen, the payload
+of the whole datagram is returned so it can be decoded by the transport
+layer.
+
+Memory is bounded: a datagram is dropped if not all its fragments are
+seen within the timeout given in seconds of trace time, and the oldest
+datagrams are dropped when the number of datagrams or the number of
+bytes waiting to be reassembled exceed their maximum.
+"""
+from collections import OrderedDict
+from utilites.baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Seconds to wait for all fragments of a datagram
+FRAG_TIMEOUT = 30.0
+# Maximum number of datagrams waiting to be reassembled
+FRAG_MAX_DATAGRAMS = 1024
+# Maximum number of bytes waiting to be reassembled
+FRAG_MAX_SIZE = 16*1024*1024
+# Maximum size of a reassembled datagram payload
+FRAG_MAX_PAYLOAD = 65535
+
+class Reassembly(BaseObj):
+    """IP fragment reassembly object
+
+       Usage:
+           from packet.internet.ipfrag import Reassembly
+
+           x = Reassembly()
+
+           # Add fragment, returns the payload of the whole datagram if
+           # this is the last fragment missing, otherwise None
+           data = x.add(key, offset, data, size, more, secs)
+
+           # Drop all fragments waiting to be reassembled
+           x.clear()
+
+       Object definition:
+
+       Reassembly(
+           fragments   = int, # Number of fragments seen
+           reassembled = int, # Number of datagrams reassembled
+           dropped     = int, # Number of datagrams dropped
+           pending     = int, # Number of datagrams waiting for fragments
+       )
+    """
+    # Class attributes
+    _attrlist = ("fragments", "reassembled", "dropped", "pending")
+
+    def __init__(self, timeout=FRAG_TIMEOUT, max_datagrams=FRAG_MAX_DATAGRAMS, max_size=FRAG_MAX_SIZE):
+        """Constructor
+
+           Initialize object's private data.
+
+           timeout:
+               Seconds of trace time to wait for all fragments of a
+               datagram [default: FRAG_TIMEOUT]
+           max_datagrams:
+               Maximum number of datagrams waiting to be reassembled
+               [default: FRAG_MAX_DATAGRAMS]
+           max_size:
+               Maximum number of bytes waiting to be reassembled
+               [default: FRAG_MAX_SIZE]
+        """
+        self.timeout       = timeout
+        self.max_datagrams = max_datagrams
+        self.max_size      = max_size
+        self.fragments     = 0
+        self.reassembled   = 0
+        self.dropped       = 0
+        self._size         = 0
+
+        # Datagram map: list [secs, total, size, nbytes, frags] keyed by
+        # (src, dst, id, protocol) in the order the datagrams were first
+        # seen, where total is the payload size given by the last fragment,
+        # size is the number of payload bytes given by all fragments,
+        # nbytes is the number of bytes captured and frags is a dictionary
+        # of (data, size) keyed by the fragment offset
+        self._datagram_map = OrderedDict()
+
+    @property
+    def pending(self):
+        """Number of datagrams waiting for fragments"""
+        return len(self._datagram_map)
+
+    def clear(self):
+        """Drop all fragments waiting to be reassembled, the counters
+           are not changed
+        """
+        self._datagram_map.clear()
+        self._size = 0
+
+    def _drop(self, key):
+        """Drop the datagram given by the key"""
+        datagram = self._datagram_map.pop(key)
+        self._size -= datagram[3]
+        self.dropped += 1
+        self.dprint('PKT1', "IP datagram %r dropped, %d of %s bytes seen" % (key, datagram[2], datagram[1]))
+
+    def _expire(self, secs):
+        """Drop all datagrams first seen before the timeout"""
+        dmap = self._datagram_map
+        while dmap:
+            key = next(iter(dmap))
+            if secs - dmap[key][0] <= self.timeout:
+                break
+            self._drop(key)
+
+    def add(self, key, offset, data, size, more, secs):
+        """Add fragment to the datagram given by the key. Return the payload
+           of the whole datagram if all fragments have been seen, otherwise
+           return None.
+
+           key:
+               Datagram identifier: (src, dst, id, protocol)
+           offset:
+               Fragment offset in bytes
+           data:
+               Fragment data captured, it could be shorter than the
+               fragment size if the packet has been truncated
+           size:
+               Fragment size in bytes
+           more:
+               More fragments flag, it is false on the last fragment
+           secs:
+               Timestamp of the packet
+        """
+        self.fragments += 1
+        self._expire(secs)
+
+        dmap = self._datagram_map
+        datagram = dmap.get(key)
+        if datagram is None:
+            if len(dmap) >= self.max_datagrams:
+                self._drop(next(iter(dmap)))
+            datagram = [secs, None, 0, 0, {}]
+            dmap[key] = datagram
+
+        frags = datagram[4]
+        if offset + size > FRAG_MAX_PAYLOAD or \
+           (not more and datagram[1] is not None and datagram[1] != offset + size):
+            # Invalid fragment or conflicting datagram size
+            self._drop(key)
+            return None
+        if not more:
+            datagram[1] = offset + size
+        if offset in frags:
+            # Duplicate fragment
+            return None
+
+        # Make sure there is room for this fragment
+        while self._size + len(data) > self.max_size and len(dmap) > 1:
+            okey = next(iter(dmap))
+            if okey == key:
+                # Move current datagram to the end so it is not dropped
+                dmap[key] = dmap.pop(key)
+                okey = next(iter(dmap))
+            self._drop(okey)
+
+        frags[offset] = (data, size)
+        datagram[2] += size
+        datagram[3] += len(data)
+        self._size  += len(data)
+
+        total = datagram[1]
+        if total is None or datagram[2] < total:
+            return None
+
+        # Join all fragments, overlapping fragments are allowed and the
+        # data of the fragment with the lowest offset is used
+        out = []
+        pos = 0
+        for foffset in sorted(frags):
+            fdata, fsize = frags[foffset]
+            if foffset > pos:
+                # Missing fragment
+                return None
+            if foffset + fsize > pos:
+                out.append(fdata[pos-foffset:])
+                if len(fdata) < fsize:
+                    # Truncated fragment, the rest of the datagram is
+                    # not available
+                    pos = total
+                    break
+                pos = foffset + fsize
+        if pos < total:
+            return None
+
+        del dmap[key]
+        self._size -= datagram[3]
+        self.reassembled += 1
+        return "".join(out)
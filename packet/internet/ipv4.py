@@ -18,13 +18,17 @@ Decode IP version 4 layer.
 """
 from packet.transport.tcp import TCP
 from packet.transport.udp import UDP
+from packet.unpack import Unpack, get_struct
 from utilites.baseobj import BaseObj
 
 # Module constants
 __author__    = 'Jorge Mora' 
 __copyright__ = "Copyright (C) 2012 NetApp, Inc."
 __license__   = "GPL v2"
-__version__   = '1.0.5'
+__version__   = '1.0.6'
+
+# Precompiled struct for the IP header
+_IPv4_st = get_struct("!BBHHHBBH4B4B")
 
 # Name of different protocols
 _IP_map = {1:'ICMP(1)', 2:'IGMP(2)', 6:'TCP(6)', 17:'UDP(17)'}
@@ -69,8 +73,14 @@ class IPv4(BaseObj):
            dst             = "%d.%d.%d.%d", # destination IP address
            options = string, # IP options if available
            data = string,    # Raw data of payload if protocol
-                             # is not supported
+                             # is not supported or if this is a
+                             # fragment of a datagram not fully seen yet
        )
+
+       Fragments are reassembled by the packet trace object, see
+       packet.internet.ipfrag. The transport layer is decoded only on the
+       packet having the last fragment missing of the datagram, using the
+       payload of the whole datagram.
     """
     # Class attributes
     _attrlist = ("version", "IHL", "header_size", "DSCP", "ECN", "total_size",
@@ -88,7 +98,7 @@ class IPv4(BaseObj):
         """
         # Decode IP header
         unpack = pktt.unpack
-        ulist = unpack.unpack(20, "!BBHHHBBH4B4B")
+        ulist = unpack.unpack_struct(_IPv4_st)
         self.version         = (ulist[0] >> 4)
         self.IHL             = (ulist[0] & 0x0F)
         self.header_size     = 4*self.IHL
@@ -111,6 +121,14 @@ class IPv4(BaseObj):
             osize = self.header_size - 20
             self.options = unpack.read(osize)
 
+        if self.flags.MF or self.fragment_offset:
+            # IP fragment
+            key = (self.src, self.dst, self.id, self.protocol)
+            size = self.total_size - self.header_size
+            if not self._reassemble(pktt, key, 8*self.fragment_offset, size, self.flags.MF):
+                return
+            unpack = pktt.unpack
+
         if self.protocol == 6:
             # Decode TCP
             TCP(pktt)
@@ -120,6 +138,30 @@ class IPv4(BaseObj):
         else:
             self.data = unpack.getbytes()
 
+    def _reassemble(self, pktt, key, offset, size, more):
+        """Add fragment to its datagram. Return True if the datagram has
+           been reassembled, in which case the working buffer of pktt is
+           replaced by the payload of the whole datagram. Otherwise, the
+           fragment data is saved in the data attribute.
+
+           key:
+               Datagram identifier: (src, dst, id, protocol)
+           offset:
+               Fragment offset in bytes
+           size:
+               Fragment size in bytes
+           more:
+               More fragments flag
+        """
+        # Discard any link layer padding
+        fdata = pktt.unpack.read(size)
+        data = pktt.ipfrag.add(key, offset, fdata, size, more, pktt.pkt.record.secs)
+        if data is None:
+            self.data = fdata
+            return False
+        pktt.unpack = Unpack(data)
+        return True
+
     def __str__(self):
         """String representation of object
 
@@ -15,19 +15,48 @@
 IPv6 module
 
 Decode IP version 6 layer.
-Extension headers are not supported.
+The only extension header supported is the fragment header.
 """
 from ipv4 import IPv4
 import conf as c
 from ipv6addr import IPv6Addr
 from packet.transport.tcp import TCP
 from packet.transport.udp import UDP
+from packet.unpack import get_struct
+from utilites.baseobj import BaseObj
 
 # Module constants
 __author__    = 'Jorge Mora' 
 __copyright__ = "Copyright (C) 2012 NetApp, Inc."
 __license__   = "GPL v2"
-__version__   = '1.0.4'
+__version__   = '1.0.5'
+
+# Precompiled struct for the IPv6 header
+_IPv6_st = get_struct("!IHBB16s16s")
+# Precompiled struct for the fragment header
+_IPv6_frag_st = get_struct("!BBHI")
+
+class Fragment(BaseObj):
+    """Fragment header object
+
+       Object definition:
+
+       Fragment(
+           protocol = int, # Next header
+           offset   = int, # Fragment offset (in 8-byte blocks)
+           MF       = int, # More Fragments
+           id       = int, # Identification
+       )
+    """
+    # Class attributes
+    _attrlist = ("protocol", "offset", "MF", "id")
+
+    def __init__(self, ulist):
+        """Constructor which takes the unpacked fragment header"""
+        self.protocol = ulist[0]
+        self.offset   = ulist[2] >> 3
+        self.MF       = ulist[2] & 0x01
+        self.id       = ulist[3]
 
 class IPv6(IPv4):
     """IPv6 object
@@ -48,13 +77,18 @@ class IPv6(IPv4):
            hop_limit     = int,
            src           = IPv6Addr(),
            dst           = IPv6Addr(),
+           fragment      = Fragment(), # fragment header if available,
+                                       # protocol is then the next header
+                                       # given by the fragment header
            data          = string,  # raw data of payload if protocol
-                                    # is not supported
+                                    # is not supported or if this is a
+                                    # fragment of a datagram not fully
+                                    # seen yet
        )
     """
     # Class attributes
     _attrlist = ("version", "traffic_class", "flow_label", "total_size",
-                 "protocol", "hop_limit", "src", "dst", "data")
+                 "protocol", "hop_limit", "src", "dst", "fragment", "data")
 
     def __init__(self, pktt):
         """Constructor
@@ -66,7 +100,7 @@ class IPv6(IPv4):
                access to the parent layers.
         """
         unpack = pktt.unpack
-        ulist = unpack.unpack(40, "!IHBB16s16s")
+        ulist = unpack.unpack_struct(_IPv6_st)
         self.version       = (ulist[0] >> 28)
         self.traffic_class = (ulist[0] >> 20)&0xFF
         self.flow_label    = ulist[0]&0xFFF
@@ -78,6 +112,16 @@ class IPv6(IPv4):
 
         pktt.pkt.ip = self
 
+        if self.protocol == 44:
+            # Fragment header
+            frag = Fragment(unpack.unpack_struct(_IPv6_frag_st))
+            self.fragment = frag
+            self.protocol = frag.protocol
+            if frag.MF or frag.offset:
+                key = (str(self.src), str(self.dst), frag.id, self.protocol)
+                if not self._reassemble(pktt, key, 8*frag.offset, self.total_size - 8, frag.MF):
+                    return
+
         if self.protocol == 6:
             # Decode TCP
             TCP(pktt)
@@ -19,6 +19,7 @@ Decode ethernet layer (RFC 894) Ethernet II.
 from macaddr import MacAddr
 from packet.internet.ipv4 import IPv4
 from packet.internet.ipv6 import IPv6
+from packet.unpack import get_struct
 from utilites.baseobj import BaseObj
 
 # Module constants
@@ -27,6 +28,9 @@ __version__   = '1.0.3'
 __copyright__ = "Copyright (C) 2012 NetApp, Inc."
 __license__   = "GPL v2"
 
+# Precompiled struct for the ethernet header
+_ETHERNET_st = get_struct("!6s6sH")
+
 _ETHERNET_map = {
     0x0800: 'IPv4',
     0x86dd: 'IPv6',
@@ -62,7 +66,7 @@ class ETHERNET(BaseObj):
                access to the parent layers.
         """
         unpack = pktt.unpack
-        ulist = unpack.unpack(14, "!6s6sH")
+        ulist = unpack.unpack_struct(_ETHERNET_st)
         self.dst  = MacAddr(ulist[0].encode('hex'))
         self.src  = MacAddr(ulist[1].encode('hex'))
         self.type = ulist[2]
@@ -1231,8 +1231,8 @@ def fattr4(unpack):
        };
     """
     bitmap = bitmap4(unpack)
-    unpack.unpack_uint()  # size of opaque
-    return bitmap_dict(unpack, bitmap, nfs_fattr4_f)
+    size = unpack.unpack_uint()  # size of opaque
+    return bitmap_dict(unpack, bitmap, nfs_fattr4_f, size=size)
 
 # Change info for the client
 class change_info4(BaseObj):
@@ -6026,6 +6026,7 @@ class COMPOUND4res(NFSbase):
     """
     # Class attributes
     _attrlist = ("status", "tag", "array")
+    _slotlist = ("minorversion",)
 
     def __init__(self, unpack, minorversion):
         self.set_global("nfs4_fh", None)
@@ -6941,6 +6942,7 @@ class CB_COMPOUND4res(NFSbase):
     """
     # Class attributes
     _attrlist = ("status", "tag", "array")
+    _slotlist = ("minorversion",)
 
     def __init__(self, unpack, minorversion):
         self.set_global("nfs4_fh", None)
@@ -24,7 +24,7 @@ from utilites.baseobj import BaseObj
 __author__    = "Jorge Mora" 
 __copyright__ = "Copyright (C) 2014 NetApp, Inc."
 __license__   = "GPL v2"
-__version__   = "1.3"
+__version__   = "1.4"
 
 # NFSv4 operation priority for displaying purposes
 NFSpriority = {
@@ -122,6 +122,21 @@ class NFSbase(utils.RPCload):
 
        This should only be used as a base class for an NFS object
     """
+    def main_op(self):
+        """Return the main operation of the compound: the last operation
+           having the highest priority, this is the operation displayed
+           when NFS_mainop is set. Return None if there are no operations.
+        """
+        array = getattr(self, "array", None)
+        if not array:
+            return None
+        program = self._rpc.program
+        if program >= 0x40000000 and program < 0x60000000:
+            priority = CBpriority
+        else:
+            priority = NFSpriority
+        return max(reversed(array), key=lambda x: priority.get(x.op, 0))
+
     def __str__(self):
         """Informal string representation of object"""
         rpc = self._rpc
@@ -0,0 +1,359 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Pcapng module
+
+Provides the objects to read a pcapng trace file. The Section Header and
+Interface Description blocks are processed as they are found in the file
+and the Enhanced, Simple and obsolete Packet blocks are returned as records
+having the same information as a record header on a pcap trace file.
+The timestamps of each packet are converted using the timestamp resolution
+and offset of the interface where the packet was captured.
+
+Any block which could be needed to decode a packet block is processed only
+once so the trace file can be re-positioned to any packet block, e.g., when
+using the packet index. If the file is positioned past the blocks processed
+so far, all blocks in between are scanned first.
+"""
+import struct
+
+from utilites.baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Block types
+BT_SHB = 0x0A0D0D0A  # Section Header Block
+BT_IDB = 0x00000001  # Interface Description Block
+BT_PB  = 0x00000002  # Packet Block (obsolete)
+BT_SPB = 0x00000003  # Simple Packet Block
+BT_EPB = 0x00000006  # Enhanced Packet Block
+
+# File identifier: block type of the Section Header Block
+PCAPNG_IDENT = "\x0a\x0d\x0d\x0a"
+
+# Byte-order magic of the Section Header Block in little endian
+_BOM_LE = "\x4d\x3c\x2b\x1a"
+
+# Option codes
+OPT_ENDOFOPT = 0
+IF_NAME      = 2
+IF_TSRESOL   = 9
+IF_TSOFFSET  = 14
+
+def _options(endian, data, offset):
+    """Return a dictionary of all the options in data starting at the
+       given offset, the value of each option is the raw data
+    """
+    opts = {}
+    opt_st = struct.Struct(endian + "HH")
+    while offset + 4 <= len(data):
+        code, size = opt_st.unpack_from(data, offset)
+        offset += 4
+        if code == OPT_ENDOFOPT:
+            break
+        opts[code] = data[offset:offset+size]
+        # Option values are padded to 32 bits
+        offset += (size + 3) & ~3
+    return opts
+
+class Interface(BaseObj):
+    """Interface Description Block object
+
+       Usage:
+           from packet.pcapng import Interface
+
+           x = Interface(endian, data)
+
+           # Convert timestamp to (seconds, microseconds)
+           seconds, usecs = x.timestamp(high, low)
+
+       Object definition:
+
+       Interface(
+           link_type = int,    # Link layer type
+           snaplen   = int,    # Maximum number of bytes captured per packet
+           name      = string, # Interface name if available
+           units     = int,    # Timestamp units per second
+           tsoffset  = int,    # Seconds added to every timestamp
+       )
+    """
+    # Class attributes
+    _attrlist = ("link_type", "snaplen", "name", "units", "tsoffset")
+
+    def __init__(self, endian, data):
+        """Constructor
+
+           Initialize object's private data.
+
+           endian:
+               Byte order of the section
+           data:
+               Raw data of the block body
+        """
+        self.link_type, reserved, self.snaplen = struct.unpack_from(endian + "HHI", data)
+        self.name     = None
+        self.units    = 1000000
+        self.tsoffset = 0
+
+        opts = _options(endian, data, 8)
+        if IF_NAME in opts:
+            self.name = opts[IF_NAME].rstrip("\x00")
+        if IF_TSRESOL in opts:
+            tsresol = ord(opts[IF_TSRESOL][0])
+            if tsresol & 0x80:
+                # Negative power of two
+                self.units = 1 << (tsresol & 0x7F)
+            else:
+                # Negative power of ten
+                self.units = 10**tsresol
+        if IF_TSOFFSET in opts:
+            self.tsoffset = struct.unpack(endian + "q", opts[IF_TSOFFSET][:8])[0]
+
+    def timestamp(self, high, low):
+        """Return the timestamp given by its high and low 32 bit words as
+           a tuple (seconds, microseconds)
+        """
+        seconds, frac = divmod((high << 32) | low, self.units)
+        if self.units != 1000000:
+            frac = frac * 1000000 // self.units
+        return (int(seconds + self.tsoffset), int(frac))
+
+class Section(BaseObj):
+    """Section Header Block object
+
+       Usage:
+           from packet.pcapng import Section
+
+           x = Section(offset, endian, data)
+
+       Object definition:
+
+       Section(
+           offset     = int,  # File offset of the section header block
+           end        = int,  # File offset of next section, None if this
+                              # is the last section found so far
+           endian     = string, # Byte order of the section: "<" or ">"
+           major      = int,  # Major version number
+           minor      = int,  # Minor version number
+           interfaces = list, # List of interfaces defined in the section
+       )
+    """
+    # Class attributes
+    _attrlist = ("offset", "end", "endian", "major", "minor", "interfaces")
+
+    def __init__(self, offset, endian, data):
+        """Constructor
+
+           Initialize object's private data.
+
+           offset:
+               File offset of the section header block
+           endian:
+               Byte order of the section
+           data:
+               Raw data of the block body following the byte-order magic
+        """
+        self.offset     = offset
+        self.end        = None
+        self.endian     = endian
+        self.major, self.minor = struct.unpack_from(endian + "HH", data)
+        self.interfaces = []
+        self.block_st   = struct.Struct(endian + "II")
+        self.epb_st     = struct.Struct(endian + "IIIII")
+        self.pb_st      = struct.Struct(endian + "HHIIII")
+        self.spb_st     = struct.Struct(endian + "I")
+
+class PcapNG(BaseObj):
+    """Pcapng trace file reader
+
+       Usage:
+           from packet.pcapng import PcapNG
+
+           x = PcapNG()
+
+           # Read the section header block at the current file offset of
+           # the packet trace object
+           section = x.read_header(pktt)
+
+           # Read blocks up to the next packet block, returns the record
+           # header as a tuple (seconds, usecs, length_inc, length_orig)
+           # and the file offset of pktt is at the start of the packet data
+           rec = x.read_record(pktt)
+
+       Object definition:
+
+       PcapNG(
+           sections = list,      # List of sections found so far
+           section  = Section,   # Section of the last block read
+           iface    = Interface, # Interface of the last packet block read
+           offset   = int,       # File offset of the last packet block read
+           trailer  = int,       # Number of bytes following the packet data
+                                 # on the last packet block read
+           scanned  = int,       # All blocks up to this file offset have
+                                 # been processed
+       )
+    """
+    # Class attributes
+    _attrlist = ("sections", "section", "iface", "offset", "trailer", "scanned")
+
+    def __init__(self):
+        """Constructor
+
+           Initialize object's private data.
+        """
+        self.sections = []
+        self.section  = None
+        self.iface    = None
+        self.offset   = 0
+        self.trailer  = 0
+        self.scanned  = 0
+
+    def read_header(self, pktt):
+        """Read the section header block at the current file offset and
+           return the section object
+        """
+        self._read_block(pktt)
+        if self.section is None:
+            raise Exception("Not a pcapng file")
+        return self.section
+
+    def read_record(self, pktt):
+        """Read blocks up to the next packet block. Return the record header
+           of the packet block as a tuple (seconds, usecs, length_inc,
+           length_orig) or None if there are no more packet blocks
+        """
+        if pktt.offset > self.scanned:
+            # Process all blocks skipped over so the section headers and
+            # interfaces are known at the current offset
+            offset = pktt.offset
+            pktt.seek(self.scanned)
+            while pktt.offset < offset and self._read_block(pktt, skip=True):
+                pass
+            pktt.seek(offset)
+        while True:
+            item = self._read_block(pktt)
+            if item is not True:
+                return item
+
+    def _get_section(self, offset):
+        """Return the section where the given file offset is found"""
+        section = self.section
+        if section is not None and offset >= section.offset and \
+           (section.end is None or offset < section.end):
+            return section
+        for section in reversed(self.sections):
+            if offset >= section.offset:
+                return section
+
+    def _read_block(self, pktt, skip=False):
+        """Read the block at the current file offset. Return the record
+           header if the block is a packet block, None on end of file or
+           True for any other block. Packet blocks are skipped if the
+           argument skip is True.
+        """
+        offset = pktt.offset
+        data = pktt._read(8)
+        if len(data) < 8:
+            return None
+        new = offset >= self.scanned
+
+        if data[:4] == PCAPNG_IDENT:
+            # Section header block, get byte order from the byte-order magic
+            bom = pktt._read(4)
+            if bom == _BOM_LE:
+                endian = "<"
+            elif bom == _BOM_LE[::-1]:
+                endian = ">"
+            else:
+                # Invalid byte-order magic
+                return None
+            blen = struct.unpack(endian + "I", data[4:])[0]
+            body = pktt._read(blen - 12)
+            if len(body) < blen - 12:
+                return None
+            if new:
+                section = Section(offset, endian, body)
+                if self.sections:
+                    self.sections[-1].end = offset
+                self.sections.append(section)
+                self.scanned = offset + blen
+            self.section = self._get_section(offset)
+            return True
+
+        section = self._get_section(offset)
+        if section is None:
+            return None
+        self.section = section
+        btype, blen = section.block_st.unpack(data)
+        if blen < 12:
+            # Invalid block
+            return None
+        if new:
+            self.scanned = offset + blen
+
+        if btype == BT_EPB or btype == BT_PB:
+            if skip:
+                pktt.seek(offset + blen)
+                return True
+            data = pktt._read(20)
+            if len(data) < 20:
+                return None
+            if btype == BT_EPB:
+                ifid, high, low, length_inc, length_orig = section.epb_st.unpack(data)
+            else:
+                ifid, drops, high, low, length_inc, length_orig = section.pb_st.unpack(data)
+            hsize = 28
+        elif btype == BT_SPB:
+            if skip:
+                pktt.seek(offset + blen)
+                return True
+            data = pktt._read(4)
+            if len(data) < 4:
+                return None
+            ifid = 0
+            high = low = None
+            length_orig = section.spb_st.unpack(data)[0]
+            length_inc = min(length_orig, blen - 16)
+            hsize = 12
+        else:
+            if btype == BT_IDB and new:
+                body = pktt._read(blen - 12)
+                if len(body) < blen - 12:
+                    return None
+                section.interfaces.append(Interface(section.endian, body))
+            pktt.seek(offset + blen)
+            return True
+
+        if ifid >= len(section.interfaces):
+            # Interface has not been defined, skip packet block
+            self.dprint('PKT1', "Packet block at offset %d with invalid interface %d" % (offset, ifid))
+            pktt.seek(offset + blen)
+            return True
+        iface = section.interfaces[ifid]
+        if high is None:
+            # Simple packet block has no timestamp and the number of bytes
+            # captured is given by the snapshot length of the interface
+            seconds, usecs = (0, 0)
+            if iface.snaplen > 0:
+                length_inc = min(length_inc, iface.snaplen)
+        else:
+            seconds, usecs = iface.timestamp(high, low)
+        self.iface   = iface
+        self.offset  = offset
+        self.trailer = blen - hsize - length_inc
+        return (seconds, usecs, length_inc, length_orig)
@@ -48,6 +48,9 @@ _PKT_rlayers = ['record', 'ip']
 _PKT_nlayers = ['gssd', 'gssc']
 # Packet layers to display as debug_repr(2) for debug_repr(1) if last layer
 _PKT_mlayers = ['record', 'ethernet', 'ip']
+# Layers decoded from the RPC payload, these are decoded on first access
+# when the packet has been decoded in lazy mode
+_PKT_llayers = frozenset(['gssd', 'nfs', 'mount', 'portmap', 'nlm', 'gssc'])
 _maxlen = len(max(PKT_layers, key=len))
 
 class Pkt(BaseObj):
@@ -63,11 +66,23 @@ class Pkt(BaseObj):
                print x.nfs
     """
     _attrlist = tuple(PKT_layers)
+    # Function to decode the RPC payload when in lazy mode
+    _lazy = None
 
     # Do not use BaseObj constructor to have a little bit of
     # performance improvement
     def __init__(self): pass
 
+    def __getattr__(self, attr):
+        """Decode the RPC payload on the first access to any of its layers
+           if the packet has been decoded in lazy mode"""
+        lazy = self._lazy
+        if lazy is not None and attr in _PKT_llayers:
+            self._lazy = None
+            lazy()
+            return getattr(self, attr)
+        return BaseObj.__getattr__(self, attr)
+
     def __eq__(self, other):
         """Comparison method used to determine if object has a given layer"""
         if type(other) is str:
@@ -0,0 +1,288 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Packet trace benchmark module
+
+Provides a synthetic NFSv4.1 over TCP trace file generator and a
+microbenchmark for measuring the decoding rate of the packet trace object.
+
+The synthetic trace has a single TCP connection per client where each
+iteration is a COMPOUND call and its reply. The main operations cycle
+through WRITE, READ, GETATTR, READDIR and COMMIT, every COMPOUND starts
+with SEQUENCE and PUTFH and some TCP segments carry more than one RPC.
+
+The memory benchmark decodes the packets and keeps all of them in memory,
+the memory used is reported per 100k packets. The packet layer objects
+can be made smaller by using compact mode, see utilites.baseobj.
+
+Usage:
+    # Generate a synthetic trace with 5000 COMPOUNDs and measure the
+    # number of decoded packets per second
+    python -m packet.pktbench -n 5000
+
+    # Measure the decoding rate of an existing trace file
+    python -m packet.pktbench /traces/tracefile.cap
+
+    # Measure the memory used by 100k decoded packets in compact mode
+    python -m packet.pktbench --memory --compact -n 20000
+"""
+import os
+import time
+import resource
+import random
+import struct
+import tempfile
+from optparse import OptionParser
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# NFSv4 constants used by the trace generator
+_SESSIONID = "S" * 16
+_STATEID   = "\x00\x00\x00\x01" + "O" * 12
+_FH        = "\x01\x02\x03" + "F" * 25
+_ATTRS     = (1, 3, 4, 20, 33, 35, 36, 53)
+
+def _uint(value):
+    """Encode an unsigned integer"""
+    return struct.pack("!I", value)
+
+def _uint64(value):
+    """Encode an unsigned 64 bit integer"""
+    return struct.pack("!Q", value)
+
+def _opaque(data):
+    """Encode a variable length opaque"""
+    return _uint(len(data)) + data + "\0" * ((4 - len(data) % 4) % 4)
+
+def _bitmap(bits):
+    """Encode a bitmap given the list of bits set"""
+    words = [0] * (max(bits)//32 + 1)
+    for bit in bits:
+        words[bit//32] |= 1 << (bit % 32)
+    return _uint(len(words)) + "".join([_uint(w) for w in words])
+
+def _fattr(size, fileid):
+    """Encode the fattr4 for the attributes given by _ATTRS"""
+    values = _uint(1) + _uint64(1234) + _uint64(size) + _uint64(fileid) + \
+             _uint(0644) + _uint(1) + _opaque("root") + _uint64(1400000000) + _uint(5)
+    return _bitmap(_ATTRS) + _opaque(values)
+
+def _compound(index, iosize):
+    """Return the encoded COMPOUND arguments and results"""
+    kind = index % 5
+    slot = index % 4
+    args = [_uint(53) + _SESSIONID + _uint(index) + _uint(slot) + _uint(7) + _uint(0),
+            _uint(22) + _opaque(_FH)]
+    res  = [_uint(53) + _uint(0) + _SESSIONID + _uint(index) + _uint(slot) + _uint(7) + _uint(7) + _uint(0),
+            _uint(22) + _uint(0)]
+    if kind == 0:
+        args.append(_uint(38) + _STATEID + _uint64(index*iosize) + _uint(0) + _opaque("w" * iosize))
+        res.append(_uint(38) + _uint(0) + _uint(iosize) + _uint(0) + "V" * 8)
+    elif kind == 1:
+        args.append(_uint(25) + _STATEID + _uint64(index*iosize) + _uint(iosize))
+        res.append(_uint(25) + _uint(0) + _uint(0) + _opaque("r" * iosize))
+    elif kind == 2:
+        args.append(_uint(9) + _bitmap(_ATTRS))
+        res.append(_uint(9) + _uint(0) + _fattr(index*iosize, 7))
+    elif kind == 3:
+        args.append(_uint(26) + _uint64(0) + "\0" * 8 + _uint(4096) + _uint(32768) + _bitmap(_ATTRS))
+        entries = ""
+        for i in range(20):
+            entries += _uint(1) + _uint64(i+3) + _opaque("file%03d" % i) + _fattr(i*10, 100+i)
+        res.append(_uint(26) + _uint(0) + "\0" * 8 + entries + _uint(0) + _uint(1))
+    else:
+        args.append(_uint(5) + _uint64(0) + _uint(0))
+        res.append(_uint(5) + _uint(0) + "V" * 8)
+    args = _opaque("") + _uint(1) + _uint(len(args)) + "".join(args)
+    res  = _uint(0) + _opaque("") + _uint(len(res)) + "".join(res)
+    return args, res
+
+class _TraceWriter(object):
+    """Write ethernet frames of TCP segments to a tcpdump trace file"""
+    def __init__(self, tfile):
+        self.fh = open(tfile, "wb")
+        self.fh.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        self.usecs = 0
+
+    def segment(self, src, sport, dst, dport, seq, ack, data, flags=0x18):
+        """Write a TCP segment"""
+        tcp = struct.pack("!HHIIHHHH", sport, dport, seq & 0xffffffff,
+                          ack & 0xffffffff, (5 << 12) | flags, 65535, 0, 0)
+        ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 40+len(data), 0, 0x4000,
+                         64, 6, 0, src, dst)
+        frame = "\x00\x0c\x29\x54\x09\xef\x60\x33\x4b\x29\x6e\x9d\x08\x00" + ip + tcp + data
+        self.usecs += 100
+        rec = struct.pack("<IIII", 1400000000 + self.usecs//1000000,
+                          self.usecs % 1000000, len(frame), len(frame))
+        self.fh.write(rec + frame)
+
+    def close(self):
+        self.fh.close()
+
+def gen_trace(tfile, nops=1000, iosize=4096, clients=1, seed=1):
+    """Generate a synthetic NFSv4.1 over TCP trace file
+
+       tfile:
+           Name of trace file to create
+       nops:
+           Number of COMPOUND calls in the trace [default: 1000]
+       iosize:
+           Number of bytes on each READ and WRITE [default: 4096]
+       clients:
+           Number of clients, each client uses its own TCP connection
+           [default: 1]
+       seed:
+           Seed for the random initial sequence numbers [default: 1]
+    """
+    random.seed(seed)
+    mss = 1448
+    server = "\xc0\xa8\x00\x3e"
+    writer = _TraceWriter(tfile)
+    conns = []
+    for i in range(clients):
+        client = "\xc0\xa8\x01" + chr(i+1)
+        cseq = random.randint(0, 0xffffffff)
+        sseq = random.randint(0, 0xffffffff)
+        writer.segment(client, 700+i, server, 2049, cseq, 0, "", 0x02)
+        writer.segment(server, 2049, client, 700+i, sseq, cseq+1, "", 0x12)
+        writer.segment(client, 700+i, server, 2049, cseq+1, sseq+1, "", 0x10)
+        conns.append([client, 700+i, cseq+1, sseq+1])
+
+    xid = 0x1000
+    for index in range(nops):
+        conn = conns[index % clients]
+        client, port = conn[0], conn[1]
+        args, res = _compound(index, iosize)
+        call  = "\x00" * 8 + _uint(2) + _uint(100003) + _uint(4) + _uint(1) + \
+                _uint(1) + _opaque(_uint(0) + _opaque("client") + _uint(0) * 3) + \
+                _uint(0) + _uint(0) + args
+        reply = "\x00" * 4 + _uint(1) + _uint(0) * 4 + res
+        calls = replies = ""
+        for i in range(2 if index % 7 == 3 else 1):
+            # Some segments have more than one RPC
+            xid += 1
+            calls   += _uint(0x80000000 | len(call)) + _uint(xid) + call[4:]
+            replies += _uint(0x80000000 | len(reply)) + _uint(xid) + reply[4:]
+        for data, src, sport, dst, dport, sidx, aidx in \
+          ((calls, client, port, server, 2049, 2, 3), (replies, server, 2049, client, port, 3, 2)):
+            for off in range(0, len(data), mss):
+                chunk = data[off:off+mss]
+                writer.segment(src, sport, dst, dport, conn[sidx], conn[aidx], chunk)
+                conn[sidx] += len(chunk)
+    writer.close()
+
+def bench_decode(tfile, repeat=3, **kwds):
+    """Decode all packets in the trace file and return a tuple of the
+       number of packets and the best time in seconds out of all runs
+
+       tfile:
+           Name of trace file
+       repeat:
+           Number of times to decode the trace file [default: 3]
+       kwds:
+           Named arguments given to the packet trace object
+    """
+    from packet.pktt import Pktt
+    best = None
+    for i in range(repeat):
+        pktt = Pktt(tfile, **kwds)
+        count = 0
+        stime = time.time()
+        for pkt in pktt:
+            count += 1
+        delta = time.time() - stime
+        del pktt
+        if best is None or delta < best:
+            best = delta
+    return count, best
+
+def _rss():
+    """Return the resident set size of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Maximum resident set size is given in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_memory(tfile, maxpkts=100000, **kwds):
+    """Decode the packets in the trace file keeping all of them in memory
+       and return a tuple of the number of packets and the number of bytes
+       used by these packets
+
+       tfile:
+           Name of trace file
+       maxpkts:
+           Maximum number of packets to decode [default: 100000]
+       kwds:
+           Named arguments given to the packet trace object
+    """
+    from packet.pktt import Pktt
+    pktt = Pktt(tfile, **kwds)
+    pktlist = []
+    rss = _rss()
+    for pkt in pktt:
+        pktlist.append(pkt)
+        if len(pktlist) >= maxpkts:
+            break
+    return len(pktlist), _rss() - rss
+
+if __name__ == '__main__':
+    usage = "%prog [options] [<tracefile> ...]"
+    parser = OptionParser(usage=usage, version="%prog " + __version__)
+    parser.add_option("-n", "--nops", type="int", default=5000,
+                      help="Number of COMPOUNDs in the synthetic trace [default: %default]")
+    parser.add_option("-s", "--iosize", type="int", default=4096,
+                      help="Number of bytes on each READ and WRITE [default: %default]")
+    parser.add_option("-c", "--clients", type="int", default=1,
+                      help="Number of clients in the synthetic trace [default: %default]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="Number of runs, the best run is reported [default: %default]")
+    parser.add_option("-m", "--mmap", action="store_true", default=False,
+                      help="Open trace files in memory-mapped mode")
+    parser.add_option("-M", "--memory", action="store_true", default=False,
+                      help="Measure the memory used by the decoded packets")
+    parser.add_option("-p", "--maxpkts", type="int", default=100000,
+                      help="Maximum number of packets to keep in memory [default: %default]")
+    parser.add_option("-C", "--compact", action="store_true", default=False,
+                      help="Use compact mode for the packet layer objects")
+    opts, args = parser.parse_args()
+
+    if opts.compact:
+        # Compact mode must be set before the packet modules are imported
+        from utilites.baseobj import compact_mode
+        compact_mode(True)
+
+    tmpfile = None
+    if not args:
+        fd, tmpfile = tempfile.mkstemp(suffix=".cap")
+        os.close(fd)
+        gen_trace(tmpfile, opts.nops, opts.iosize, opts.clients)
+        args = [tmpfile]
+    try:
+        for tfile in args:
+            if opts.memory:
+                count, size = bench_memory(tfile, opts.maxpkts, use_mmap=opts.mmap)
+                print "%s: %d packets use %.1f MB, %.1f MB per 100k packets" % \
+                      (tfile, count, size/1048576.0, size*100000.0/count/1048576.0)
+            else:
+                count, delta = bench_decode(tfile, opts.repeat, use_mmap=opts.mmap)
+                print "%s: %d packets in %.3f secs, %.0f packets/sec" % (tfile, count, delta, count/delta)
+    finally:
+        if tmpfile is not None:
+            os.unlink(tmpfile)
@@ -0,0 +1,191 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+RPC call tracker module
+
+Provides the base object for the analyzers pairing every RPC call with its
+reply in a single pass over a trace file. Calls and replies are paired by
+the same key used by the packet trace object, see Pktt.rpc_key().
+
+Calls waiting for a reply are dropped after a timeout given in seconds of
+trace time or when there are too many of them. A dropped call is released
+from the packet trace object as well, see Pktt.release_call(), so memory
+is bounded on traces of any size.
+"""
+from collections import OrderedDict
+
+from packet.pktt import Pktt
+from utilites.baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Seconds of trace time to wait for the reply of a call
+PENDING_TIMEOUT = 300.0
+# Maximum number of calls waiting for a reply
+PENDING_MAX = 1000000
+
+class CallTracker(BaseObj):
+    """RPC call tracker base object
+
+       The derived object defines the methods called for each call and
+       reply, the data returned for a call is kept until its reply:
+           _call(pkt, rpc, usecs):
+               Process the call, return the data kept for the call
+           _reply(pkt, rpc, usecs, ctime, data):
+               Process the reply of the call given by its timestamp
+               and data
+           _drop(usecs, data, expired):
+               The call is dropped without a reply, expired is False
+               when it is replaced by a retransmitted call [optional]
+
+       Usage:
+           from packet.pktcall import CallTracker
+
+           class Counter(CallTracker):
+               def _call(self, pkt, rpc, usecs):
+                   return rpc.procedure
+               def _reply(self, pkt, rpc, usecs, ctime, data):
+                   print data, usecs - ctime
+
+           x = Counter().run("/traces/tracefile.cap")
+
+       Object definition:
+
+       CallTracker(
+           calls     = int, # Number of calls
+           replies   = int, # Number of replies matched to a call
+           unmatched = int, # Number of replies without a call
+           retrans   = int, # Number of calls replacing a pending call
+           expired   = int, # Number of calls dropped without a reply
+           pending   = int, # Number of calls waiting for a reply
+       )
+    """
+    # Class attributes
+    _attrlist = ("calls", "replies", "unmatched", "retrans", "expired", "pending")
+
+    def __init__(self, timeout=PENDING_TIMEOUT, max_pending=PENDING_MAX):
+        """Constructor
+
+           Initialize object's private data.
+
+           timeout:
+               Seconds of trace time to wait for the reply of a call
+               [default: PENDING_TIMEOUT]
+           max_pending:
+               Maximum number of calls waiting for a reply
+               [default: PENDING_MAX]
+        """
+        self.timeout     = timeout
+        self.max_pending = max_pending
+        self.calls       = 0
+        self.replies     = 0
+        self.unmatched   = 0
+        self.retrans     = 0
+        self.expired     = 0
+
+        # Calls waiting for a reply: tuple (usecs, data) keyed by the
+        # RPC key in the order the calls were seen
+        self._pending_map = OrderedDict()
+
+    @property
+    def pending(self):
+        """Number of calls waiting for a reply"""
+        return len(self._pending_map)
+
+    def _call(self, pkt, rpc, usecs):
+        """Process the call, return the data kept for the call"""
+        return None
+
+    def _reply(self, pkt, rpc, usecs, ctime, data):
+        """Process the reply of the call"""
+        pass
+
+    def _drop(self, usecs, data, expired):
+        """The call has been dropped without a reply"""
+        pass
+
+    def _expire(self, key, usecs, pktt):
+        """Drop the pending call given by the RPC key"""
+        item = self._pending_map.pop(key)
+        if pktt is not None:
+            pktt.release_call(key)
+        self.expired += 1
+        self._drop(usecs, item[1], True)
+
+    def add(self, pkt, pktt=None):
+        """Process the given packet. Return True if the packet is an RPC
+           call or the reply of a pending call.
+
+           pkt:
+               Packet object
+           pktt:
+               Packet trace object the packet is coming from, dropped
+               calls are released from it [default: None]
+        """
+        rpc = pkt.rpc
+        if not rpc:
+            return False
+        record = pkt.record
+        usecs = record.seconds * 1000000 + record.usecs
+        pmap = self._pending_map
+        key = Pktt.rpc_key(pkt)
+
+        if rpc.type == 0:
+            self.calls += 1
+            item = pmap.pop(key, None)
+            if item is not None:
+                # Use the latest call, it is added at the end
+                self.retrans += 1
+                self._drop(usecs, item[1], False)
+            # Drop calls which timed out
+            while pmap:
+                okey = next(iter(pmap))
+                if usecs - pmap[okey][0] <= self.timeout * 1000000:
+                    break
+                self._expire(okey, usecs, pktt)
+            if len(pmap) >= self.max_pending:
+                self._expire(next(iter(pmap)), usecs, pktt)
+            pmap[key] = (usecs, self._call(pkt, rpc, usecs))
+        else:
+            item = pmap.pop(key, None)
+            if item is None:
+                self.unmatched += 1
+                return False
+            self.replies += 1
+            self._reply(pkt, rpc, usecs, item[0], item[1])
+        return True
+
+    def run(self, tfile, **kwds):
+        """Process all packets in the trace file, the packets are decoded
+           in lazy mode so the RPC payload is only decoded when it is used.
+           Returns the object itself.
+
+           tfile:
+               Name of trace file, list of trace files or a packet trace
+               object
+           kwds:
+               Named arguments given to the packet trace object
+        """
+        if isinstance(tfile, Pktt):
+            pktt = tfile
+        else:
+            kwds.setdefault("lazy", True)
+            pktt = Pktt(tfile, **kwds)
+        for pkt in pktt:
+            self.add(pkt, pktt)
+        return self
@@ -0,0 +1,459 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Columnar packet summary module
+
+Provides the objects to export a summary of every RPC packet in a trace
+file into a directory of columns and to load and query these columns
+without decoding the trace file again.
+
+Every column is saved as a NumPy ".npy" file having a one-dimensional
+array with a row for each RPC call or reply. The files are written without
+NumPy so they can be created on any system. When loading, NumPy is used if
+it is available, the columns are memory-mapped and queries are vectorized,
+otherwise the columns are loaded into arrays from the array module.
+
+The IP addresses are saved as an index into the list of all addresses
+found in the trace, this list is saved in the file "addresses.txt".
+
+Columns:
+    secs      = float64, # Timestamp of packet
+    index     = uint32,  # Packet index in the trace file
+    src       = uint32,  # Index of source IP address
+    dst       = uint32,  # Index of destination IP address
+    sport     = uint16,  # Source port
+    dport     = uint16,  # Destination port
+    xid       = uint32,  # RPC transaction id
+    rtype     = uint8,   # RPC message type: 0 (call) or 1 (reply)
+    program   = uint32,  # RPC program
+    version   = uint32,  # RPC program version
+    procedure = uint32,  # RPC procedure
+    ops       = uint64,  # Bitmap of NFSv4 operations 0-63 in the COMPOUND
+    ops2      = uint64,  # Bitmap of NFSv4 operations 64-127 in the COMPOUND
+    status    = int32,   # NFS status of reply, -1 if not available
+    offset    = uint64,  # File offset of I/O operation, taken from the
+                         # call for replies
+    count     = uint32,  # Number of bytes of I/O operation
+    fh        = uint32,  # CRC32 of the file handle, taken from the call
+                         # for replies, 0 if not available
+    length    = uint32,  # Number of bytes of packet on the wire
+The I/O items are taken from the main operation of an NFSv4 COMPOUND,
+see NFSbase.main_op().
+
+Usage:
+    # Export the columns of a trace file
+    python -m packet.pktcol /traces/tracefile.cap /traces/tracefile.col
+"""
+import os
+import sys
+import ast
+import array
+import struct
+from optparse import OptionParser
+
+from packet.pktt import Pktt
+from packet.nfs.nfsbase import NFSbase
+from utilites.baseobj import BaseObj
+from utilites.formatstr import crc32
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Type code of the array module for 64 bit unsigned integers, these
+# columns are saved as doubles if the platform has no such type code
+_U64 = "L" if array.array("L").itemsize == 8 else "d"
+
+# Name and array type code of all columns
+COLUMNS = (
+    ("secs",      "d"),
+    ("index",     "I"),
+    ("src",       "I"),
+    ("dst",       "I"),
+    ("sport",     "H"),
+    ("dport",     "H"),
+    ("xid",       "I"),
+    ("rtype",     "B"),
+    ("program",   "I"),
+    ("version",   "I"),
+    ("procedure", "I"),
+    ("ops",       _U64),
+    ("ops2",      _U64),
+    ("status",    "i"),
+    ("offset",    _U64),
+    ("count",     "I"),
+    ("fh",        "I"),
+    ("length",    "I"),
+)
+
+# NumPy data type of each array type code
+_DESCR = {"d": "<f8", "I": "<u4", "H": "<u2", "B": "|u1", "i": "<i4", "L": "<u8"}
+
+# Name of the file having the list of IP addresses
+ADDR_FILE = "addresses.txt"
+
+# Size of the header of every column file, the header is written when
+# the file is created and it is rewritten with the number of rows when
+# the file is closed
+_NPY_MAGIC = "\x93NUMPY\x01\x00"
+_NPY_HSIZE = 128
+
+# Number of rows kept in memory before they are appended to the files
+FLUSH_ROWS = 65536
+
+def _npy_header(typecode, nrows):
+    """Return the header of a column file"""
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (_DESCR[typecode], nrows)
+    header = header.ljust(_NPY_HSIZE - len(_NPY_MAGIC) - 3) + "\n"
+    return _NPY_MAGIC + struct.pack("<H", len(header)) + header
+
+def _nfs_item(nfs):
+    """Return the object having the I/O items of the NFS object: the main
+       operation for NFSv4 or the NFS object itself for NFSv3
+    """
+    if isinstance(nfs, NFSbase):
+        return nfs.main_op()
+    return nfs
+
+class ColumnWriter(BaseObj):
+    """Columnar packet summary writer
+
+       Usage:
+           from packet.pktcol import ColumnWriter
+
+           x = ColumnWriter("/traces/tracefile.col")
+
+           # Add summary of every RPC packet
+           pktt = Pktt("/traces/tracefile.cap")
+           for pkt in pktt:
+               x.add(pkt, pktt)
+
+           # Write all rows and the headers of all columns
+           x.close()
+
+       Object definition:
+
+       ColumnWriter(
+           outdir = string, # Directory where the columns are saved
+           rows   = int,    # Number of rows added
+       )
+    """
+    # Class attributes
+    _attrlist = ("outdir", "rows")
+
+    def __init__(self, outdir):
+        """Constructor
+
+           Initialize object's private data.
+
+           outdir:
+               Directory where the columns are saved, it is created if it
+               does not exist
+        """
+        self.outdir = outdir
+        self.rows   = 0
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        self._addr_map = {}  # Address index keyed by address
+        self._addrs    = []  # List of addresses
+        self._columns  = []  # List of (array, file object) for each column
+        for name, typecode in COLUMNS:
+            fd = open(os.path.join(outdir, name + ".npy"), "wb")
+            fd.write(_npy_header(typecode, 0))
+            self._columns.append((array.array(typecode), fd))
+
+    def _addr_index(self, addr):
+        """Return the index of the given address in the list of addresses"""
+        index = self._addr_map.get(addr)
+        if index is None:
+            index = len(self._addrs)
+            self._addr_map[addr] = index
+            self._addrs.append(addr)
+        return index
+
+    def add(self, pkt, pktt=None):
+        """Add summary of the given packet if it is an RPC call or reply
+
+           pkt:
+               Packet object
+           pktt:
+               Packet trace object the packet is coming from. If this is
+               given, the file handle and offset of a reply are taken
+               from its call [default: None]
+        """
+        rpc = pkt.rpc
+        if not rpc:
+            return
+        ip = pkt.ip
+        layer = pkt.tcp if pkt.tcp is not None else pkt.udp
+        record = pkt.record
+
+        ops = 0
+        status = -1
+        offset = count = fh = None
+        nfs = pkt.nfs
+        if nfs is not None:
+            for item in getattr(nfs, "array", None) or []:
+                if item.op < 128:
+                    ops |= 1 << item.op
+            item = _nfs_item(nfs)
+            if item is not None:
+                offset = getattr(item, "offset", None)
+                count  = getattr(item, "count", None)
+                fh     = getattr(item, "fh", None)
+            if rpc.type == 1:
+                status = getattr(nfs, "status", -1)
+                pkt_call = pktt.pkt_call if pktt is not None else None
+                if pkt_call is not None and pkt_call.nfs is not None:
+                    item = _nfs_item(pkt_call.nfs)
+                    if item is not None:
+                        offset = getattr(item, "offset", None)
+                        fh     = getattr(item, "fh", None)
+
+        row = (
+            record.secs,
+            record.index,
+            self._addr_index(str(ip.src)),
+            self._addr_index(str(ip.dst)),
+            layer.src_port,
+            layer.dst_port,
+            rpc.xid,
+            rpc.type,
+            rpc.program or 0,
+            rpc.version or 0,
+            rpc.procedure or 0,
+            ops & 0xffffffffffffffff,
+            (ops >> 64) & 0xffffffffffffffff,
+            status if isinstance(status, int) else -1,
+            offset if isinstance(offset, (int, long)) else 0,
+            count if isinstance(count, (int, long)) else 0,
+            crc32(fh) if isinstance(fh, str) and len(fh) else 0,
+            record.length_orig,
+        )
+        for value, column in zip(row, self._columns):
+            column[0].append(value)
+        self.rows += 1
+        if len(self._columns[0][0]) >= FLUSH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        """Append all rows in memory to the column files"""
+        for items, fd in self._columns:
+            if sys.byteorder != "little":
+                items.byteswap()
+            items.tofile(fd)
+            del items[:]
+
+    def close(self):
+        """Write all rows in memory, the headers of all columns and the
+           list of addresses
+        """
+        if self._columns is None:
+            return
+        self._flush()
+        for (name, typecode), (items, fd) in zip(COLUMNS, self._columns):
+            fd.seek(0)
+            fd.write(_npy_header(typecode, self.rows))
+            fd.close()
+        self._columns = None
+        with open(os.path.join(self.outdir, ADDR_FILE), "w") as fd:
+            for addr in self._addrs:
+                fd.write(addr + "\n")
+
+def export(tfile, outdir, **kwds):
+    """Decode the trace file and save the summary of every RPC packet as
+       columns in the given directory. Return the number of rows saved.
+
+       tfile:
+           Name of trace file or a list of trace files
+       outdir:
+           Directory where the columns are saved
+       kwds:
+           Named arguments given to the packet trace object
+    """
+    pktt = Pktt(tfile, **kwds)
+    writer = ColumnWriter(outdir)
+    try:
+        for pkt in pktt:
+            writer.add(pkt, pktt)
+    finally:
+        writer.close()
+    return writer.rows
+
+class Columns(BaseObj):
+    """Columnar packet summary reader
+
+       Usage:
+           from packet.pktcol import Columns
+
+           x = Columns("/traces/tracefile.col")
+
+           # Column of timestamps
+           secs = x.secs
+
+           # Row numbers of all WRITE calls to the given file handle after
+           # the given timestamp
+           rows = x.where(rtype=0, op=OP_WRITE, fh=fh, tmin=1400000000.0)
+
+           # Packet index of the first row found
+           index = x.index[rows[0]]
+
+       Object definition:
+
+       Columns(
+           indir     = string, # Directory where the columns are saved
+           rows      = int,    # Number of rows
+           addresses = list,   # List of IP addresses
+           mmap      = bool,   # Columns are memory-mapped NumPy arrays
+       )
+       All columns are also attributes of the object.
+    """
+    # Class attributes
+    _attrlist = ("indir", "rows", "addresses", "mmap")
+
+    def __init__(self, indir, mmap=True):
+        """Constructor
+
+           Initialize object's private data.
+
+           indir:
+               Directory where the columns are saved
+           mmap:
+               Memory-map the columns if NumPy is available [default: True]
+        """
+        self.indir = indir
+        self.rows  = None
+        self.mmap  = bool(numpy is not None and mmap)
+        with open(os.path.join(indir, ADDR_FILE)) as fd:
+            self.addresses = fd.read().splitlines()
+        self._addr_map = dict((addr, index) for index, addr in enumerate(self.addresses))
+        for name, typecode in COLUMNS:
+            path = os.path.join(indir, name + ".npy")
+            if numpy is not None:
+                items = numpy.load(path, mmap_mode="r" if mmap else None)
+            else:
+                items = self._load(path, typecode)
+            if self.rows is None:
+                self.rows = len(items)
+            elif len(items) != self.rows:
+                raise Exception("Column %s has %d rows, expecting %d" % (name, len(items), self.rows))
+            setattr(self, name, items)
+
+    @staticmethod
+    def _load(path, typecode):
+        """Load column file into an array of the given type code"""
+        with open(path, "rb") as fd:
+            if fd.read(len(_NPY_MAGIC)) != _NPY_MAGIC:
+                raise Exception("Invalid column file %s" % path)
+            hlen = struct.unpack("<H", fd.read(2))[0]
+            header = ast.literal_eval(fd.read(hlen))
+            if header["descr"] != _DESCR[typecode]:
+                raise Exception("Invalid data type %s in column file %s" % (header["descr"], path))
+            items = array.array(typecode)
+            items.fromfile(fd, header["shape"][0])
+        if sys.byteorder != "little":
+            items.byteswap()
+        return items
+
+    def addr_index(self, addr):
+        """Return the index of the given IP address, None if not found"""
+        return self._addr_map.get(addr)
+
+    def where(self, rtype=None, program=None, procedure=None, op=None, fh=None,
+              src=None, dst=None, status=None, tmin=None, tmax=None):
+        """Return the row numbers matching all the given conditions, the
+           result is a NumPy array if NumPy is available, otherwise a list
+
+           rtype:
+               RPC message type: 0 (call) or 1 (reply)
+           program:
+               RPC program
+           procedure:
+               RPC procedure
+           op:
+               NFSv4 operation in the COMPOUND
+           fh:
+               File handle or its CRC32
+           src:
+               Source IP address
+           dst:
+               Destination IP address
+           status:
+               NFS status of reply
+           tmin:
+               Minimum timestamp
+           tmax:
+               Maximum timestamp
+        """
+        conds = []  # List of (column, value) for equality conditions
+        for name, value in (("rtype", rtype), ("program", program),
+                            ("procedure", procedure), ("status", status)):
+            if value is not None:
+                conds.append((getattr(self, name), value))
+        if fh is not None:
+            conds.append((self.fh, crc32(fh) if isinstance(fh, str) else fh))
+        for name, addr in (("src", src), ("dst", dst)):
+            if addr is not None:
+                index = self.addr_index(addr)
+                if index is None:
+                    return [] if numpy is None else numpy.zeros(0, dtype=int)
+                conds.append((getattr(self, name), index))
+        opmask = None
+        if op is not None:
+            opcol = self.ops if op < 64 else self.ops2
+            opmask = 1 << (op % 64)
+
+        if numpy is not None:
+            mask = numpy.ones(self.rows, dtype=bool)
+            for items, value in conds:
+                mask &= (items == value)
+            if opmask is not None:
+                mask &= (opcol & numpy.uint64(opmask)) != 0
+            if tmin is not None:
+                mask &= (self.secs >= tmin)
+            if tmax is not None:
+                mask &= (self.secs <= tmax)
+            return numpy.nonzero(mask)[0]
+
+        rows = []
+        secs = self.secs
+        for row in xrange(self.rows):
+            if tmin is not None and secs[row] < tmin:
+                continue
+            if tmax is not None and secs[row] > tmax:
+                continue
+            if opmask is not None and not (int(opcol[row]) & opmask):
+                continue
+            for items, value in conds:
+                if items[row] != value:
+                    break
+            else:
+                rows.append(row)
+        return rows
+
+if __name__ == '__main__':
+    usage = "%prog [options] <tracefile> <outdir>"
+    parser = OptionParser(usage=usage, version="%prog " + __version__)
+    opts, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("A trace file and an output directory must be given")
+    count = export(args[0], args[1])
+    print "%s: %d rows saved in %s" % (args[0], count, args[1])
@@ -0,0 +1,418 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Packet index module
+
+Provides the object for a persistent packet index of a tcpdump trace file.
+The index has an entry for every packet in the trace file which includes
+the file offset of the record where the packet is found, the frame number,
+the timestamp and the number of bytes included in the trace for the record.
+
+Key indexes are built together with the packet index, each one maps the
+NFS filehandles, stateids, clientids or sessionids found in the packets to
+the list of packet indices having that key. A key is given by the CRC32 of
+its value so the index is compact, thus a key lookup returns a superset of
+the packets actually having the given value.
+
+The index is saved in a sidecar file next to the trace file, e.g., the index
+for "/traces/tracefile.cap" is saved as "/traces/tracefile.cap.idx".
+When the index file is opened the file is memory-mapped so there is no need
+to load the whole index into memory.
+
+The index file has a header followed by each of the columns:
+    magic     = "PKTTIDX\\0"
+    version   = int   # Index file format version
+    count     = int   # Number of packets in the index
+    itemsize  = int   # Size in bytes of the offset column items
+    tracesize = int   # Size of trace file when the index was created
+    tracetime = float # Modification time of trace file
+
+The columns are followed by each of the key indexes:
+    nkeys     = int   # Number of distinct keys
+    count     = int   # Number of packet indices in the index
+    keys      = array # Sorted CRC32 of the keys
+    starts    = array # Position of the packet indices of each key
+    indices   = array # Packet indices of all keys
+"""
+import os
+import mmap
+import array
+import struct
+import binascii
+from bisect import bisect_left
+
+from utilites.baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.1"
+
+# Index file header
+IDX_MAGIC   = "PKTTIDX\0"
+IDX_VERSION = 2
+IDX_HEADER  = struct.Struct("<8sIQIQd")
+IDX_KEYHDR  = struct.Struct("<II")
+
+# List of columns: (name, array typecode)
+IDX_COLUMNS = (
+    ("offset",  "L"),  # File offset of record
+    ("frame",   "I"),  # Frame number
+    ("seconds", "I"),  # Seconds
+    ("usecs",   "I"),  # Microseconds
+    ("length",  "I"),  # Number of bytes included in trace
+)
+
+# List of key indexes: name of the NFS attribute having the key
+IDX_KEYS = ("fh", "stateid", "clientid", "sessionid")
+
+# Struct format for each of the item sizes
+_item_fmt = {2:"H", 4:"I", 8:"Q"}
+
+def key_crc(value):
+    """Return the key of the given value for the key indexes or None
+       if the value cannot be used as a key. Strings and objects compared
+       as strings, e.g., stateid4, use the CRC32 of the string while
+       integers use the CRC32 of their 64-bit big-endian representation
+
+       value:
+           Value of the NFS attribute, e.g., filehandle, stateid
+    """
+    if isinstance(value, BaseObj) and value._eqattr is not None:
+        # Object is compared using one of its attributes
+        value = getattr(value, value._eqattr)
+    if isinstance(value, str):
+        return binascii.crc32(value) & 0xffffffff
+    if isinstance(value, (int, long)) and not isinstance(value, bool) and 0 <= value < (1<<64):
+        return binascii.crc32(struct.pack("!Q", value)) & 0xffffffff
+    return None
+
+class MapColumn(object):
+    """Index column on a memory-mapped file
+
+       Usage:
+           from packet.pktidx import MapColumn
+
+           x = MapColumn(mmap_obj, offset, itemsize, count)
+
+           # Get item given by index
+           item = x[index]
+
+           # Number of items in column
+           count = len(x)
+    """
+    def __init__(self, mmap_obj, offset, itemsize, count):
+        """Constructor
+
+           Initialize object's private data.
+
+           mmap_obj:
+               Memory map of the index file
+           offset:
+               Offset of the column in the index file
+           itemsize:
+               Size in bytes of each item
+           count:
+               Number of items in the column
+        """
+        self._mmap   = mmap_obj
+        self._offset = offset
+        self._size   = itemsize
+        self._count  = count
+        self._struct = struct.Struct("=" + _item_fmt[itemsize])
+
+    def __len__(self):
+        """Return the number of items in the column"""
+        return self._count
+
+    def __getitem__(self, index):
+        """Return the item given by index"""
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("index column out of range")
+        return self._struct.unpack_from(self._mmap, self._offset + index*self._size)[0]
+
+class PktIndex(BaseObj):
+    """Packet index object
+
+       Usage:
+           from packet.pktidx import PktIndex
+
+           # Open the index for the given trace file, the index is loaded
+           # if its index file exists and it is valid, otherwise an empty
+           # index is created
+           x = PktIndex("/traces/tracefile.cap")
+
+           # Add a packet to the index
+           x.append(offset, frame, seconds, usecs, length)
+
+           # Number of packets in the index
+           count = len(x)
+
+           # Get entry for packet given by index
+           entry = x[index]
+           offset = entry.offset
+
+           # Get the index of the first packet found at the given file offset
+           index = x.find(offset)
+
+           # Add filehandle to the key index for packet given by index
+           x.add_key("fh", filehandle, index)
+
+           # Get the list of packet indices which may have the filehandle
+           indices = x.lookup("fh", filehandle)
+
+           # Save index to its index file
+           x.save()
+
+       Object definition:
+
+       PktIndex(
+           tfile    = string, # Name of trace file
+           ifile    = string, # Name of index file
+           complete = bool,   # All packets in the trace file have been indexed
+       )
+    """
+    # Class attributes
+    _attrlist = ("tfile", "ifile", "complete")
+
+    def __init__(self, tfile, ifile=None):
+        """Constructor
+
+           Initialize object's private data.
+
+           tfile:
+               Name of tcpdump trace file
+           ifile:
+               Name of index file [default: tfile + ".idx"]
+        """
+        self.tfile    = tfile
+        self.ifile    = tfile + ".idx" if ifile is None else ifile
+        self.complete = False
+        self._mmap    = None
+        self._fh      = None
+        self._columns = {}
+        for name, typecode in IDX_COLUMNS:
+            self._columns[name] = array.array(typecode)
+        # Key indexes: dictionary of packet indices keyed by the CRC32 of
+        # the key for each of the IDX_KEYS, once the index is loaded from
+        # its index file it is a tuple of (keys, starts, indices) columns
+        self._keyidx = dict((name, {}) for name in IDX_KEYS)
+
+        if os.path.exists(self.ifile):
+            try:
+                self.load()
+            except Exception as e:
+                # Invalid index file, start with an empty index
+                self.dprint('PKT1', "Unable to load index file %s: %s" % (self.ifile, e))
+                self.close()
+                for name, typecode in IDX_COLUMNS:
+                    self._columns[name] = array.array(typecode)
+                self._keyidx = dict((name, {}) for name in IDX_KEYS)
+
+    def __del__(self):
+        """Destructor
+
+           Gracefully close the index file if it is opened.
+        """
+        self.close()
+
+    def __len__(self):
+        """Return the number of packets in the index"""
+        return len(self._columns["offset"])
+
+    def __getitem__(self, index):
+        """Return the index entry for the given packet index"""
+        entry = {}
+        for name, typecode in IDX_COLUMNS:
+            entry[name] = self._columns[name][index]
+        return BaseObj(entry)
+
+    def column(self, name):
+        """Return the column given by name"""
+        return self._columns[name]
+
+    def offset(self, index):
+        """Return the file offset of the record for the given packet index"""
+        return self._columns["offset"][index]
+
+    def find(self, offset):
+        """Return the index of the first packet found at the given
+           file offset
+        """
+        return bisect_left(self._columns["offset"], offset)
+
+    def append(self, offset, frame, seconds, usecs, length):
+        """Add a packet to the index
+
+           offset:
+               File offset of the record where the packet is found
+           frame:
+               Frame number
+           seconds:
+               Timestamp seconds
+           usecs:
+               Timestamp microseconds
+           length:
+               Number of bytes included in trace
+        """
+        columns = self._columns
+        columns["offset"].append(offset)
+        columns["frame"].append(frame)
+        columns["seconds"].append(seconds)
+        columns["usecs"].append(usecs)
+        columns["length"].append(length)
+
+    def add_key(self, name, value, index):
+        """Add the key given by value to the key index given by name
+
+           name:
+               Name of the key index, one of IDX_KEYS
+           value:
+               Value of the key, e.g., filehandle, stateid
+           index:
+               Packet index of the packet having the key
+        """
+        crc = key_crc(value)
+        if crc is None:
+            return
+        kmap = self._keyidx[name]
+        indices = kmap.get(crc)
+        if indices is None:
+            kmap[crc] = array.array("I", [index])
+        elif indices[-1] != index:
+            # Packet index is added just once
+            indices.append(index)
+
+    def lookup(self, name, value, crc=None):
+        """Return the list of packet indices which may have the given key,
+           packets having a different value with the same CRC32 are also
+           included in the list
+
+           name:
+               Name of the key index, one of IDX_KEYS
+           value:
+               Value of the key, e.g., filehandle, stateid
+           crc:
+               CRC32 of the key, value is ignored if this is given
+        """
+        if crc is None:
+            crc = key_crc(value)
+            if crc is None:
+                return []
+        kidx = self._keyidx[name]
+        if isinstance(kidx, dict):
+            return list(kidx.get(crc, []))
+        keys, starts, indices = kidx
+        pos = bisect_left(keys, crc)
+        if pos == len(keys) or keys[pos] != crc:
+            return []
+        return [indices[i] for i in xrange(starts[pos], starts[pos+1])]
+
+    def _trace_stat(self):
+        """Return the size and modification time of the trace file"""
+        fstat = os.stat(self.tfile)
+        return (fstat.st_size, fstat.st_mtime)
+
+    def load(self):
+        """Load the index from its index file, the index file is
+           memory-mapped so columns are not actually read into memory
+        """
+        self._fh = open(self.ifile, "rb")
+        self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, itemsize, tsize, ttime = IDX_HEADER.unpack_from(self._mmap, 0)
+        if magic != IDX_MAGIC or version != IDX_VERSION:
+            raise Exception("Not a packet index file")
+        if (tsize, ttime) != self._trace_stat():
+            raise Exception("Packet index file is stale")
+
+        offset = IDX_HEADER.size
+        for name, typecode in IDX_COLUMNS:
+            size = itemsize if name == "offset" else array.array(typecode).itemsize
+            self._columns[name] = MapColumn(self._mmap, offset, size, count)
+            offset += size * count
+
+        keyidx = {}
+        for name in IDX_KEYS:
+            nkeys, kcount = IDX_KEYHDR.unpack_from(self._mmap, offset)
+            offset += IDX_KEYHDR.size
+            keys = MapColumn(self._mmap, offset, 4, nkeys)
+            offset += 4 * nkeys
+            starts = MapColumn(self._mmap, offset, 4, nkeys + 1)
+            offset += 4 * (nkeys + 1)
+            keyidx[name] = (keys, starts, MapColumn(self._mmap, offset, 4, kcount))
+            offset += 4 * kcount
+        if offset > len(self._mmap):
+            raise Exception("Packet index file is truncated")
+        self._keyidx = keyidx
+        self.complete = True
+
+    def save(self):
+        """Save the index to its index file, the index is flagged as
+           complete and all columns are memory-mapped from the index file
+        """
+        columns = self._columns
+        if isinstance(columns["offset"], MapColumn):
+            # Index has already been loaded from its index file
+            return
+        tsize, ttime = self._trace_stat()
+        itemsize = columns["offset"].itemsize
+        self.complete = True
+        try:
+            fd = open(self.ifile, "wb")
+            try:
+                fd.write(IDX_HEADER.pack(IDX_MAGIC, IDX_VERSION, len(self), itemsize, tsize, ttime))
+                for name, typecode in IDX_COLUMNS:
+                    columns[name].tofile(fd)
+                for name in IDX_KEYS:
+                    kmap = self._keyidx[name]
+                    keys = array.array("I", sorted(kmap))
+                    starts = array.array("I", [0])
+                    indices = array.array("I")
+                    for crc in keys:
+                        indices.extend(kmap[crc])
+                        starts.append(len(indices))
+                    fd.write(IDX_KEYHDR.pack(len(keys), len(indices)))
+                    keys.tofile(fd)
+                    starts.tofile(fd)
+                    indices.tofile(fd)
+            finally:
+                fd.close()
+            self.dprint('PKT1', "Packet index saved: %s" % self.ifile)
+        except Exception as e:
+            # Unable to save the index file, keep the index in memory
+            self.dprint('PKT1', "Unable to save index file %s: %s" % (self.ifile, e))
+
+    def close(self):
+        """Close the index file"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+if __name__ == '__main__':
+    # Build the packet index for every trace file given
+    import sys
+    from packet.pktt import Pktt
+    if len(sys.argv) < 2:
+        print "Usage: python -m packet.pktidx <tracefile> [<tracefile> ...]"
+        exit(1)
+    for tfile in sys.argv[1:]:
+        pktt = Pktt(tfile, index=True)
+        count = pktt.build_index()
+        print "%s: %d packets indexed" % (pktt.pktidx.ifile, count)
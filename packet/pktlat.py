@@ -0,0 +1,375 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+RPC latency analyzer module
+
+Provides the object to compute the latency of every RPC call, the time
+from the call to its reply, in a single pass over a trace file. Calls
+and replies are paired by the same key used by the packet trace object:
+the connection of the call and the xid.
+
+Latencies are grouped by operation, by client and by server. The operation
+is given by the program, version and procedure of the call, e.g., "NFSv3
+GETATTR", and for an NFSv4 COMPOUND it is given by the main operation of
+the compound, see NFSbase.main_op(), e.g., "NFSv4.1 WRITE".
+
+Each group keeps its latencies in a histogram of logarithmic buckets: every
+power of two is divided into a fixed number of buckets, so percentiles are
+given with a bounded relative error using a bounded amount of memory for
+any number of calls. Calls waiting for a reply are dropped as given by
+the call tracker, see packet.pktcall.
+
+Usage:
+    # Display latencies by operation
+    python -m packet.pktlat /traces/tracefile.cap
+
+    # Display latencies by operation, by client and by server
+    python -m packet.pktlat --clients --servers /traces/tracefile.cap
+"""
+import math
+import array
+from optparse import OptionParser
+
+import packet.nfs.nfs3_const as nfs3_const
+import packet.nfs.mount3_const as mount3_const
+import packet.nfs.nlm4_const as nlm4_const
+import packet.nfs.portmap2_const as portmap2_const
+from packet.nfs.nfsbase import NFSbase
+from utilites.baseobj import BaseObj
+from packet.pktcall import CallTracker, PENDING_TIMEOUT, PENDING_MAX
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Number of bits of the bucket index, every power of two is divided into
+# 2**(HIST_BITS-1) buckets and values less than 2**HIST_BITS are exact
+HIST_BITS = 5
+# Maximum value kept in the histogram, larger values use the last bucket
+HIST_MAX = 1 << 40
+
+# Name and procedure names of each RPC program keyed by (program, version)
+_PROGRAMS = {
+    (100003, 3): ("NFSv3",     nfs3_const.nfs_proc3),
+    (100005, 3): ("MOUNTv3",   mount3_const.mount_proc3),
+    (100021, 4): ("NLMv4",     nlm4_const.nlm_proc4),
+    (100000, 2): ("PORTMAPv2", portmap2_const.portmap_proc2),
+}
+
+def _bucket_index(value):
+    """Return the histogram bucket index for the given value"""
+    if value < (1 << HIST_BITS):
+        return value
+    shift = value.bit_length() - HIST_BITS
+    return (shift << (HIST_BITS-1)) + (value >> shift)
+
+def _bucket_range(index):
+    """Return the range of values [low, high) of the given bucket index"""
+    if index < (1 << HIST_BITS):
+        return (index, index + 1)
+    shift = (index >> (HIST_BITS-1)) - 1
+    value = index - (shift << (HIST_BITS-1))
+    return (value << shift, (value + 1) << shift)
+
+class Histogram(BaseObj):
+    """Logarithmic bucket histogram object
+
+       Usage:
+           from packet.pktlat import Histogram
+
+           x = Histogram()
+
+           # Add value
+           x.add(125)
+
+           # Get the 90th percentile
+           value = x.percentile(0.9)
+
+           # Add all values of another histogram
+           x.merge(y)
+
+       Object definition:
+
+       Histogram(
+           count = int,   # Number of values
+           min   = int,   # Minimum value
+           max   = int,   # Maximum value
+           mean  = float, # Average value
+           p50   = int,   # Median
+           p99   = int,   # 99th percentile
+           p999  = int,   # 99.9th percentile
+       )
+    """
+    # Class attributes
+    _attrlist = ("count", "min", "max", "mean", "p50", "p99", "p999")
+
+    def __init__(self):
+        """Constructor
+
+           Initialize object's private data.
+        """
+        self.count    = 0
+        self.min      = None
+        self.max      = None
+        self._sum     = 0
+        # Buckets are added as needed up to the bucket of HIST_MAX
+        self._buckets = array.array("L")
+
+    @property
+    def mean(self):
+        """Average value"""
+        if self.count == 0:
+            return None
+        return float(self._sum) / self.count
+
+    @property
+    def p50(self):
+        """Median"""
+        return self.percentile(0.5)
+
+    @property
+    def p99(self):
+        """99th percentile"""
+        return self.percentile(0.99)
+
+    @property
+    def p999(self):
+        """99.9th percentile"""
+        return self.percentile(0.999)
+
+    def add(self, value):
+        """Add a non-negative integer value to the histogram"""
+        self.count += 1
+        self._sum  += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        index = _bucket_index(min(value, HIST_MAX - 1))
+        buckets = self._buckets
+        if index >= len(buckets):
+            buckets.extend([0] * (index + 1 - len(buckets)))
+        buckets[index] += 1
+
+    def merge(self, hist):
+        """Add all values of the given histogram"""
+        if hist.count == 0:
+            return
+        self.count += hist.count
+        self._sum  += hist._sum
+        if self.min is None or hist.min < self.min:
+            self.min = hist.min
+        if self.max is None or hist.max > self.max:
+            self.max = hist.max
+        buckets = self._buckets
+        if len(hist._buckets) > len(buckets):
+            buckets.extend([0] * (len(hist._buckets) - len(buckets)))
+        for index, count in enumerate(hist._buckets):
+            buckets[index] += count
+
+    def percentile(self, fraction):
+        """Return the value where the given fraction of all values are less
+           than or equal to it, the value is the middle of its bucket so it
+           is given with the relative error of the bucket size. Return None
+           if the histogram is empty.
+
+           fraction:
+               Fraction of all values, e.g., 0.99 for the 99th percentile
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(fraction * self.count)))
+        total = 0
+        for index, count in enumerate(self._buckets):
+            total += count
+            if total >= rank:
+                low, high = _bucket_range(index)
+                value = (low + high - 1) // 2
+                return min(max(value, self.min), self.max)
+        return self.max
+
+class Latency(CallTracker):
+    """RPC latency analyzer object
+
+       Usage:
+           from packet.pktlat import Latency
+
+           x = Latency()
+
+           # Process all packets in the trace file
+           x.run("/traces/tracefile.cap")
+
+           # Or process the packets given by a packet trace object
+           pktt = Pktt("/traces/tracefile.cap", lazy=True)
+           for pkt in pktt:
+               x.add(pkt, pktt)
+
+           # Histogram of all latencies in microseconds
+           hist = x.total
+
+           # Histogram for each operation, client and server
+           hist = x.ops["NFSv4.1 WRITE"]
+           hist = x.clients["192.168.0.20"]
+           hist = x.servers["192.168.0.2"]
+
+           # Display the latencies by operation in milliseconds
+           print x.report()
+
+       Object definition:
+
+       Latency(
+           calls     = int,       # Number of calls
+           replies   = int,       # Number of replies matched to a call
+           unmatched = int,       # Number of replies without a call
+           retrans   = int,       # Number of calls replacing a pending call
+           expired   = int,       # Number of calls dropped without a reply
+           pending   = int,       # Number of calls waiting for a reply
+           total     = Histogram, # Latencies of all calls
+           ops       = dict,      # Histogram for each operation
+           clients   = dict,      # Histogram for each client address
+           servers   = dict,      # Histogram for each server address
+       )
+    """
+    # Class attributes
+    _attrlist = ("calls", "replies", "unmatched", "retrans", "expired",
+                 "pending", "total", "ops", "clients", "servers")
+
+    def __init__(self, timeout=PENDING_TIMEOUT, max_pending=PENDING_MAX):
+        """Constructor
+
+           Initialize object's private data.
+
+           timeout:
+               Seconds of trace time to wait for the reply of a call
+               [default: PENDING_TIMEOUT]
+           max_pending:
+               Maximum number of calls waiting for a reply
+               [default: PENDING_MAX]
+        """
+        CallTracker.__init__(self, timeout, max_pending)
+        self.total   = Histogram()
+        self.ops     = {}
+        self.clients = {}
+        self.servers = {}
+
+        # Operation names keyed by (program, version, procedure)
+        self._opname_map = {}
+
+    def _op_name(self, pkt, rpc):
+        """Return the operation name of the RPC call"""
+        program   = rpc.program
+        version   = rpc.version
+        procedure = rpc.procedure
+        cb_flag = program >= 0x40000000 and program < 0x60000000
+        if (program == 100003 and version == 4 or cb_flag) and procedure == 1:
+            # NFSv4 COMPOUND or CB_COMPOUND: use the main operation
+            nfs = pkt.nfs
+            item = nfs.main_op() if isinstance(nfs, NFSbase) else None
+            if item is not None:
+                minorversion = getattr(nfs, "minorversion", 0)
+                if cb_flag:
+                    vers = "NFSv4"
+                elif minorversion:
+                    vers = "NFSv4.%d" % minorversion
+                else:
+                    vers = "NFSv4"
+                key = (vers, item.op)
+                name = self._opname_map.get(key)
+                if name is None:
+                    name = "%s %s" % (vers, str(item.op)[3:])
+                    self._opname_map[key] = name
+                return name
+
+        key = (program, version, procedure)
+        name = self._opname_map.get(key)
+        if name is None:
+            if cb_flag:
+                name = "NFSv4 CB_%s" % ("NULL" if procedure == 0 else "COMPOUND")
+            elif program == 100003 and version == 4:
+                name = "NFSv4 %s" % ("NULL" if procedure == 0 else "COMPOUND")
+            elif (program, version) in _PROGRAMS:
+                pname, procs = _PROGRAMS[(program, version)]
+                proc = procs.get(procedure)
+                if proc is None:
+                    name = "%s %d" % (pname, procedure)
+                else:
+                    name = "%s %s" % (pname, proc.split("_", 1)[-1])
+            else:
+                name = "%d v%d %d" % (program, version, procedure)
+            self._opname_map[key] = name
+        return name
+
+    def _call(self, pkt, rpc, usecs):
+        """Return the operation, client and server of the call"""
+        ip = pkt.ip
+        return (self._op_name(pkt, rpc), str(ip.src), str(ip.dst))
+
+    def _reply(self, pkt, rpc, usecs, ctime, data):
+        """Add the latency of the call to its histograms"""
+        latency = max(0, usecs - ctime)
+        self.total.add(latency)
+        for gmap, name in zip((self.ops, self.clients, self.servers), data):
+            hist = gmap.get(name)
+            if hist is None:
+                hist = Histogram()
+                gmap[name] = hist
+            hist.add(latency)
+
+    def report(self, group="ops"):
+        """Return the latencies of each group in milliseconds as a table
+           sorted by the number of calls
+
+           group:
+               Name of the group to display: "ops", "clients" or "servers"
+               [default: "ops"]
+        """
+        gmap = getattr(self, group)
+        items = sorted(gmap.items(), key=lambda x: (-x[1].count, x[0]))
+        items.append(("ALL", self.total))
+        width = max(len(x[0]) for x in items)
+        fmt = "%-*s %10s %10s %10s %10s %10s %10s"
+        out = [fmt % (width, group.upper(), "count", "mean", "p50", "p99", "p999", "max")]
+        for name, hist in items:
+            if hist.count == 0:
+                continue
+            values = [hist.mean, hist.p50, hist.p99, hist.p999, hist.max]
+            out.append(fmt % ((width, name, hist.count) + tuple("%.3f" % (x/1000.0) for x in values)))
+        return "\n".join(out)
+
+if __name__ == '__main__':
+    usage = "%prog [options] <tracefile> [<tracefile> ...]"
+    parser = OptionParser(usage=usage, version="%prog " + __version__)
+    parser.add_option("-c", "--clients", action="store_true", default=False,
+                      help="Display latencies by client")
+    parser.add_option("-s", "--servers", action="store_true", default=False,
+                      help="Display latencies by server")
+    parser.add_option("-t", "--timeout", type="float", default=PENDING_TIMEOUT,
+                      help="Seconds to wait for the reply of a call [default: %default]")
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("No trace file given")
+
+    lat = Latency(timeout=opts.timeout)
+    lat.run(args if len(args) > 1 else args[0])
+    print "Latencies in milliseconds, %d calls, %d replies, %d unmatched, %d expired, %d pending" % \
+          (lat.calls, lat.replies, lat.unmatched, lat.expired, lat.pending)
+    print lat.report("ops")
+    if opts.clients:
+        print
+        print lat.report("clients")
+    if opts.servers:
+        print
+        print lat.report("servers")
@@ -0,0 +1,582 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Parallel packet trace decoding module
+
+Provides the object for decoding a tcpdump trace file or a list of trace
+files using multiple processes. Each trace file is split into shards of
+records, every shard is decoded by a process in a multiprocessing pool
+and the results are returned as a single stream of packet summaries.
+
+The pcap format has no record markers, so the start of a shard is found
+by scanning the file from the desired offset until a chain of valid record
+headers is found. Decoding a shard starts a number of bytes before the
+start of the shard (overlap window) so the TCP stream and RPC xid state
+is rebuilt before the first packet of the shard, packets in the overlap
+window belong to the previous shard and are not reported. The overlap
+window must be large enough to include all TCP segments of any RPC
+message spanning the shard boundary. If a shard is found not to start
+or end at a record boundary, it is decoded again serially.
+
+Compressed trace files cannot be split so they are always decoded as a
+single shard unless they are block-compressed (see packet.bgzf), in which
+case they are split using the uncompressed offsets.
+
+Each packet summary is a tuple with the following items:
+    secs   = float,  # Timestamp of packet
+    findex = int,    # Index of trace file in the list of trace files
+    index  = int,    # Packet index in its trace file
+    frame  = int,    # Frame number in its trace file
+    length = int,    # Number of bytes on the wire
+    src    = string, # Source IP address
+    dst    = string, # Destination IP address
+    sport  = int,    # Source port
+    dport  = int,    # Destination port
+    xid    = int,    # RPC transaction id
+    rtype  = int,    # RPC message type: 0 (call) or 1 (reply)
+    ops    = tuple,  # NFSv4 operations on the COMPOUND or the procedure
+                     # for NFSv3 and any other RPC program
+    status = int,    # NFS status of reply
+    match  = bool,   # Packet matches the expression given, None if no
+                     # expression is given
+The items not present on the packet are set to None.
+
+Usage:
+    # Decode trace file using all CPUs and compare the decoding rate
+    # with the serial decoding
+    python -m packet.pktpar /traces/tracefile.cap
+"""
+import os
+import heapq
+import struct
+import multiprocessing
+
+from packet.pktt import Pktt
+from packet.bgzf import BGZFile, is_bgzf
+from utilites.baseobj import BaseObj
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Names of the packet summary items
+SUMMARY_FIELDS = ("secs", "findex", "index", "frame", "length", "src", "dst",
+                  "sport", "dport", "xid", "rtype", "ops", "status", "match")
+
+# Default size of each shard
+SHARD_SIZE = 256*1024*1024
+
+# Default size of the overlap window
+OVERLAP_SIZE = 8*1024*1024
+
+# Number of consecutive valid record headers needed to find the start of
+# a record when splitting the trace file
+SYNC_COUNT = 32
+
+# Maximum number of bytes scanned for the start of a record
+SYNC_MAX = 4*1024*1024
+
+# Maximum record length accepted as valid when splitting the trace file
+_MAX_RECLEN = 256*1024
+
+def pkt_summary(pkt, findex, index, frame, match=None):
+    """Return the summary tuple of the given packet
+
+       pkt:
+           Packet object
+       findex:
+           Index of trace file in the list of trace files
+       index:
+           Packet index in its trace file
+       frame:
+           Frame number in its trace file
+       match:
+           Packet matches the expression [default: None]
+    """
+    record = pkt.record
+    src = dst = sport = dport = xid = rtype = ops = status = None
+    ip = pkt.ip
+    if ip is not None:
+        src = ip.src
+        dst = ip.dst
+    layer = pkt.tcp if pkt.tcp is not None else pkt.udp
+    if layer is not None:
+        sport = layer.src_port
+        dport = layer.dst_port
+    rpc = pkt.rpc
+    if rpc:
+        xid = rpc.xid
+        rtype = rpc.type
+        nfs = pkt.nfs
+        if nfs is not None and getattr(nfs, "array", None) is not None:
+            ops = tuple(int(item.op) for item in nfs.array)
+        elif rtype == 0:
+            ops = (rpc.procedure,)
+        if rtype == 1 and nfs is not None:
+            status = getattr(nfs, "status", None)
+    return (record.secs, findex, index, frame, record.length_orig, src, dst,
+            sport, dport, xid, rtype, ops, status, match)
+
+def _chain_ok(data, offset, eof, rec_st, maxlen, tmin=None, tmax=None):
+    """Return True if there is a chain of valid record headers starting
+       at the given offset of the data
+
+       data:
+           Data read from the trace file
+       offset:
+           Offset in data of the first record header
+       eof:
+           Data includes the end of the trace file
+       rec_st:
+           Struct object of the record header
+       maxlen:
+           Maximum length of a record
+       tmin:
+           Minimum timestamp of a record in seconds [default: None]
+       tmax:
+           Maximum timestamp of a record in seconds [default: None]
+    """
+    dsize = len(data)
+    psecs = None
+    for i in range(SYNC_COUNT):
+        if offset == dsize and eof:
+            # Reached the end of the trace file
+            return True
+        if offset + 16 > dsize:
+            return False
+        secs, usecs, length_inc, length_orig = rec_st.unpack_from(data, offset)
+        if usecs >= 1000000 or length_inc == 0 or length_inc > maxlen or \
+           length_inc > length_orig or length_orig > _MAX_RECLEN:
+            return False
+        if (tmin is not None and secs < tmin) or (tmax is not None and secs > tmax):
+            return False
+        if psecs is not None and abs(secs - psecs) > 3600:
+            return False
+        psecs = secs
+        offset += 16 + length_inc
+    return True
+
+def find_record(fh, offset, rec_st, maxlen, tmin=None, tmax=None):
+    """Return the file offset of the first record found at or after
+       the given offset, None if no record is found
+
+       fh:
+           File object of the trace file
+       offset:
+           File offset where to start searching
+       rec_st:
+           Struct object of the record header
+       maxlen:
+           Maximum length of a record
+       tmin:
+           Minimum timestamp of a record in seconds [default: None]
+       tmax:
+           Maximum timestamp of a record in seconds [default: None]
+    """
+    # Read enough data to include the whole chain of records
+    size = SYNC_MAX + SYNC_COUNT*(16 + maxlen)
+    fh.seek(offset)
+    data = fh.read(size)
+    eof = len(data) < size
+    limit = len(data) if eof else SYNC_MAX
+    for i in xrange(limit):
+        if _chain_ok(data, i, eof, rec_st, maxlen, tmin, tmax):
+            return offset + i
+    return None
+
+def _last_secs(fh, filesize, rec_st, maxlen, tmin):
+    """Return the timestamp in seconds of the last record in the trace
+       file, None if it is not found
+
+       fh:
+           File object of the trace file
+       filesize:
+           Size of the trace file
+       rec_st:
+           Struct object of the record header
+       maxlen:
+           Maximum length of a record
+       tmin:
+           Timestamp in seconds of the first record
+    """
+    offset = max(24, filesize - SYNC_COUNT*(16 + maxlen))
+    offset = find_record(fh, offset, rec_st, maxlen, tmin)
+    if offset is None:
+        return None
+    # Follow the chain of records up to the end of the file
+    secs = None
+    fh.seek(offset)
+    while offset < filesize:
+        header = fh.read(16)
+        if len(header) < 16:
+            return None
+        secs, usecs, length_inc, length_orig = rec_st.unpack(header)
+        offset += 16 + length_inc
+        fh.seek(offset)
+    return secs
+
+def _decode_shard(tfile, findex, start, end, ostart, expr):
+    """Decode all packets in the shard and return a tuple:
+           (list of summaries, number of records, aligned)
+
+       The summaries have the packet index and frame number relative to
+       the start of the shard. The shard is aligned if the decoding started
+       and ended exactly at the start and end of the shard.
+
+       tfile:
+           Name of trace file
+       findex:
+           Index of trace file in the list of trace files
+       start:
+           File offset of the first record in the shard,
+           None to decode the whole file
+       end:
+           File offset of the first record after the shard,
+           None to decode up to the end of the file
+       ostart:
+           File offset of the first record in the overlap window
+       expr:
+           Match expression evaluated on each packet
+    """
+    pktt = Pktt(tfile)
+    pmatch = None
+    if expr is not None:
+        pmatch = pktt._compile_match(expr)
+    if start is not None:
+        pktt.seek_record(ostart)
+
+    summaries = []
+    frame0 = None
+    aligned = end is None
+    while True:
+        try:
+            pkt = pktt.next()
+        except StopIteration:
+            # Reached the end of the file, the shard is not aligned if
+            # the end of the file was reached before the end of the shard
+            aligned = end is None
+            break
+        boffset = pktt.boffset
+        if start is not None and boffset < start:
+            # Packet is in the overlap window
+            continue
+        if end is not None and boffset >= end:
+            # Packet belongs to next shard
+            aligned = boffset == end
+            break
+        if frame0 is None:
+            if start is not None and boffset != start:
+                # Decoding of overlap window went past the start
+                aligned = False
+                break
+            frame0 = pktt.frame
+        match = None
+        if pmatch is not None:
+            try:
+                match = bool(pmatch(pktt))
+            except Exception:
+                match = False
+        summaries.append(pkt_summary(pkt, findex, len(summaries), pktt.frame - frame0, match))
+    if start is not None and frame0 is None:
+        # Decoding of overlap window never got to the start of the shard
+        aligned = False
+    nrecords = 0 if frame0 is None else pktt.frame - frame0
+    del pktt
+    return (summaries, nrecords, aligned)
+
+def _decode_shard_args(args):
+    """Decode shard, the arguments are given as a tuple"""
+    return _decode_shard(*args)
+
+class PktPar(BaseObj):
+    """Parallel packet trace decoder
+
+       Usage:
+           from packet.pktpar import PktPar
+
+           x = PktPar("/traces/tracefile.cap", nprocs=4)
+
+           # Iterate over the summaries of all packets in the trace file,
+           # the summaries are returned in timestamp order
+           for summary in x.decode("NFS.argop == 38"):
+               print summary
+
+           # List of (findex, index) of all packets matching the expression
+           print x.matches
+
+       Object definition:
+
+       PktPar(
+           tfiles     = list, # List of trace file names
+           nprocs     = int,  # Number of processes to use
+           shard_size = int,  # Size of each shard in bytes
+           overlap    = int,  # Size of overlap window in bytes
+           shards     = list, # List of shards for each trace file, each shard
+                              # is given by (start, end, overlap start)
+           count      = int,  # Number of packets decoded
+           matches    = list, # List of (findex, index) of the packets
+                              # matching the expression
+       )
+    """
+    # Class attributes
+    _attrlist = ("tfiles", "nprocs", "shard_size", "overlap", "shards",
+                 "count", "matches")
+
+    def __init__(self, tfiles, nprocs=None, shard_size=SHARD_SIZE, overlap=OVERLAP_SIZE):
+        """Constructor
+
+           Initialize object's private data.
+
+           tfiles:
+               Name of tcpdump trace file or a list of trace file names,
+               the packet index of each packet is relative to its own file
+           nprocs:
+               Number of processes to use [default: number of CPUs]
+           shard_size:
+               Size of each shard in bytes [default: SHARD_SIZE]
+           overlap:
+               Size of the overlap window in bytes [default: OVERLAP_SIZE]
+        """
+        if isinstance(tfiles, str):
+            tfiles = [tfiles]
+        self.tfiles     = tfiles
+        self.nprocs     = nprocs if nprocs else multiprocessing.cpu_count()
+        self.shard_size = shard_size
+        self.overlap    = overlap
+        self.shards     = None
+        self.count      = 0
+        self.matches    = []
+
+    def split(self):
+        """Split all trace files into shards, the list of shards for each
+           trace file is saved in the object attribute shards
+        """
+        self.shards = []
+        for tfile in self.tfiles:
+            self.shards.append(self._split_trace(tfile))
+        return self.shards
+
+    def _split_trace(self, tfile):
+        """Return the list of shards for the given trace file"""
+        filesize = os.stat(tfile).st_size
+        fh = open(tfile, "rb")
+        try:
+            if is_bgzf(fh):
+                # Block-compressed file, shards are given by uncompressed
+                # offsets since any offset can be reached directly
+                fh = BGZFile(fh, tfile + ".gzi")
+                filesize = fh.size
+            header = fh.read(24)
+            if header[:4] == "\324\303\262\241":
+                endian = "<"
+            elif header[:4] == "\241\262\303\324":
+                endian = ">"
+            else:
+                # Compressed or pcapng file, decode whole file on a
+                # single shard
+                return [(None, None, None)]
+            snaplen = struct.unpack(endian + "I", header[16:20])[0]
+            if filesize <= 24 + self.shard_size:
+                return [(None, None, None)]
+
+            rec_st = struct.Struct(endian + "IIII")
+            maxlen = snaplen if snaplen > 0 else _MAX_RECLEN
+
+            # Records found when splitting the file must have a timestamp
+            # between the first and last record of the file
+            tmin = rec_st.unpack(fh.read(16))[0]
+            tmax = _last_secs(fh, filesize, rec_st, maxlen, tmin)
+
+            # Find the start of each shard
+            starts = [24]
+            offset = 24 + self.shard_size
+            while offset < filesize:
+                start = find_record(fh, offset, rec_st, maxlen, tmin, tmax)
+                if start is None or start >= filesize:
+                    break
+                if start > starts[-1]:
+                    starts.append(start)
+                offset = start + self.shard_size
+
+            shards = []
+            for i in range(len(starts)):
+                start = starts[i]
+                end = starts[i+1] if i+1 < len(starts) else None
+                if i == 0:
+                    # First shard has no overlap window
+                    shards.append((start, end, start))
+                    continue
+                ostart = None
+                if start - self.overlap > 24:
+                    ostart = find_record(fh, start - self.overlap, rec_st, maxlen, tmin, tmax)
+                if ostart is None or ostart > start:
+                    ostart = 24
+                shards.append((start, end, ostart))
+            return shards
+        finally:
+            fh.close()
+
+    def decode(self, expr=None):
+        """Decode all trace files in parallel and return an iterator of the
+           summaries of all packets. The summaries of each trace file are in
+           trace file order and the summaries of multiple trace files are
+           merged in timestamp order. The number of packets decoded and the
+           list of packets matching the expression are saved in the object
+           attributes count and matches.
+
+           expr:
+               Match expression evaluated on each packet [default: None]
+        """
+        if self.shards is None:
+            self.split()
+        self.count   = 0
+        self.matches = []
+
+        # Submit the shards of all files in round-robin order so the
+        # first shards of all files are decoded first
+        tasks = []
+        nshards = max(len(x) for x in self.shards)
+        for i in range(nshards):
+            for findex in range(len(self.tfiles)):
+                if i < len(self.shards[findex]):
+                    start, end, ostart = self.shards[findex][i]
+                    tasks.append((findex, (self.tfiles[findex], findex, start, end, ostart, expr)))
+
+        pool = None
+        results = [[] for x in self.tfiles]
+        if self.nprocs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(self.nprocs)
+            for findex, args in tasks:
+                results[findex].append(pool.apply_async(_decode_shard_args, (args,)))
+            pool.close()
+        else:
+            for findex, args in tasks:
+                results[findex].append(args)
+
+        try:
+            streams = [self._file_stream(findex, results[findex], expr) for findex in range(len(self.tfiles))]
+            if len(streams) == 1:
+                stream = streams[0]
+            else:
+                stream = heapq.merge(*streams)
+            for summary in stream:
+                self.count += 1
+                if summary[-1]:
+                    self.matches.append((summary[1], summary[2]))
+                yield summary
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _file_stream(self, findex, results, expr):
+        """Return an iterator of the summaries of all packets in the trace
+           file given by findex, the packet index and frame number of each
+           summary are made relative to the start of the trace file. A shard
+           which is not aligned is decoded again serially together with
+           the following shards until the decoding is aligned
+        """
+        tfile = self.tfiles[findex]
+        shards = self.shards[findex]
+        index = 0
+        frame = 1
+        ostart = None  # Overlap start of the last shard decoded
+        i = 0
+        while i < len(results):
+            item = results[i]
+            if isinstance(item, tuple):
+                # Serial mode, decode shard now
+                item = _decode_shard(*item)
+            else:
+                item = item.get()
+            summaries, nrecords, aligned = item
+            j = i
+            extend = False
+            while not aligned:
+                # A record found when splitting the file is not valid,
+                # decode the shard again serially starting at the overlap
+                # window of the last shard decoded which is known to be
+                # valid, include the next shard if it is still not aligned
+                if extend:
+                    j += 1
+                    if j >= len(shards):
+                        raise Exception("Shard %d of %s is not aligned with the next shard" % (i, tfile))
+                extend = True
+                if ostart is None:
+                    ostart = shards[i][2]
+                self.dprint('PKT1', "Shard %d of %s is not aligned, decoding shards %d-%d serially" % (i, tfile, i, j))
+                summaries, nrecords, aligned = _decode_shard(tfile, findex, shards[i][0], shards[j][1], ostart, expr)
+            for summary in summaries:
+                yield summary[:2] + (summary[2] + index, summary[3] + frame) + summary[4:]
+            index += len(summaries)
+            frame += nrecords
+            if not extend:
+                # Overlap window of this shard is valid
+                ostart = shards[i][2]
+            i = j + 1
+
+def serial_decode(tfiles, expr=None):
+    """Decode all trace files using the serial path and return an iterator
+       of the summaries of all packets as in PktPar.decode()
+
+       tfiles:
+           Name of tcpdump trace file or a list of trace file names
+       expr:
+           Match expression evaluated on each packet [default: None]
+    """
+    if isinstance(tfiles, str):
+        tfiles = [tfiles]
+    streams = []
+    for findex in range(len(tfiles)):
+        summaries = _decode_shard(tfiles[findex], findex, None, None, None, expr)[0]
+        # Frame numbers start at 1
+        streams.append([x[:3] + (x[3] + 1,) + x[4:] for x in summaries])
+    if len(streams) == 1:
+        return iter(streams[0])
+    return heapq.merge(*streams)
+
+if __name__ == '__main__':
+    import time
+    from optparse import OptionParser
+    usage = "%prog [options] <tracefile> [<tracefile> ...]"
+    parser = OptionParser(usage=usage, version="%prog " + __version__)
+    parser.add_option("-p", "--nprocs", type="int", default=None,
+                      help="Number of processes [default: number of CPUs]")
+    parser.add_option("-s", "--shard-size", type="int", default=SHARD_SIZE/(1024*1024),
+                      help="Size of each shard in MB [default: %default]")
+    parser.add_option("-o", "--overlap", type="int", default=OVERLAP_SIZE/(1024*1024),
+                      help="Size of overlap window in MB [default: %default]")
+    parser.add_option("-e", "--expr", default=None,
+                      help="Match expression evaluated on each packet")
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("no trace files given")
+
+    stime = time.time()
+    slist = list(serial_decode(args, opts.expr))
+    sdelta = time.time() - stime
+
+    x = PktPar(args, nprocs=opts.nprocs, shard_size=opts.shard_size*1024*1024, overlap=opts.overlap*1024*1024)
+    stime = time.time()
+    plist = list(x.decode(opts.expr))
+    pdelta = time.time() - stime
+
+    nshards = sum(len(s) for s in x.shards)
+    print "serial:   %d packets in %.3f secs, %.0f packets/sec" % (len(slist), sdelta, len(slist)/sdelta)
+    print "parallel: %d packets in %.3f secs, %.0f packets/sec (%d processes, %d shards)" % (len(plist), pdelta, len(plist)/pdelta, x.nprocs, nshards)
+    if opts.expr is not None:
+        print "matches:  %d" % len(x.matches)
+    print "summaries are %s" % ("identical" if slist == plist else "different")
@@ -0,0 +1,433 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Session slot occupancy module
+
+Provides the object to track the use of the slot table of every NFSv4.1
+session and the number of outstanding RPC calls in a single pass over a
+trace file.
+
+A slot is busy from the SEQUENCE call using it until the reply of that
+call. For each session, the time spent with each number of busy slots
+is kept in an occupancy histogram together with the time spent at the
+slot limit, i.e., having at least target_highest_slotid + 1 busy slots
+where target_highest_slotid is given by the latest SEQUENCE reply. Every
+time the server lowers target_highest_slotid the reduction is recorded.
+The number of outstanding RPC calls of all programs is kept in the same
+kind of histogram.
+
+Calls waiting for a reply are dropped as given by the call tracker, see
+packet.pktcall, and a dropped call releases its slot.
+
+Usage:
+    # Display slot occupancy of each session
+    python -m packet.pktslot /traces/tracefile.cap
+
+    # Include the occupancy histogram of each session
+    python -m packet.pktslot --histogram /traces/tracefile.cap
+"""
+import array
+from collections import OrderedDict
+from optparse import OptionParser
+
+import packet.nfs.nfs4_const as nfs4_const
+from utilites.baseobj import BaseObj
+from packet.pktcall import CallTracker, PENDING_TIMEOUT, PENDING_MAX
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+class Occupancy(BaseObj):
+    """Time-weighted occupancy histogram object
+
+       Usage:
+           from packet.pktslot import Occupancy
+
+           x = Occupancy()
+
+           # Occupancy changes to 3 at the given time in microseconds
+           x.set(usecs, 3)
+
+           # Fraction of time with each occupancy
+           fractions = x.histogram()
+
+           # Occupancy not exceeded 99% of the time
+           level = x.percentile(0.99)
+
+       Object definition:
+
+       Occupancy(
+           level = int,   # Current occupancy
+           max   = int,   # Maximum occupancy
+           time  = int,   # Microseconds tracked
+           mean  = float, # Time-weighted average occupancy
+       )
+    """
+    # Class attributes
+    _attrlist = ("level", "max", "time", "mean")
+
+    def __init__(self):
+        """Constructor
+
+           Initialize object's private data.
+        """
+        self.level = 0
+        self.max   = 0
+        self.time  = 0
+        self._last = None
+        # Microseconds spent at each occupancy, extended as needed
+        self._hist = array.array("d")
+
+    @property
+    def mean(self):
+        """Time-weighted average occupancy"""
+        if self.time == 0:
+            return None
+        return sum(i * x for i, x in enumerate(self._hist)) / self.time
+
+    def advance(self, usecs):
+        """Account the time elapsed since the last change to the current
+           occupancy, return the number of microseconds elapsed
+
+           usecs:
+               Current time in microseconds
+        """
+        last = self._last
+        self._last = usecs
+        if last is None or usecs <= last:
+            return 0
+        elapsed = usecs - last
+        hist = self._hist
+        if self.level >= len(hist):
+            hist.extend([0.0] * (self.level + 1 - len(hist)))
+        hist[self.level] += elapsed
+        self.time += elapsed
+        return elapsed
+
+    def set(self, usecs, level):
+        """Change the occupancy at the given time
+
+           usecs:
+               Time of the change in microseconds
+           level:
+               New occupancy
+        """
+        self.advance(usecs)
+        self.level = level
+        if level > self.max:
+            self.max = level
+
+    def histogram(self):
+        """Return the list of the fraction of time spent at each occupancy"""
+        if self.time == 0:
+            return []
+        return [x / self.time for x in self._hist]
+
+    def percentile(self, fraction):
+        """Return the lowest occupancy which is not exceeded for the given
+           fraction of time. Return None if no time has been tracked.
+
+           fraction:
+               Fraction of time, e.g., 0.99 for the 99th percentile
+        """
+        if self.time == 0:
+            return None
+        limit = fraction * self.time
+        total = 0.0
+        for level, value in enumerate(self._hist):
+            total += value
+            if total >= limit:
+                return level
+        return len(self._hist) - 1
+
+class Session(BaseObj):
+    """NFSv4.1 session slot table object
+
+       Object definition:
+
+       Session(
+           sessionid  = string,    # Session id
+           client     = string,    # Client address
+           server     = string,    # Server address
+           calls      = int,       # Number of SEQUENCE calls
+           replies    = int,       # Number of SEQUENCE replies
+           reused     = int,       # Number of calls using a busy slot
+           expired    = int,       # Number of calls dropped without a reply
+           slots      = Occupancy, # Busy slots over time
+           highest    = int,       # Highest slot id used by the client
+           target     = int,       # Latest target_highest_slotid
+           limit      = int,       # Slot limit: target + 1
+           at_limit   = int,       # Microseconds at the slot limit
+           reductions = list,      # List of (secs, old, new) for every
+                                   # target_highest_slotid reduction
+       )
+    """
+    # Class attributes
+    _attrlist = ("sessionid", "client", "server", "calls", "replies",
+                 "reused", "expired", "slots", "highest", "target", "limit",
+                 "at_limit", "reductions")
+
+    def __init__(self, sessionid, client, server):
+        """Constructor
+
+           Initialize object's private data.
+
+           sessionid:
+               Session id
+           client:
+               Client address
+           server:
+               Server address
+        """
+        self.sessionid  = sessionid
+        self.client     = client
+        self.server     = server
+        self.calls      = 0
+        self.replies    = 0
+        self.reused     = 0
+        self.expired    = 0
+        self.slots      = Occupancy()
+        self.highest    = None
+        self.target     = None
+        self.at_limit   = 0
+        self.reductions = []
+        # Number of outstanding calls on each busy slot
+        self._busy = {}
+
+    @property
+    def limit(self):
+        """Slot limit given by the latest target_highest_slotid"""
+        if self.target is None:
+            return None
+        return self.target + 1
+
+    def _update(self, usecs):
+        """Account the time elapsed since the last change"""
+        limit = self.limit
+        busy = self.slots.level
+        elapsed = self.slots.advance(usecs)
+        if limit is not None and busy >= limit:
+            self.at_limit += elapsed
+
+    def acquire(self, usecs, slotid):
+        """A call has been sent using the given slot
+
+           usecs:
+               Time of the call in microseconds
+           slotid:
+               Slot id of the call
+        """
+        self._update(usecs)
+        self.calls += 1
+        count = self._busy.get(slotid, 0)
+        if count:
+            self.reused += 1
+        self._busy[slotid] = count + 1
+        self.slots.set(usecs, len(self._busy))
+        if self.highest is None or slotid > self.highest:
+            self.highest = slotid
+
+    def release(self, usecs, slotid, target=None):
+        """The call using the given slot has been replied or dropped
+
+           usecs:
+               Time of the reply in microseconds
+           slotid:
+               Slot id of the call
+           target:
+               The target_highest_slotid of the reply [default: None]
+        """
+        self._update(usecs)
+        count = self._busy.get(slotid, 0)
+        if count > 1:
+            self._busy[slotid] = count - 1
+        elif count:
+            del self._busy[slotid]
+        self.slots.set(usecs, len(self._busy))
+        if target is not None:
+            if self.target is not None and target < self.target:
+                self.reductions.append((usecs / 1000000.0, self.target, target))
+            self.target = target
+
+class SlotTracker(CallTracker):
+    """Session slot occupancy tracker object
+
+       Usage:
+           from packet.pktslot import SlotTracker
+
+           x = SlotTracker()
+
+           # Process all packets in the trace file
+           x.run("/traces/tracefile.cap")
+
+           # Or process the packets given by a packet trace object
+           pktt = Pktt("/traces/tracefile.cap", lazy=True)
+           for pkt in pktt:
+               x.add(pkt, pktt)
+
+           # Session objects keyed by the session id
+           for session in x.sessions.values():
+               print session.slots.max, session.at_limit, session.reductions
+
+           # Outstanding RPC calls of all programs
+           print x.rpcs.mean, x.rpcs.max
+
+           # Display the slot occupancy of each session
+           print x.report()
+
+       Object definition:
+
+       SlotTracker(
+           calls     = int,       # Number of calls
+           replies   = int,       # Number of replies matched to a call
+           unmatched = int,       # Number of replies without a call
+           expired   = int,       # Number of calls dropped without a reply
+           pending   = int,       # Number of calls waiting for a reply
+           rpcs      = Occupancy, # Outstanding RPC calls over time
+           sessions  = dict,      # Session objects keyed by session id
+       )
+    """
+    # Class attributes
+    _attrlist = ("calls", "replies", "unmatched", "expired", "pending",
+                 "rpcs", "sessions")
+
+    def __init__(self, timeout=PENDING_TIMEOUT, max_pending=PENDING_MAX):
+        """Constructor
+
+           Initialize object's private data.
+
+           timeout:
+               Seconds of trace time to wait for the reply of a call
+               [default: PENDING_TIMEOUT]
+           max_pending:
+               Maximum number of calls waiting for a reply
+               [default: PENDING_MAX]
+        """
+        CallTracker.__init__(self, timeout, max_pending)
+        self.rpcs     = Occupancy()
+        self.sessions = OrderedDict()
+
+    def _sequence(self, pkt, rpc):
+        """Return the SEQUENCE operation of an NFSv4.1 COMPOUND,
+           None if there is no SEQUENCE operation
+        """
+        if rpc.program != 100003 or rpc.version != 4 or rpc.procedure != 1:
+            return None
+        array = getattr(pkt.nfs, "array", None)
+        if not array or array[0].op != nfs4_const.OP_SEQUENCE:
+            return None
+        return array[0]
+
+    def _call(self, pkt, rpc, usecs):
+        """Acquire the slot of the call, return the session and slot id
+           of the call, session is None if the call is not using a slot
+        """
+        item = self._sequence(pkt, rpc)
+        if item is None:
+            return (None, None)
+        sessionid = item.sessionid
+        session = self.sessions.get(sessionid)
+        if session is None:
+            session = Session(sessionid, str(pkt.ip.src), str(pkt.ip.dst))
+            self.sessions[sessionid] = session
+        session.acquire(usecs, item.slotid)
+        return (session, item.slotid)
+
+    def _reply(self, pkt, rpc, usecs, ctime, data):
+        """Release the slot of the call"""
+        session, slotid = data
+        if session is not None:
+            session.replies += 1
+            target = None
+            seq = self._sequence(pkt, rpc)
+            if seq is not None and seq.status == nfs4_const.NFS4_OK:
+                target = seq.target_highest_slotid
+            session.release(usecs, slotid, target)
+
+    def _drop(self, usecs, data, expired):
+        """Release the slot of the call dropped without a reply"""
+        session, slotid = data
+        if session is not None:
+            if expired:
+                session.expired += 1
+            session.release(usecs, slotid)
+
+    def add(self, pkt, pktt=None):
+        """Process the given packet. Return True if the packet is an RPC
+           call or the reply of a pending call.
+
+           pkt:
+               Packet object
+           pktt:
+               Packet trace object the packet is coming from, dropped
+               calls are released from it [default: None]
+        """
+        if not CallTracker.add(self, pkt, pktt):
+            return False
+        record = pkt.record
+        self.rpcs.set(record.seconds * 1000000 + record.usecs, self.pending)
+        return True
+
+    def report(self, histogram=False):
+        """Return the slot occupancy of each session as a table
+
+           histogram:
+               Include the occupancy histogram of each session
+               [default: False]
+        """
+        fmt = "%-34s %-15s %7s %6s %6s %6s %6s %6s %8s %5s"
+        out = [fmt % ("SESSION", "CLIENT", "calls", "mean", "p99", "max",
+                      "high", "limit", "%limit", "redux")]
+        for session in self.sessions.values():
+            slots = session.slots
+            pct = 100.0 * session.at_limit / slots.time if slots.time else 0.0
+            out.append(fmt % (str(session.sessionid), session.client, session.calls,
+                              "%.2f" % (slots.mean or 0.0), slots.percentile(0.99),
+                              slots.max, session.highest, session.limit,
+                              "%.2f" % pct, len(session.reductions)))
+        rpcs = self.rpcs
+        out.append("")
+        out.append("Outstanding RPC calls: mean %.2f, p99 %s, max %d" % \
+                   (rpcs.mean or 0.0, rpcs.percentile(0.99), rpcs.max))
+        if histogram:
+            for session in self.sessions.values():
+                out.append("")
+                out.append("SESSION %s" % str(session.sessionid))
+                for level, fraction in enumerate(session.slots.histogram()):
+                    if fraction > 0:
+                        out.append("    %5d busy slots: %6.2f%%" % (level, 100.0 * fraction))
+                for secs, old, new in session.reductions:
+                    out.append("    target_highest_slotid %d -> %d at %.6f" % (old, new, secs))
+        return "\n".join(out)
+
+if __name__ == '__main__':
+    usage = "%prog [options] <tracefile> [<tracefile> ...]"
+    parser = OptionParser(usage=usage, version="%prog " + __version__)
+    parser.add_option("-H", "--histogram", action="store_true", default=False,
+                      help="Display the occupancy histogram of each session")
+    parser.add_option("-t", "--timeout", type="float", default=PENDING_TIMEOUT,
+                      help="Seconds to wait for the reply of a call [default: %default]")
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("No trace file given")
+
+    tracker = SlotTracker(timeout=opts.timeout)
+    tracker.run(args if len(args) > 1 else args[0])
+    print "%d calls, %d replies, %d unmatched, %d expired, %d pending, %d sessions" % \
+          (tracker.calls, tracker.replies, tracker.unmatched, tracker.expired,
+           tracker.pending, len(tracker.sessions))
+    print tracker.report(opts.histogram)
@@ -23,7 +23,10 @@ this module to completely automate your tests.
 How does it work? It opens the trace file and reads one record at a time
 keeping track where each record starts. This way, very large trace files
 can be opened without having to wait for the file to load and avoid loading
-the whole file into memory.
+the whole file into memory. Both pcap and pcapng trace files are supported,
+for pcapng files the timestamp resolution of each interface is honored.
+Trace files can also be gzip compressed, if the file is block-compressed
+(see packet.bgzf) any packet can be reached by decompressing a single block.
 
 Packet layers supported:
     - ETHERNET II (RFC 894)
@@ -38,8 +41,12 @@ Packet layers supported:
     - MOUNT v3
     - NLM v4
 """
+import ast
+import copy
 import fcntl
 import gzip
+import heapq
+import mmap
 import os
 import parser
 import re
@@ -49,20 +56,27 @@ import sys
 import termios
 import time
 import token
+from bisect import bisect_left
+from collections import OrderedDict, deque
 
 from utilites.formatstr import *
 
+from packet.bgzf import BGZFile, is_bgzf
 from packet.link.ethernet import ETHERNET
 from packet.pkt import Pkt, PKT_layers
+from packet.inotify import Watcher
+from packet.internet.ipfrag import Reassembly
+from packet.pcapng import PcapNG, PCAPNG_IDENT
+from packet.pktidx import PktIndex, IDX_KEYS, key_crc
 from packet.record import Record
-from packet.unpack import Unpack
+from packet.unpack import Unpack, UnpackView, get_struct
 from utilites.baseobj import BaseObj
 
 # Module constants
 __author__    = "Jorge Mora" 
 __copyright__ = "Copyright (C) 2012 NetApp, Inc."
 __license__   = "GPL v2"
-__version__   = "2.2"
+__version__   = "2.3"
 
 BaseObj.debug_map(0x100000000, 'pkt1', "PKT1: ")
 BaseObj.debug_map(0x200000000, 'pkt2', "PKT2: ")
@@ -76,11 +90,23 @@ _token_map = dict(token.tok_name.items() + symbol.sym_name.items())
 _nfsopmap = {'status': 1, 'tag': 1}
 # Match function map
 _match_func_map = dict(zip(PKT_layers,["self._match_%s"%x for x in PKT_layers]))
+# Cache of compiled match expressions
+_match_expr_map = {}
+# Maximum number of compiled match expressions in the cache
+_MATCH_MAX = 1024
 
 # Read size -- the amount of data read at a time from the file
 # The read ahead buffer actual size is always >= 2*READ_SIZE
 READ_SIZE = 64*1024
 
+# Maximum number of packets to decode before the packet given when
+# jumping to a packet using the packet index. These packets are decoded
+# to rebuild the TCP stream and RPC xid state
+INDEX_LOOKBACK = 1000
+
+# Maximum number of replies in the RPC reply map
+REPLY_MAP_SIZE = 100000
+
 # Show progress if stderr is a tty and stdout is not
 SHOWPROG = os.isatty(2) and not os.isatty(1)
 
@@ -90,7 +116,7 @@ class Header(BaseObj):
                  "dump_length", "link_type")
 
     def __init__(self, pktt):
-        ulist = struct.unpack(pktt.header_fmt, pktt._read(20))
+        ulist = get_struct(pktt.header_fmt).unpack(pktt._read(20))
         self.major       = ulist[0]
         self.minor       = ulist[1]
         self.zone_offset = ulist[2]
@@ -98,6 +124,163 @@ class Header(BaseObj):
         self.dump_length = ulist[4]
         self.link_type   = ulist[5]
 
+class MatchCmp(BaseObj):
+    """Compiled comparison of a match expression
+
+       Object definition:
+
+       MatchCmp(
+           layer = string,   # Packet layer, e.g., "ip", "nfs"
+           uargs = string,   # Comparison without the layer prefix
+           func  = function, # Evaluate comparison on the packet layer,
+                             # takes the Pktt object as argument
+           ifunc = function, # Evaluate comparison on an NFSv4 operation,
+                             # takes the operation object as argument
+           top   = bool,     # Comparison of top level NFSv4 attributes
+       )
+    """
+    # Class attributes
+    _attrlist = ("layer", "uargs", "func", "ifunc", "top")
+
+    def __init__(self, layer, uargs, func, ifunc, top):
+        self.layer = layer
+        self.uargs = uargs
+        self.func  = func
+        self.ifunc = ifunc
+        self.top   = top
+
+class MatchFilter(BaseObj):
+    """Prefilter of a match expression on the raw record data
+
+       Simple comparisons on the IPv4 addresses, the IP protocol and the
+       TCP/UDP ports which are part of the top level conjunction of a match
+       expression are checked directly on the raw bytes of the record at
+       their fixed Ethernet, IPv4 and TCP/UDP header offsets. A record which
+       fails any of these checks cannot match the expression so there is
+       no need to fully decode it.
+
+       Comparisons on the NFS filehandle, stateid, clientid or sessionid
+       are added as key checks, these are not checked on the raw bytes of
+       the record but they are used to get the list of packets which may
+       match the expression from the key indexes of the packet index.
+
+       Usage:
+           from packet.pktt import MatchFilter
+
+           x = MatchFilter()
+
+           # Add comparison "IP.src == '192.168.0.20'"
+           x.add("ip", "src", "192.168.0.20")
+
+           # Add comparison "crc32(NFS.fh) == 0x5d4cbd8e"
+           x.add_key("fh", 0x5d4cbd8e)
+
+           # Check the raw record data
+           if x(data):
+               # Record may match the expression
+               ...
+
+       Object definition:
+
+       MatchFilter(
+           ipchecks = list, # List of (offset, string) checks on the
+                            # Ethernet and IPv4 headers
+           l4checks = list, # List of (offset, string) checks on the
+                            # TCP/UDP header
+           keychecks = list, # List of (name, crc) checks on the key
+                             # indexes of the packet index
+       )
+    """
+    # Class attributes
+    _attrlist = ("ipchecks", "l4checks", "keychecks")
+
+    def __init__(self):
+        """Constructor
+
+           Initialize object's private data.
+        """
+        self.ipchecks  = []
+        self.l4checks  = []
+        self.keychecks = []
+
+    def __nonzero__(self):
+        """Truth value testing, object is True if it has any checks"""
+        return bool(self.ipchecks or self.l4checks or self.keychecks)
+
+    def add(self, layer, lhs, value):
+        """Add a comparison for equality to the prefilter.
+           Return True if the comparison is supported by the prefilter.
+
+           layer:
+               Packet layer of the comparison, e.g., "ip", "tcp"
+           lhs:
+               Attribute of the packet layer, e.g., "src", "dst_port"
+           value:
+               Value of the right hand side of the comparison
+        """
+        if layer == "ip" and lhs in ("src", "dst") and isinstance(value, str):
+            m = re.search(r"^(\d+)\.(\d+)\.(\d+)\.(\d+)$", value)
+            if m is None:
+                return False
+            octets = [int(x) for x in m.groups()]
+            if max(octets) > 255:
+                return False
+            offset = 26 if lhs == "src" else 30
+            self.ipchecks.append((offset, "".join(chr(x) for x in octets)))
+        elif layer == "ip" and lhs == "protocol" and isinstance(value, int):
+            if value < 0 or value > 255:
+                return False
+            self.ipchecks.append((23, chr(value)))
+        elif layer in ("tcp", "udp") and lhs in ("src_port", "dst_port") and isinstance(value, int):
+            if value < 0 or value > 0xFFFF:
+                return False
+            # Packet must have the corresponding transport layer
+            self.ipchecks.append((23, chr(6 if layer == "tcp" else 17)))
+            offset = 0 if lhs == "src_port" else 2
+            self.l4checks.append((offset, struct.pack("!H", value)))
+        elif layer == "nfs" and lhs in IDX_KEYS:
+            crc = key_crc(value)
+            if crc is None:
+                return False
+            self.keychecks.append((lhs, crc))
+        else:
+            return False
+        return True
+
+    def add_key(self, name, crc):
+        """Add a key check given by the CRC32 of the key
+
+           name:
+               Name of the key index, e.g., "fh", "stateid"
+           crc:
+               CRC32 of the key
+        """
+        self.keychecks.append((name, crc))
+
+    def __call__(self, data):
+        """Return False if the record cannot match the expression
+
+           data:
+               Raw record data starting at the Ethernet header
+        """
+        if data[12:14] != "\x08\x00" or len(data) < 34:
+            # Not an IPv4 packet, record must be decoded
+            return True
+        for offset, value in self.ipchecks:
+            if data[offset:offset+len(value)] != value:
+                return False
+        if self.l4checks:
+            if ord(data[20]) & 0x1F or data[21] != "\x00":
+                # IP fragment, record must be decoded
+                return True
+            # Offset of the TCP/UDP header
+            l4off = 14 + 4*(ord(data[14]) & 0x0F)
+            for offset, value in self.l4checks:
+                offset += l4off
+                if data[offset:offset+2] != value:
+                    return False
+        return True
+
 class Pktt(BaseObj, Unpack):
     """Packet trace object
 
@@ -110,7 +293,7 @@ class Pktt(BaseObj, Unpack):
            for pkt in x:
                print pkt
     """
-    def __init__(self, tfile, live=False, state=True):
+    def __init__(self, tfile, live=False, state=True, use_mmap=False, index=False, lazy=False, serial=False):
         """Constructor
 
            Initialize object's private data, note that this will not check the
@@ -127,8 +310,38 @@ class Pktt(BaseObj, Unpack):
                file. This is useful when running tcpdump in parallel,
                especially when tcpdump is run with the '-C' option, in which
                case when <EOF> is encountered the next trace file created by
-               tcpdump will be opened and the object will be re-initialized,
-               all private data referencing the previous file is lost.
+               tcpdump will be opened keeping the TCP stream and RPC xid
+               state, the packet index and the frame number. The object
+               waits for new data using inotify if available, otherwise
+               it polls the trace file. See also follow().
+           use_mmap:
+               If set to True, the trace file is memory-mapped and all records
+               are read directly from the map instead of using the read ahead
+               buffer. Seeking to any offset is just a matter of moving the
+               file offset. This option is ignored for compressed trace files
+               or when 'live' is set, in which case the read ahead buffer
+               is used. Records are not copied from the map.
+           index:
+               If set to True, use the packet index saved in the index file
+               "<tracefile>.idx" to jump directly to any packet. If the index
+               file does not exist, the index is built on the first pass of
+               the trace file and saved at the end of the pass. This option
+               is ignored when 'live' is set.
+           lazy:
+               If set to True, the RPC payload (NFS, MOUNT, NLM, etc.) is not
+               decoded when the packet is read. Only the layers up to the RPC
+               header are decoded so the TCP stream and RPC xid state is kept
+               up to date. The RPC payload is decoded on the first access to
+               any of its layers, e.g., pkt.nfs. This greatly reduces the
+               cost of scanning a trace file when matching only on lower
+               layers like IP addresses or TCP ports.
+           serial:
+               If set to True and a list of trace files is given, the trace
+               files are processed one after the other in the order given
+               as a single logical trace, e.g., the trace files created by
+               tcpdump when using the '-C' option. Otherwise, the packets of
+               all trace files are merged in timestamp order. In both cases
+               the TCP stream and RPC xid state is shared by all trace files.
         """
         self.tfile   = tfile  # Current trace file name
         self.bfile   = tfile  # Base trace file name
@@ -138,14 +351,22 @@ class Pktt(BaseObj, Unpack):
         self.ioffset = 0      # File offset of first packet
         self.index   = 0      # Current packet index
         self.frame   = 1      # Current frame number
-        self.mindex  = 0      # Maximum packet index for current trace file
         self.findex  = 0      # Current tcpdump file index (used with self.live)
         self.fh      = None   # Current file handle
+        self.usemmap = use_mmap # Memory-map the trace file if possible
+        self.mmap    = None   # Memory map of the trace file
+        self.pcapng  = None   # Pcapng reader if trace file is pcapng
+        self._watcher = None  # Watcher of trace file directory (live)
+        self.useindex = index # Use the packet index if possible
+        self.pktidx  = None   # Packet index object
+        self.lazy    = lazy   # Decode the RPC payload on first access
         self.eof     = False  # End of file marker for current packet trace
-        self.serial  = False  # Processing trace files serially
+        self.serial  = serial # Processing trace files serially
         self.pkt     = None   # Current packet
         self.pkt_call  = None # The current packet call if self.pkt is a reply
         self.pktt_list = []   # List of Pktt objects created
+        self._merge_heap = None # Heap of (timestamp, index) of Pktt objects
+        self._merge_index = 0 # Index of current Pktt object in serial mode
         self.tfiles    = []   # List of packet trace files
         self.rdbuffer  = ""   # Read buffer
         self.rdoffset  = 0    # Read buffer offset
@@ -158,14 +379,32 @@ class Pktt(BaseObj, Unpack):
         self.progdone  = 0    # Display last progress only once
         self.timestart = time.time() # Time reference base
         self.reply_matched = False   # Matching a reply
+        self._match_debug  = False   # Display debug info for each comparison
+        self._prefilter    = None    # Prefilter of the current match
+        self.prefiltered   = False   # Current packet failed the prefilter
+        self._keyfilter    = None    # Record offsets given by the key indexes
+        self._key_map      = {}      # Cache of (indices, offsets) by key checks
+        self.prefilter_hits   = 0    # Number of records passing the prefilter
+        self.prefilter_misses = 0    # Number of records failing the prefilter
+        self._tcp_pending  = None    # Packet whose TCP segment has more RPC records
+        self.ipfrag = Reassembly()   # IP fragment reassembly and its counters
 
         # TCP stream map: to keep track of the different TCP streams within
         # the trace file -- used to deal with RPC packets spanning multiple
         # TCP packets or to handle a TCP packet having multiple RPC packets
         self._tcp_stream_map = {}
 
-        # RPC xid map: to keep track of packet calls
+        # RPC xid map: to keep track of packet calls, keyed by the RPC key
+        # given by rpc_key() so calls from different connections using
+        # the same xid are kept apart
         self._rpc_xid_map = {}
+        # RPC reply map: tuple (index, call index) of each reply keyed by
+        # the RPC key, see rpc_key(), where call index is the packet index
+        # of its call or None if the call has not been decoded. The map
+        # is kept across rewinds since the packet index of a reply does
+        # not change, the entry is removed when a call is decoded using
+        # the same key so it is never stale
+        self._rpc_reply_map = OrderedDict()
         # List of outstanding xids to match
         self._match_xid_list = []
 
@@ -179,15 +418,20 @@ class Pktt(BaseObj, Unpack):
             else:
                 # Create all packet trace objects
                 for tfile in self.tfiles:
-                    self.pktt_list.append(Pktt(tfile))
+                    self.pktt_list.append(Pktt(tfile, use_mmap=use_mmap, index=index, lazy=lazy))
 
     def __del__(self):
         """Destructor
 
            Gracefully close the tcpdump trace file if it is opened.
         """
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
         if self.fh:
             self.fh.close()
+        if self._watcher is not None:
+            self._watcher.close()
 
     def __iter__(self):
         """Make this object iterable."""
@@ -236,6 +480,9 @@ class Pktt(BaseObj, Unpack):
             # The index is less than the current packet offset so position
             # the file pointer to the offset of the packet given by index
             self.rewind(index)
+        elif index - self.index > INDEX_LOOKBACK and self._index_ok(index):
+            # Jump forward directly to the packet using the packet index
+            self.rewind(index)
 
         # Move to the packet specified by the index
         pkt = None
@@ -287,38 +534,24 @@ class Pktt(BaseObj, Unpack):
 
         if len(self.pktt_list) > 1:
             # Dealing with multiple trace files
-            minsecs  = None
-            pktt_obj = None
-            for obj in self.pktt_list:
-                if obj.pkt is None:
-                    # Get first packet for this packet trace object
-                    try:
-                        obj.next()
-                    except StopIteration:
-                        obj.mindex = self.index
-                if obj.eof:
+            if self._merge_heap is None:
+                self._merge_init()
+            while True:
+                # Get the packet trace object having the next packet
+                findex = self._merge_next()
+                if findex is None:
+                    # All packet trace files have been processed
+                    self.offset = self.filesize
+                    self.show_progress(True)
+                    raise StopIteration
+                pktt_obj = self.pktt_list[findex]
+                offset = pktt_obj.offset
+                try:
+                    pktt_obj.next()
+                    break
+                except StopIteration:
+                    # Truncated record, this packet trace file is done
                     continue
-                if minsecs is None or obj.pkt.record.secs < minsecs:
-                    minsecs = obj.pkt.record.secs
-                    pktt_obj = obj
-            if self.filesize == 0:
-                # Calculate total bytes to process
-                for obj in self.pktt_list:
-                    self.filesize += obj.filesize
-            if pktt_obj is None:
-                # All packet trace files have been processed
-                self.offset = self.filesize
-                self.show_progress(True)
-                raise StopIteration
-            elif len(self._tcp_stream_map):
-                # This packet trace file should be processed serially
-                # Have all state transferred to next packet object
-                pktt_obj.rewind()
-                pktt_obj._tcp_stream_map = self._tcp_stream_map
-                pktt_obj._rpc_xid_map    = self._rpc_xid_map
-                self._tcp_stream_map = {}
-                self._rpc_xid_map    = {}
-                pktt_obj.next()
 
             # Overwrite attributes seen by the caller with the attributes
             # from the current packet trace object
@@ -326,28 +559,12 @@ class Pktt(BaseObj, Unpack):
             self.pkt_call = pktt_obj.pkt_call
             self.tfile = pktt_obj.tfile
             self.pkt.record.index = self.index  # Use a cumulative index
-            self.offset += pktt_obj.offset - pktt_obj.boffset
+            self.offset += pktt_obj.offset - offset
+            self._save_reply(self.pkt)
 
-            try:
-                # Get next packet for this packet trace object
-                pktt_obj.next()
-            except StopIteration:
-                # Set maximum packet index for this packet trace object to
-                # be used by rewind to select the proper packet trace object
-                pktt_obj.mindex = self.index
-                # Check if objects should be serially processed
-                pktt_obj.serial = False
-                for obj in self.pktt_list:
-                    if not obj.eof:
-                        if obj.index > 1:
-                            pktt_obj.serial = False
-                            break
-                        elif obj.index == 1:
-                            pktt_obj.serial = True
-                if pktt_obj.serial:
-                    # Save current state
-                    self._tcp_stream_map = pktt_obj._tcp_stream_map
-                    self._rpc_xid_map    = pktt_obj._rpc_xid_map
+            if not self.serial:
+                # Add packet trace object back to the merge heap
+                self._merge_push(findex)
 
             self.show_progress()
 
@@ -355,6 +572,60 @@ class Pktt(BaseObj, Unpack):
             self.index += 1
             return self.pkt
 
+        # Open packet trace if needed
+        self._getfh()
+
+        if self._tcp_pending is not None:
+            # The TCP segment of the previous packet has more RPC records,
+            # decode the next one without reading the record again
+            self._decode_pending()
+        else:
+            self._decode_record()
+
+        # Save packet index if this is an RPC reply
+        self._save_reply(self.pkt)
+
+        if self.pktidx is not None and not self.pktidx.complete and self.index == len(self.pktidx):
+            # Add packet to the packet index
+            record = self.pkt.record
+            self.pktidx.append(self.boffset, record.frame, record.seconds, record.usecs, record.length_inc)
+            self._index_keys(self.pkt)
+
+        self.show_progress()
+
+        # Increment packet index
+        self.index += 1
+
+        return self.pkt
+
+    def _index_keys(self, pkt):
+        """Add the NFS filehandles, stateids, clientids and sessionids of
+           the packet to the key indexes of the packet index. The keys are
+           taken from the same objects used when matching the NFS layer
+           so a match on any of these keys only needs to check the packets
+           given by the key index. The RPC payload is decoded if the packet
+           has been decoded in lazy mode or if it failed the prefilter.
+        """
+        nfs = pkt.nfs
+        if nfs is None:
+            return
+        if pkt.rpc.version == 3:
+            objlist = [nfs]
+        else:
+            objlist = getattr(nfs, "array", None) or []
+        index = self.index
+        pktidx = self.pktidx
+        for obj in objlist:
+            for name in IDX_KEYS:
+                try:
+                    value = getattr(obj, name, None)
+                except Exception:
+                    continue
+                if value is not None:
+                    pktidx.add_key(name, value, index)
+
+    def _decode_record(self):
+        """Read the next record from the trace file and decode it"""
         if self.boffset != self.offset:
             # Frame number is one for every record header on the pcap trace
             # On the other hand self.index is the packet number. Since there
@@ -368,10 +639,24 @@ class Pktt(BaseObj, Unpack):
         # Save file offset for this packet
         self.boffset = self.offset
 
-        # Get record header
-        data = self._read(16)
-        if len(data) < 16:
+        if self.pcapng is not None:
+            # Get record header from the next packet block, all other
+            # blocks are processed by the pcapng object
+            data = self.pcapng.read_record(self)
+            if data is not None:
+                self.boffset = self.pcapng.offset
+                link_type = self.pcapng.iface.link_type
+        else:
+            # Get record header
+            data = self._read(16)
+            if len(data) < 16:
+                data = None
+            link_type = self.header.link_type
+        if data is None:
             self.eof = True
+            if self.pktidx is not None and not self.pktidx.complete and self.index == len(self.pktidx):
+                # All packets have been indexed, save the packet index
+                self.pktidx.save()
             self.offset = self.filesize
             self.show_progress(True)
             raise StopIteration
@@ -379,53 +664,295 @@ class Pktt(BaseObj, Unpack):
         record = Record(self, data)
 
         # Get record data and create Unpack object
-        self.unpack = Unpack(self._read(record.length_inc))
+        if self.mmap is not None:
+            # Memory-mapped file, use a view of the record buffer so the
+            # record data is not copied
+            self.unpack = UnpackView(buffer(self.mmap, self.offset, record.length_inc))
+            self.offset += self.unpack.size()
+        else:
+            self.unpack = Unpack(self._read(record.length_inc))
         if self.unpack.size() < record.length_inc:
             # Record has been truncated, stop iteration
             self.eof = True
             self.offset = self.filesize
             self.show_progress(True)
             raise StopIteration
-
-        if self.header.link_type == 1:
-            # Decode ethernet layer
-            ETHERNET(self)
+        if self.pcapng is not None and self.pcapng.trailer:
+            # Skip padding and options of the packet block
+            self.seek(self.offset + self.pcapng.trailer)
+
+        self.prefiltered = False
+        if link_type == 1:
+            if self._prefilter is None:
+                # Decode ethernet layer
+                ETHERNET(self)
+            elif (self._keyfilter is None or self.boffset in self._keyfilter) and \
+                 self._prefilter(self.unpack._data):
+                # Record passed the prefilter, decode ethernet layer
+                self.prefilter_hits += 1
+                ETHERNET(self)
+            else:
+                # Record cannot match the current expression
+                self.prefilter_misses += 1
+                self.prefiltered = True
+                data = self.unpack._data
+                if data[12:14] != "\x08\x00" or len(data) < 34 or ord(data[23]) in (6, 17):
+                    # Decode the layers up to the RPC header only so the
+                    # TCP stream and RPC xid state is kept up to date,
+                    # a record failing the key filter could be any type
+                    lazy = self.lazy
+                    self.lazy = True
+                    try:
+                        ETHERNET(self)
+                    finally:
+                        self.lazy = lazy
         else:
             # Unknown link layer
             record.data = self.unpack.getbytes()
 
-        self.show_progress()
+    def _decode_pending(self):
+        """Decode the next RPC record on the TCP segment of the previous
+           packet, the new packet shares all layers up to the TCP layer
+           with the previous packet
+        """
+        pkt, stream = self._tcp_pending
+        self._tcp_pending = None
+        record = copy.copy(pkt.record)
+        record.index = self.index
+        self.pkt.record = record
+        for layer in ("ethernet", "ip", "tcp"):
+            setattr(self.pkt, layer, getattr(pkt, layer))
+        lazy = self.lazy
+        if self.prefiltered:
+            # Record failed the prefilter, decode up to the RPC header only
+            self.lazy = True
+        try:
+            pkt.tcp._decode_rpc(self, stream)
+        finally:
+            self.lazy = lazy
+
+    def follow(self, expr=None, timeout=None):
+        """Generator which returns every packet as soon as it is written to
+           the trace file. The trace file is followed as a live trace even
+           if the object was not created with the 'live' option, including
+           moving to the next trace file when tcpdump is run with the '-C'
+           option. The packets are returned without waiting on a partially
+           written record so the caller can check packets while tcpdump is
+           still running.
 
-        # Increment packet index
-        self.index += 1
+           expr:
+               Return only the packets matching the expression, see match()
+               for the format of the expression [default: None]
+           timeout:
+               Stop if there is no new data for this number of seconds,
+               follow the trace forever if None [default: None]
 
-        return self.pkt
+           Examples:
+               # Wait for the first NFS OPEN call while the test is running
+               for pkt in x.follow("NFS.argop == 18", timeout=30):
+                   break
+        """
+        self.live = True
+        self._getfh()
+        pmatch = None
+        if expr is not None:
+            pmatch = self._compile_match(expr)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self._tcp_pending is None and not self._live_ready():
+                if self._live_next():
+                    continue
+                if deadline is not None:
+                    wtime = deadline - time.time()
+                    if wtime <= 0 or not self._live_wait(wtime):
+                        # Timeout waiting for new data
+                        return
+                else:
+                    self._live_wait()
+                continue
+            pkt = self.next()
+            if deadline is not None:
+                deadline = time.time() + timeout
+            if self._watcher is not None:
+                self._watcher.reset()
+            if pmatch is None or pmatch(self):
+                yield pkt
+
+    def _live_ready(self):
+        """Return True if the next record is entirely in the trace file so
+           reading it will not block
+        """
+        fsize = os.fstat(self.fh.fileno()).st_size
+        if self.pcapng is not None:
+            hsize = 8
+        else:
+            hsize = 16
+        if self.offset + hsize > fsize:
+            return False
+        if self.rdoffset + hsize <= len(self.rdbuffer):
+            # Record header is already in the read buffer
+            data = self.rdbuffer[self.rdoffset:self.rdoffset+hsize]
+        else:
+            # Read record header directly from the file
+            offset = self.offset
+            self.fh.seek(offset)
+            data = self.fh.read(hsize)
+            self.seek(offset, hard=True)
+            if len(data) < hsize:
+                return False
+        if self.pcapng is not None:
+            # Block total length
+            rsize = self.pcapng.section.block_st.unpack(data)[1]
+        else:
+            rsize = hsize + get_struct(self.header_rec).unpack(data)[2]
+        return self.offset + rsize <= fsize
+
+    def _live_next(self):
+        """Move to the next trace file created by tcpdump when using the
+           '-C' option. The TCP stream and RPC xid state is kept as well
+           as the packet index and the frame number so all trace files are
+           processed as a single trace. Return True if the next trace file
+           is opened, False if the next trace file does not exist or if
+           there is more data on the current trace file.
+        """
+        tracefile = "%s%d" % (self.bfile, self.findex+1)
+        if not os.path.isfile(tracefile):
+            return False
+        if os.fstat(self.fh.fileno()).st_size > self.offset:
+            # Finish reading the current trace file first
+            return False
+        self.dprint('PKT1', ">>> Following next trace file %s" % tracefile)
+        index  = self.index
+        tstart = self.tstart
+        # Last record of the current trace file has been processed
+        nframe = self.boffset != self.offset
+        self.fh.close()
+        self.fh       = None
+        self.tfile    = tracefile
+        self.findex  += 1
+        self.rdbuffer = ""
+        self.rdoffset = 0
+        self._getfh()
+        self.index  = index
+        self.tstart = tstart
+        if nframe:
+            self.frame += 1
+        return True
+
+    def _live_wait(self, timeout=None):
+        """Wait for data to be written to the trace file or for the next
+           trace file to be created. Return False on timeout.
+        """
+        if self._watcher is None:
+            self._watcher = Watcher(os.path.dirname(os.path.abspath(self.tfile)))
+        ret = self._watcher.wait(timeout)
+        # Clear the <EOF> condition of the file object
+        self.fh.seek(0, os.SEEK_CUR)
+        return ret
+
+    def _peek_secs(self):
+        """Return the timestamp of the next record without consuming it
+           or None if there are no more records in the trace file
+        """
+        if self._tcp_pending is not None:
+            # Next packet is on the current record
+            return self.pkt.record.secs
+        if self.pcapng is not None:
+            offset = self.offset
+            rec = self.pcapng.read_record(self)
+            self.seek(offset)
+            if rec is None:
+                return None
+            return float(rec[0]) + float(rec[1])/1000000.0
+        rec_st = get_struct(self.header_rec)
+        if self.mmap is not None:
+            if self.offset + 16 > self.filesize:
+                return None
+            ulist = rec_st.unpack_from(self.mmap, self.offset)
+        elif self.rdoffset + 16 <= len(self.rdbuffer):
+            # Record header is already in the read buffer
+            ulist = rec_st.unpack_from(self.rdbuffer, self.rdoffset)
+        else:
+            offset = self.offset
+            data = self._read(16)
+            self.seek(offset)
+            if len(data) < 16:
+                return None
+            ulist = rec_st.unpack(data)
+        return float(ulist[0]) + float(ulist[1])/1000000.0
+
+    def _merge_init(self):
+        """Initialize the merge of multiple trace files, all packet trace
+           objects share the TCP stream and RPC xid state of this object
+        """
+        self._tcp_stream_map = {}
+        self._rpc_xid_map    = {}
+        self.ipfrag.clear()
+        self._merge_heap  = []
+        self._merge_index = 0
+        self.filesize = 0
+        for findex in range(len(self.pktt_list)):
+            obj = self.pktt_list[findex]
+            obj._tcp_stream_map = self._tcp_stream_map
+            obj._rpc_xid_map    = self._rpc_xid_map
+            obj.ipfrag          = self.ipfrag
+            obj._getfh()
+            # Calculate total bytes to process
+            self.filesize += obj.filesize
+            if not self.serial:
+                self._merge_push(findex)
+
+    def _merge_push(self, findex):
+        """Add the packet trace object given by the index to the merge heap
+           using the timestamp of its next record as the key
+        """
+        secs = self.pktt_list[findex]._peek_secs()
+        if secs is not None:
+            heapq.heappush(self._merge_heap, (secs, findex))
+
+    def _merge_next(self):
+        """Return the index of the packet trace object having the next packet
+           or None if all packet trace files have been processed
+        """
+        if self.serial:
+            # Process trace files one after the other
+            while self._merge_index < len(self.pktt_list):
+                obj = self.pktt_list[self._merge_index]
+                if not obj.eof and obj._peek_secs() is not None:
+                    return self._merge_index
+                self._merge_index += 1
+            return None
+        if self._merge_heap:
+            return heapq.heappop(self._merge_heap)[1]
+        return None
 
     def rewind(self, index=0):
         """Rewind the trace file by setting the file pointer to the start of
            the given packet index. Returns False if unable to rewind the file,
            e.g., when the given index is greater than the maximum number
-           of packets processed so far.
+           of packets processed so far. If the packet index is used, the
+           file pointer can be set to any packet in the index.
         """
         self.dprint('PKT1', ">>> rewind(%d)" % index)
-        if index >= 0 and index < self.index:
+        if index >= 0 and (index < self.index or self._index_ok(index)):
             if len(self.pktt_list) > 1:
-                # Dealing with multiple trace files
-                self.index = 0
+                # Dealing with multiple trace files, rewind all packet trace
+                # objects and start the merge all over again
+                self.index  = 0
+                self.offset = 0
                 for obj in self.pktt_list:
-                    if not obj.eof or index <= obj.mindex:
-                        obj.rewind()
-                        try:
-                            obj.next()
-                        except StopIteration:
-                            pass
-                    elif obj.serial and index > obj.mindex:
-                        self.index = obj.mindex + 1
+                    obj.rewind()
+                self._merge_heap = None
+            elif self._index_ok(index) and self._index_seek(index):
+                # Jumped directly to the packet using the packet index
+                return True
             else:
                 # Reset the current packet index and offset to the first packet
-                self.offset = self.ioffset
-                self.index  = 0
-                self.eof    = False
+                self.offset  = self.ioffset
+                self.boffset = self.ioffset
+                self.index   = 0
+                self.frame   = 1
+                self.eof     = False
 
                 # Position the file pointer to the offset of the first packet
                 self.seek(self.ioffset)
@@ -433,6 +960,8 @@ class Pktt(BaseObj, Unpack):
                 # Clear state
                 self._tcp_stream_map = {}
                 self._rpc_xid_map    = {}
+                self._tcp_pending    = None
+                self.ipfrag.clear()
 
             # Move to the packet before the specified by the index so the
             # next packet fetched will be the one given by index
@@ -446,14 +975,176 @@ class Pktt(BaseObj, Unpack):
             return True
         return False
 
+    def _index_ok(self, index):
+        """Return True if the packet given by index is in the packet index"""
+        if self.pktidx is None and self.useindex and not self.live and len(self.pktt_list) <= 1:
+            # Open packet trace to load the packet index
+            self._getfh()
+        return self.pktidx is not None and index >= 0 and index < len(self.pktidx)
+
+    def _index_seek(self, index):
+        """Position the file pointer to the packet given by index using the
+           packet index. The TCP stream and RPC xid state is rebuilt by
+           decoding at most INDEX_LOOKBACK packets before the given packet.
+           Returns False if unable to position the file pointer, e.g.,
+           when the packets decoded do not match the packet index.
+        """
+        self.dprint('PKT1', ">>> index_seek(%d)" % index)
+        pktidx = self.pktidx
+        # Start decoding on the first packet of the record
+        start = pktidx.find(pktidx.offset(max(0, index - INDEX_LOOKBACK)))
+        if self.tstart is None:
+            # Timestamp of first packet is needed for relative times
+            entry = pktidx[0]
+            self.tstart = float(entry.seconds) + float(entry.usecs)/1000000.0
+
+        # Position the file pointer to the offset of the starting packet,
+        # index columns are given as long integers
+        self.seek_record(int(pktidx.offset(start)), int(pktidx[start].frame), start)
+
+        while self.index < index:
+            try:
+                self.next()
+            except StopIteration:
+                return False
+            if self._tcp_pending is None:
+                # Next packet is on a new record, re-synchronize the packet
+                # index in case the state at the start of the look-back
+                # window gave a different number of packets on a record
+                self.index = pktidx.find(self.offset)
+        if self.index != index:
+            return False
+        return True
+
+    def seek_record(self, offset, frame=1, index=0):
+        """Position the file pointer to the record at the given file offset
+           so the next packet fetched is the first packet on that record.
+           The TCP stream and RPC xid state is cleared so it is rebuilt
+           from this record on.
+
+           offset:
+               File offset of the record, it must be the start of a record
+           frame:
+               Frame number of the record [default: 1]
+           index:
+               Packet index of the first packet on the record [default: 0]
+        """
+        self._getfh()
+
+        # Clear state
+        self._tcp_stream_map = {}
+        self._rpc_xid_map    = {}
+        self._tcp_pending    = None
+        self.ipfrag.clear()
+
+        self.seek(offset)
+        self.boffset = self.offset
+        self.frame   = frame
+        self.index   = index
+        self.eof     = False
+
+    def build_index(self):
+        """Build the packet index by processing all packets in the trace file
+           and save it in the index file. The trace file is rewound to the
+           first packet. Returns the number of packets in the index.
+        """
+        self.useindex = True
+        self._getfh()
+        if self.pktidx is None:
+            self.pktidx = PktIndex(self.tfile)
+        if not self.pktidx.complete:
+            self.rewind(0)
+            for pkt in self:
+                pass
+        self.rewind(0)
+        return len(self.pktidx)
+
+    def index_lookup(self, name, value):
+        """Return the sorted list of packet indices which may have the given
+           NFS filehandle, stateid, clientid or sessionid using the key
+           indexes of the packet index. Returns None if the packet index
+           is not available or not all packets have been indexed.
+
+           name:
+               Name of the key, one of "fh", "stateid", "clientid" or
+               "sessionid"
+           value:
+               Value of the key, packets having a different value with the
+               same CRC32 are also included in the list
+
+           Examples:
+               # Get the packets which may have the given filehandle
+               indices = x.index_lookup("fh", filehandle)
+        """
+        if not self._index_ok(0) or not self.pktidx.complete:
+            return None
+        return self.pktidx.lookup(name, value)
+
+    def _key_indices(self, keychecks):
+        """Return the sorted list of packet indices which may match all
+           the given key checks and set the record offsets of these packets
+           as the key filter. Returns None if the packet index is not
+           available or not all packets have been indexed.
+
+           keychecks:
+               List of (name, crc) checks on the key indexes
+        """
+        if not self._index_ok(0) or not self.pktidx.complete:
+            return None
+        key = tuple(keychecks)
+        item = self._key_map.get(key)
+        if item is None:
+            pktidx = self.pktidx
+            iset = None
+            for name, crc in keychecks:
+                items = pktidx.lookup(name, None, crc=crc)
+                iset = set(items) if iset is None else iset.intersection(items)
+            indices = sorted(iset)
+            item = (indices, frozenset(pktidx.offset(x) for x in indices))
+            if len(self._key_map) >= _MATCH_MAX:
+                self._key_map.clear()
+            self._key_map[key] = item
+        self._keyfilter = item[1]
+        return item[0]
+
+    def _key_jump(self, indices, maxindex):
+        """Jump to the next packet given by the sorted list of indices
+           using the packet index if there are too many packets to skip,
+           the last packet in the trace file is used if there are no more
+           packets in the list
+
+           indices:
+               Sorted list of packet indices which may match
+           maxindex:
+               Do not jump past this packet index
+        """
+        pos = bisect_left(indices, self.index)
+        if pos < len(indices):
+            index = indices[pos]
+        else:
+            index = len(self.pktidx) - 1
+        if maxindex:
+            index = min(index, maxindex)
+        if index - self.index > INDEX_LOOKBACK:
+            self.rewind(index)
+
     def seek(self, offset, whence=os.SEEK_SET, hard=False):
         """Position the read offset correctly
            If new position is outside the current read buffer then clear the
            buffer so a new chunk of data will be read from the file instead
         """
-        soffset = self.fh.tell() - len(self.rdbuffer)
-        if hard or offset < soffset or whence != os.SEEK_SET:
-            # Seek is before the read buffer, do the actual seek
+        if self.mmap is not None:
+            # Memory-mapped file, just move the file offset
+            if whence == os.SEEK_CUR:
+                offset += self.offset
+            elif whence == os.SEEK_END:
+                offset += self.filesize
+            self.offset = offset
+            return
+        eoffset = self.fh.tell()
+        soffset = eoffset - len(self.rdbuffer)
+        if hard or offset < soffset or offset > eoffset or whence != os.SEEK_SET:
+            # Seek is outside the read buffer, do the actual seek
             self.rdbuffer = ""
             self.rdoffset = 0
             self.fh.seek(offset, whence)
@@ -477,7 +1168,8 @@ class Pktt(BaseObj, Unpack):
 
             iszip = False
             self.header_fmt = None
-            while self.header_fmt is None:
+            self.pcapng = None
+            while self.header_fmt is None and self.pcapng is None:
                 # Initialize offset
                 self.offset = 0
 
@@ -495,26 +1187,54 @@ class Pktt(BaseObj, Unpack):
                     # Big endian
                     self.header_fmt = '>HHIIII'
                     self.header_rec = '>IIII'
+                elif self.ident == PCAPNG_IDENT:
+                    # Pcapng file, endianness is given by each section
+                    self.pcapng = PcapNG()
                 else:
                     if iszip:
                         raise Exception('Not a tcpdump file')
                     iszip = True
-                    # Get the size of the uncompressed file, this only works
-                    # for uncompressed files less than 4GB
-                    self.fh.seek(-4, os.SEEK_END)
-                    self.filesize = struct.unpack("<I", self.fh.read(4))[0]
-                    # Do a hard seek -- clear read ahead buffer
-                    self.seek(0, hard=True)
-                    # Try if this is a gzip compress file
-                    self.fh = gzip.GzipFile(fileobj=self.fh)
+                    if is_bgzf(self.fh):
+                        # Block-compressed gzip file, seeking to any offset
+                        # only needs to decompress a single block
+                        self.fh = BGZFile(self.fh, self.tfile + ".gzi")
+                        self.filesize = self.fh.size
+                        # Do a hard seek -- clear read ahead buffer
+                        self.seek(0, hard=True)
+                    else:
+                        # Get the size of the uncompressed file, this only
+                        # works for uncompressed files less than 4GB
+                        self.fh.seek(-4, os.SEEK_END)
+                        self.filesize = struct.unpack("<I", self.fh.read(4))[0]
+                        # Do a hard seek -- clear read ahead buffer
+                        self.seek(0, hard=True)
+                        # Try if this is a gzip compress file
+                        self.fh = gzip.GzipFile(fileobj=self.fh)
+
+            if self.usemmap and not iszip and not self.live:
+                # Map the whole trace file, from now on all records are
+                # read directly from the map so discard read ahead buffer
+                self.mmap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+                self.rdbuffer = ""
+                self.rdoffset = 0
 
             # Get header information
-            self.header = Header(self)
+            if self.pcapng is not None:
+                self.seek(0)
+                self.header = self.pcapng.read_header(self)
+            else:
+                self.header = Header(self)
+
+            if self.useindex and not self.live and self.pktidx is None:
+                # Load the packet index if it exists, otherwise it will be
+                # built on the first pass of the trace file
+                self.pktidx = PktIndex(self.tfile)
 
             # Initialize packet number
             self.index   = 0
             self.tstart  = None
             self.ioffset = self.offset
+            self.boffset = self.offset
 
         return self.fh
 
@@ -525,6 +1245,11 @@ class Pktt(BaseObj, Unpack):
         """
         # Open packet trace if needed
         self._getfh()
+        if self.mmap is not None:
+            # Memory-mapped file, get the bytes directly from the map
+            data = self.mmap[self.offset:self.offset+count]
+            self.offset += len(data)
+            return data
         while True:
             # Get the number of bytes specified
             rdsize = len(self.rdbuffer) - self.rdoffset
@@ -547,21 +1272,11 @@ class Pktt(BaseObj, Unpack):
             ldata = len(data)
             if self.live and ldata != count:
                 # Not all data was read (<EOF>)
-                tracefile = "%s%d" % (self.bfile, self.findex+1)
-                # Check if next trace file exists
-                if os.path.isfile(tracefile):
-                    # Save information that keeps track of the next trace file
-                    basefile = self.bfile
-                    findex = self.findex + 1
-                    # Re-initialize the object
-                    self.__del__()
-                    self.__init__(tracefile, live=self.live)
-                    # Overwrite next trace file info
-                    self.bfile = basefile
-                    self.findex = findex
                 # Re-position file pointer to last known offset
                 self.seek(self.offset)
-                time.sleep(1)
+                if not self._live_next():
+                    # Wait for more data to be written to the trace file
+                    self._live_wait()
             else:
                 break
 
@@ -650,55 +1365,377 @@ class Pktt(BaseObj, Unpack):
 
         return LHS + opr + RHS
 
-    def _match(self, layer, uargs):
-        """Default match function."""
-        if not hasattr(self.pkt, layer):
-            return False
+    def _compile_cmp(self, layer, uargs):
+        """Compile a single comparison of a match expression and return
+           a MatchCmp object. The comparison is converted into a function
+           so there is no need to process the comparison for every packet.
 
+           layer:
+               Packet layer of the comparison, e.g., "tcp", "nfs"
+           uargs:
+               Comparison without the layer prefix, e.g., "flags.ACK==1"
+        """
+        lhs, opr, rhs = self._split_match(uargs)
         if layer == "nfs":
+            # The NFS layer uses a flat name space, the comparison is done
+            # on the NFS object for top level attributes or NFSv3 and on
+            # each of the operations in the compound for NFSv4
+            expr = self._process_match("self.pkt.nfs.", lhs, opr, rhs)
+            iexpr = self._process_match("item.", lhs, opr, rhs)
+            ifunc = eval("lambda item: " + iexpr)
+        else:
+            expr = self._process_match("self.pkt.%s." % layer.lower(), lhs, opr, rhs)
+            ifunc = None
+        func = eval("lambda self: " + expr)
+        return MatchCmp(layer, uargs, func, ifunc, bool(_nfsopmap.get(lhs)))
+
+    def _match_cmp(self, cmp):
+        """Evaluate a compiled comparison on the current packet
+
+           cmp:
+               MatchCmp object given by _compile_cmp()
+        """
+        if cmp.layer == "nfs":
             # Use special matching function for NFS
-            texpr = self.match_nfs(uargs)
+            texpr = self._match_nfs_cmp(cmp)
         else:
             # Use general match
-            obj = "self.pkt.%s." % layer.lower()
-            lhs, opr, rhs = self._split_match(uargs)
-            expr = self._process_match(obj, lhs, opr, rhs)
-            texpr = eval(expr)
-        self.dprint('PKT2', "    %d: match_%s(%s) -> %r" % (self.pkt.record.index, layer, uargs, texpr))
+            texpr = cmp.func(self)
+        if self._match_debug:
+            self.dprint('PKT2', "    %d: match_%s(%s) -> %r" % (self.pkt.record.index, cmp.layer, cmp.uargs, texpr))
         return texpr
 
+    def _match(self, layer, uargs):
+        """Default match function."""
+        if not hasattr(self.pkt, layer):
+            return False
+        self._match_debug = self.debug_enabled('PKT2')
+        return self._match_cmp(self._compile_cmp(layer, uargs))
+
     def clear_xid_list(self):
         """Clear list of outstanding xids"""
         self._match_xid_list = []
 
+    @staticmethod
+    def rpc_key(pkt, rpc=None):
+        """Return the key identifying the RPC transaction of the given call
+           or reply packet. The key is the same for both the call and its
+           reply, it is given by the connection of the call and the xid:
+               ("<src>:<src_port>-<dst>:<dst_port>", xid)
+
+           Return None if the packet is not an RPC packet.
+
+           pkt:
+               Packet object
+           rpc:
+               RPC object to use instead of the RPC layer of the packet,
+               used while the packet is being decoded [default: None]
+        """
+        if rpc is None:
+            rpc = pkt.rpc
+        if not rpc:
+            return None
+        ip = pkt.ip
+        layer = pkt.tcp if pkt.tcp is not None else pkt.udp
+        if rpc.type == 0:
+            connid = "%s:%d-%s:%d" % (ip.src, layer.src_port, ip.dst, layer.dst_port)
+        else:
+            connid = "%s:%d-%s:%d" % (ip.dst, layer.dst_port, ip.src, layer.src_port)
+        return (connid, rpc.xid)
+
+    def release_call(self, key):
+        """Remove the RPC call given by its key from the RPC xid map so it
+           is not kept until its reply is decoded, the reply is then not
+           paired with the call and pkt_call is None. This is used to bound
+           the memory used by calls which are never replied. Return the
+           call packet, None if the call is not waiting for a reply.
+
+           key:
+               RPC key of the call, see rpc_key()
+        """
+        return self._rpc_xid_map.pop(key, None)
+
+    def _save_reply(self, pkt):
+        """Save the packet index of the given packet in the reply map
+           if it is an RPC reply, if it is an RPC call remove the reply
+           of any previous call using the same xid and connection
+        """
+        rpc = pkt.rpc
+        if rpc and rpc.type == 1:
+            rmap = self._rpc_reply_map
+            pkt_call = self.pkt_call
+            cindex = pkt_call.record.index if pkt_call is not None else None
+            rmap[self.rpc_key(pkt)] = (pkt.record.index, cindex)
+            if len(rmap) > REPLY_MAP_SIZE:
+                # Remove oldest reply
+                rmap.popitem(last=False)
+        elif rpc and self._rpc_reply_map:
+            self._rpc_reply_map.pop(self.rpc_key(pkt), None)
+
+    def get_reply_index(self, pkt_call):
+        """Return the packet index of the reply for the given RPC call
+           if the reply has already been decoded, otherwise return None.
+
+           pkt_call:
+               RPC call packet or its RPC key given by rpc_key()
+        """
+        if isinstance(pkt_call, tuple):
+            # The reply map has no replies older than the last call
+            # decoded with this key
+            item = self._rpc_reply_map.get(pkt_call)
+            return None if item is None else item[0]
+        item = self._rpc_reply_map.get(self.rpc_key(pkt_call))
+        if item is None:
+            return None
+        index, cindex = item
+        call_index = pkt_call.record.index
+        if index < call_index or (cindex is not None and cindex != call_index):
+            # This is the reply of another call using the same xid
+            return None
+        return index
+
+    def get_reply(self, pkt_call, expr=None, maxindex=None):
+        """Return the reply for the given RPC call, also the packet index
+           points to the next packet after the reply. The reply is taken
+           directly from the reply map if it has already been decoded,
+           otherwise the trace file is searched until the reply is found.
+           Returns None if the reply is not found or it does not match the
+           given expression, in which case the packet index points to the
+           packet at the beginning of the search.
+
+           pkt_call:
+               RPC call packet or its RPC key given by rpc_key()
+           expr:
+               Match expression the reply must match, the NFSop and NFSidx
+               of the reply are set as in match() [default: None]
+           maxindex:
+               The search fails if packet index hits this limit
+
+           Examples:
+               # Find the next WRITE request and its reply
+               pkt_call = x.match("NFS.argop == 38")
+               pkt_reply = x.get_reply(pkt_call, "NFS.status == 0 and NFS.resop == 38")
+        """
+        self.dprint('PKT1', ">>> %d: get_reply(%s)" % (self.index, expr))
+        save_index = self.index
+        index = self.get_reply_index(pkt_call)
+        while index is None:
+            # Search for the reply
+            if maxindex and self.index > maxindex:
+                break
+            try:
+                self.next()
+            except StopIteration:
+                break
+            index = self.get_reply_index(pkt_call)
+
+        pkt = None
+        if index is not None and not (maxindex and index >= maxindex):
+            if self.pkt is not None and self.pkt.record.index == index:
+                # Reply is the current packet, no need to decode it again
+                pkt = self.pkt
+            else:
+                pkt = self[index]
+            if expr is not None:
+                pmatch = self._compile_match(expr)
+                self._match_debug = self.debug_enabled('PKT2')
+                try:
+                    if not pmatch(self):
+                        pkt = None
+                except Exception:
+                    pkt = None
+
+        if pkt is None:
+            # Reply not found, re-position the file pointer back to where
+            # the search started
+            self.rewind(save_index)
+            self.pkt = None
+        self.dprint('PKT1', ">>> get_reply() -> %s" % (pkt is not None))
+        return pkt
+
+    @staticmethod
+    def _copy_pkt(pkt):
+        """Return a copy of the given packet, the RPC payload is decoded
+           first if the packet has been decoded in lazy mode
+        """
+        if pkt._lazy is not None:
+            getattr(pkt, "nfs")
+        return copy.copy(pkt)
+
+    def match_many(self, exprs, count=None, maxindex=None, rewind=True, reply_window=None, callback=None):
+        """Search for all the given match expressions in a single forward
+           pass of the trace file. Return a dictionary having a list of
+           matched packets for each expression name. Each packet is a copy
+           of the matched packet so the NFSop and NFSidx are the ones set
+           by its expression, as in match().
+
+           When the expression is given as a tuple (expr, reply_expr), each
+           matched RPC call is paired with its reply and the list has a
+           tuple (pkt_call, pkt_reply) for each match. The reply must match
+           reply_expr unless it is None, pkt_reply is None if the reply is
+           not found or it does not match.
+
+           exprs:
+               Dictionary of match expressions keyed by name
+           count:
+               Maximum number of matches for each expression, given as an
+               integer for all expressions or as a dictionary keyed by name
+               [default: None (all matches)]
+           maxindex:
+               The search stops if packet index hits this limit
+           rewind:
+               Rewind to index where the search started, otherwise the
+               packet index points to the next packet after the last
+               packet searched [default: True]
+           reply_window:
+               Maximum number of packets to search after a matched call
+               for its reply [default: None (no limit)]
+           callback:
+               Function called as callback(name, pkt) for each matched
+               packet instead of saving a copy of it, the packet is only
+               valid during the call. For a paired expression, it is
+               called for each matched call and again for its reply when
+               found. The returned dictionary has the number of matches
+               for each expression name instead [default: None]
+
+           Examples:
+               # Find all WRITE and COMMIT requests together with their
+               # replies and the first OPEN request
+               exprs = {
+                   "write":  ("NFS.argop == 38", "NFS.resop == 38"),
+                   "commit": ("NFS.argop == 5", "NFS.resop == 5"),
+                   "open":   "NFS.argop == 18",
+               }
+               res = x.match_many(exprs, count={"open": 1})
+               for pkt_call, pkt_reply in res["write"]:
+                   if pkt_reply:
+                       print pkt_reply.NFSop.count
+
+               # Count all WRITE replies without keeping any packet
+               def write_reply(name, pkt):
+                   if pkt.rpc.type == 1:
+                       print pkt.NFSop.count
+               x.match_many({"write": exprs["write"]}, callback=write_reply)
+        """
+        save_index = self.index
+        self._match_debug = self.debug_enabled('PKT2')
+        self.dprint('PKT1', ">>> %d: match_many(%s)" % (self.index, exprs.keys()))
+
+        # List of (name, call function, reply function, maximum count)
+        mlist = []
+        ret = {}
+        nmatch = {}
+        for name, expr in exprs.items():
+            pair = isinstance(expr, tuple)
+            if pair:
+                expr, rexpr = expr
+                rmatch = None if rexpr is None else self._compile_match(rexpr)
+            else:
+                rmatch = None
+            maxcount = count.get(name) if isinstance(count, dict) else count
+            mlist.append((name, self._compile_match(expr), pair, rmatch, maxcount))
+            ret[name] = []
+            nmatch[name] = 0
+
+        # Matched calls waiting for their replies keyed by RPC key,
+        # each entry is a list of (name, list index, reply function,
+        # call index)
+        pending = {}
+        # List of (call index, RPC key) in the order the calls are matched
+        pqueue = deque()
+        done = set()
+        while len(done) < len(mlist) or pending:
+            if maxindex and self.index > maxindex:
+                # Hit maxindex limit
+                break
+            try:
+                pkt = self.next()
+            except StopIteration:
+                break
+            while reply_window is not None and pqueue and \
+                  pkt.record.index - pqueue[0][0] > reply_window:
+                # Stop waiting for the reply of the oldest call,
+                # its pkt_reply is left as None
+                cindex, key = pqueue.popleft()
+                plist = [x for x in pending.get(key, []) if x[3] > cindex]
+                if plist:
+                    pending[key] = plist
+                else:
+                    pending.pop(key, None)
+            if pending and pkt.rpc and pkt.rpc.type == 1:
+                # Pair this reply with its matched calls
+                plist = pending.pop(self.rpc_key(pkt), None)
+                for name, index, rmatch, cindex in plist or []:
+                    try:
+                        if rmatch is not None and not rmatch(self):
+                            continue
+                    except Exception:
+                        continue
+                    if callback is not None:
+                        callback(name, pkt)
+                    else:
+                        rlist = ret[name]
+                        rlist[index] = (rlist[index][0], self._copy_pkt(pkt))
+            for name, pmatch, pair, rmatch, maxcount in mlist:
+                if name in done:
+                    continue
+                try:
+                    if not pmatch(self):
+                        continue
+                except Exception:
+                    continue
+                self.dprint('PKT1', ">>> %d: match_many(%s) -> True" % (pkt.record.index, name))
+                index = nmatch[name]
+                nmatch[name] += 1
+                if pair and pkt.rpc and pkt.rpc.type == 0:
+                    key = self.rpc_key(pkt)
+                    cindex = pkt.record.index
+                    pending.setdefault(key, []).append((name, index, rmatch, cindex))
+                    if reply_window is not None:
+                        pqueue.append((cindex, key))
+                if callback is not None:
+                    callback(name, pkt)
+                elif pair:
+                    ret[name].append((self._copy_pkt(pkt), None))
+                else:
+                    ret[name].append(self._copy_pkt(pkt))
+                if maxcount is not None and nmatch[name] >= maxcount:
+                    done.add(name)
+
+        if rewind:
+            # Re-position the file pointer back to where the search started
+            self.rewind(save_index)
+        self.pkt = None
+        if callback is not None:
+            return nmatch
+        return ret
+
     def _match_nfs(self, uargs):
         """Match NFS values on current packet."""
-        array = None
-        isarg = True
-        lhs, opr, rhs = self._split_match(uargs)
+        return self._match_nfs_cmp(self._compile_cmp("nfs", uargs))
 
-        if self.pkt.rpc.version == 3 or _nfsopmap.get(lhs):
+    def _match_nfs_cmp(self, cmp):
+        """Match NFS values on current packet using a compiled comparison."""
+        pkt = self.pkt
+        if pkt.rpc.version == 3 or cmp.top:
             try:
                 # Top level NFSv4 packet info or NFSv3 packet
-                expr = self._process_match("self.pkt.nfs.", lhs, opr, rhs)
-                if eval(expr):
+                if cmp.func(self):
                     # Set NFSop and NFSidx
-                    self.pkt.NFSop = self.pkt.nfs
-                    self.pkt.NFSidx = 0
+                    pkt.NFSop = pkt.nfs
+                    pkt.NFSidx = 0
                     return True
                 return False
             except Exception:
                 return False
 
         idx = 0
-        obj_prefix = "item."
-        for item in self.pkt.nfs.array:
+        ifunc = cmp.ifunc
+        for item in pkt.nfs.array:
             try:
-                # Get expression to eval
-                expr = self._process_match(obj_prefix, lhs, opr, rhs)
-                if eval(expr):
-                    self.pkt.NFSop = item
-                    self.pkt.NFSidx = idx
+                if ifunc(item):
+                    pkt.NFSop = item
+                    pkt.NFSidx = idx
                     return True
             except Exception:
                 # Continue searching
@@ -778,18 +1815,21 @@ class Pktt(BaseObj, Unpack):
         self.dprint('PKT2', "    %d: match_nfs(%s) -> %r" % (self.pkt.record.index, uargs, texpr))
         return texpr
 
-    def _convert_match(self, ast):
+    def _convert_match(self, ast, cmplist):
         """Convert a parser list match expression into their corresponding
-           function calls.
+           function calls. Each comparison is compiled and added to cmplist.
 
            Example:
                expr = "TCP.flags.ACK == 1 and NFS.argop == 50"
                st = parser.expr(expr)
                ast = parser.st2list(st)
-               data =  self._convert_match(ast)
+               cmplist = []
+               data =  self._convert_match(ast, cmplist)
 
                Returns:
-               data = "(self._match('tcp','flags.ACK==1'))and(self._match('nfs','argop==50'))"
+               data = "(self._match_cmp(_cmp[0]))and(self._match_cmp(_cmp[1]))"
+               cmplist = [MatchCmp(layer='tcp', uargs='flags.ACK==1', ...),
+                          MatchCmp(layer='nfs', uargs='argop==50', ...)]
         """
         ret = ''
         isin = False
@@ -799,10 +1839,10 @@ class Pktt(BaseObj, Unpack):
                 return _match_func_map[ast.lower()]
             return ast
         if len(ast) == 2:
-            return self._convert_match(ast[1])
+            return self._convert_match(ast[1], cmplist)
 
         for a in ast[1:]:
-            data = self._convert_match(a)
+            data = self._convert_match(a, cmplist)
             if data == 'in':
                 data = ' in '
                 isin = True
@@ -831,12 +1871,92 @@ class Pktt(BaseObj, Unpack):
                     uargs = data[4]
                 else:
                     uargs = data[0] + data[4]
-            # Escape all single quotes since the whole string will be quoted
-            uargs = re.sub(r"'", "\\'", uargs)
-            ret = "(%s('%s','%s'))" % (func, layer, uargs)
+            # Escape all single quotes and unquote the comparison string
+            # so escape sequences are processed
+            uargs = eval("'%s'" % re.sub(r"'", "\\'", uargs))
+            cmplist.append(self._compile_cmp(layer, uargs))
+            ret = "(self._match_cmp(_cmp[%d]))" % (len(cmplist)-1)
 
         return ret
 
+    def _compile_match(self, expr):
+        """Compile the match expression into a function which evaluates
+           the expression on the current packet. The compiled expression
+           is cached so it is compiled only once for each distinct
+           expression.
+
+           expr:
+               String of expressions to be evaluated
+        """
+        item = _match_expr_map.get(expr)
+        if item is None:
+            # Parse match expression
+            st = parser.expr(expr)
+            smap = parser.st2list(st)
+            cmplist = []
+            pdata = self._convert_match(smap, cmplist)
+            func = eval("lambda self: " + pdata, {'_cmp': cmplist})
+            item = (func, self._compile_filter(expr))
+            if len(_match_expr_map) >= _MATCH_MAX:
+                _match_expr_map.clear()
+            _match_expr_map[expr] = item
+        return item[0]
+
+    def _compile_filter(self, expr):
+        """Return the prefilter for the match expression or None if the
+           expression has no comparisons supported by the prefilter.
+           Only the comparisons on the top level conjunction of the
+           expression are added to the prefilter, e.g., for the expression
+           "IP.src == '192.168.0.20' and (TCP.dst_port == 2049 or ...)"
+           only the comparison on IP.src is used. Comparisons on the NFS
+           keys, e.g., "NFS.fh == '...'" or "crc32(NFS.fh) == 0x5d4cbd8e",
+           are added as key checks.
+
+           expr:
+               String of expressions to be evaluated
+        """
+        try:
+            tree = ast.parse(expr.strip(), mode="eval").body
+        except Exception:
+            return None
+        if isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And):
+            terms = tree.values
+        else:
+            terms = [tree]
+
+        pfilter = MatchFilter()
+        for term in terms:
+            # Only comparisons for equality between a packet layer
+            # attribute and a constant value are supported
+            if not isinstance(term, ast.Compare) or len(term.ops) != 1 or \
+               not isinstance(term.ops[0], ast.Eq):
+                continue
+            lhs = term.left
+            crc = False
+            if isinstance(lhs, ast.Call) and isinstance(lhs.func, ast.Name) and \
+               lhs.func.id == "crc32" and len(lhs.args) == 1 and not lhs.keywords:
+                # Comparison on the CRC32 of the attribute
+                lhs = lhs.args[0]
+                crc = True
+            if not isinstance(lhs, ast.Attribute) or not isinstance(lhs.value, ast.Name):
+                continue
+            try:
+                value = ast.literal_eval(term.comparators[0])
+                if isinstance(value, str):
+                    # Escape sequences are processed once more when
+                    # the comparison is compiled
+                    value = value.decode("string_escape")
+            except Exception:
+                continue
+            layer = lhs.value.id.lower()
+            if not crc:
+                pfilter.add(layer, lhs.attr, value)
+            elif layer == "nfs" and lhs.attr in IDX_KEYS and isinstance(value, (int, long)):
+                pfilter.add_key(lhs.attr, value)
+        if pfilter:
+            return pfilter
+        return None
+
     def match(self, expr, maxindex=None, rewind=True, reply=False):
         """Return the packet that matches the given expression, also the packet
            index points to the next packet after the matched packet.
@@ -852,6 +1972,25 @@ class Pktt(BaseObj, Unpack):
            reply:
                Match RPC replies of previously matched calls as well
 
+           Simple comparisons for equality on IP.src, IP.dst, IP.protocol
+           and the TCP/UDP ports which are part of the top level conjunction
+           of the expression are checked first on the raw record data.
+           Records failing these checks are not fully decoded, only the
+           layers up to the RPC header are decoded so the TCP stream and
+           RPC xid state is kept up to date. The number of records passing
+           and failing the prefilter are counted in the object attributes
+           prefilter_hits and prefilter_misses respectively. The prefilter
+           is not used when matching replies or multiple trace files.
+
+           Comparisons for equality on NFS.fh, NFS.stateid, NFS.clientid
+           and NFS.sessionid, or on crc32(NFS.fh), which are part of the
+           top level conjunction of the expression use the key indexes of
+           the packet index when all packets have been indexed. Only the
+           records having any of the packets given by the key indexes are
+           fully decoded and the packet index is used to jump directly to
+           the next of these packets if there are more than INDEX_LOOKBACK
+           packets in between.
+
            Examples:
                # Find the packet with both the ACK and SYN TCP flags set to 1
                pkt = x.match("TCP.flags.ACK == 1 and TCP.flags.SYN == 1")
@@ -893,33 +2032,52 @@ class Pktt(BaseObj, Unpack):
         # Save current position
         save_index = self.index
 
-        # Parse match expression
-        st = parser.expr(expr)
-        smap = parser.st2list(st)
-        pdata = self._convert_match(smap)
+        # Get compiled match expression
+        pmatch = self._compile_match(expr)
+        self._match_debug = self.debug_enabled('PKT2')
         self.dprint('PKT1', ">>> %d: match(%s)" % (self.index, expr))
         self.reply_matched = False
 
-        # Search one packet at a time
-        for pkt in self:
-            if maxindex and self.index > maxindex:
-                # Hit maxindex limit
-                break
-            try:
-                if reply and pkt == "rpc" and pkt.rpc.type == 1 and pkt.rpc.xid in self._match_xid_list:
-                    self.dprint('PKT1', ">>> %d: match() -> True: reply" % pkt.record.index)
-                    self._match_xid_list.remove(pkt.rpc.xid)
-                    self.reply_matched = True
-                    return pkt
-                if eval(pdata):
-                    # Return matched packet
-                    self.dprint('PKT1', ">>> %d: match() -> True" % pkt.record.index)
-                    if reply and pkt == "rpc" and pkt.rpc.type == 0:
-                        # Save xid of matched call
-                        self._match_xid_list.append(pkt.rpc.xid)
-                    return pkt
-            except Exception:
-                pass
+        indices = None
+        if not reply and len(self.pktt_list) < 2:
+            # Use the prefilter of the expression to skip the full decode
+            # of all records which cannot match the expression
+            self._prefilter = _match_expr_map[expr][1]
+            if self._prefilter and self._prefilter.keychecks:
+                indices = self._key_indices(self._prefilter.keychecks)
+
+        try:
+            if indices is not None:
+                self._key_jump(indices, maxindex)
+            # Search one packet at a time
+            for pkt in self:
+                if maxindex and self.index > maxindex:
+                    # Hit maxindex limit
+                    break
+                if self.prefiltered:
+                    if indices is not None:
+                        self._key_jump(indices, maxindex)
+                    continue
+                try:
+                    if reply and pkt == "rpc" and pkt.rpc.type == 1 and pkt.rpc.xid in self._match_xid_list:
+                        self.dprint('PKT1', ">>> %d: match() -> True: reply" % pkt.record.index)
+                        self._match_xid_list.remove(pkt.rpc.xid)
+                        self.reply_matched = True
+                        return pkt
+                    if pmatch(self):
+                        # Return matched packet
+                        self.dprint('PKT1', ">>> %d: match() -> True" % pkt.record.index)
+                        if reply and pkt == "rpc" and pkt.rpc.type == 0:
+                            # Save xid of matched call
+                            self._match_xid_list.append(pkt.rpc.xid)
+                        return pkt
+                except Exception:
+                    pass
+                if indices is not None:
+                    self._key_jump(indices, maxindex)
+        finally:
+            self._prefilter = None
+            self._keyfilter = None
 
         if rewind:
             # No packet matched, re-position the file pointer back to where
@@ -0,0 +1,471 @@
+#===============================================================================
+# Copyright 2012 NetApp, Inc. All Rights Reserved,
+# contribution by Jorge Mora <mora@netapp.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#===============================================================================
+"""
+Throughput timeline module
+
+Provides the object to aggregate the I/O of a trace file into fixed time
+intervals in a single pass: the number of bytes read and written, the
+number of RPC calls and the average number of outstanding RPC calls for
+each interval. Calls are paired with their replies by the call tracker,
+see packet.pktcall.
+
+The bytes read and written are given by the count of the READ and WRITE
+replies and they are added to the interval of the reply. For an NFSv4
+COMPOUND the I/O is given by the main operation of the compound, see
+NFSbase.main_op(). The number of outstanding calls is the time each call
+has been waiting for its reply in the interval divided by the interval.
+
+The timeline is kept for all the traffic, for each client and for each
+server. The data servers are the servers having the EXCHGID4_FLAG_USE_PNFS_DS
+flag set on any EXCHANGE_ID reply or the addresses given to the object.
+
+Intervals are aligned to multiples of the interval length in absolute time
+so timelines from different trace files using the same interval length
+can be merged.
+
+Usage:
+    # Display the timeline using one second intervals
+    python -m packet.pkttime /traces/tracefile.cap
+
+    # Display the timeline of each client using 100ms intervals
+    python -m packet.pkttime --interval 0.1 --clients /traces/tracefile.cap
+"""
+import time
+import array
+from optparse import OptionParser
+
+import packet.nfs.nfs4_const as nfs4_const
+from packet.nfs.nfsbase import NFSbase
+from utilites.baseobj import BaseObj
+from packet.pktcall import CallTracker, PENDING_TIMEOUT, PENDING_MAX
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Module constants
+__author__    = "Jorge Mora"
+__copyright__ = "Copyright (C) 2012 NetApp, Inc."
+__license__   = "GPL v2"
+__version__   = "1.0"
+
+# Default interval length in seconds
+INTERVAL = 1.0
+
+# Names of the arrays of each series
+SERIES_NAMES = ("reads", "writes", "ops", "inflight")
+
+# Type of I/O of NFSv3 procedures keyed by the procedure
+_NFS3_IO = {6: "reads", 7: "writes"}
+# Type of I/O of NFSv4 operations keyed by the operation
+_NFS4_IO = {nfs4_const.OP_READ: "reads", nfs4_const.OP_WRITE: "writes"}
+
+class Series(BaseObj):
+    """Timeline series object, each array has an item for each interval
+       starting at the first interval of the timeline, the arrays are
+       extended as needed so they could be shorter than the timeline
+
+       Usage:
+           from packet.pkttime import Series
+
+           x = Series()
+
+           # Add 4096 bytes read to the third interval
+           x.add("reads", 2, 4096)
+
+       Object definition:
+
+       Series(
+           reads    = array, # Bytes read in each interval
+           writes   = array, # Bytes written in each interval
+           ops      = array, # Number of RPC calls in each interval
+           inflight = array, # Microseconds of outstanding RPC calls
+                             # in each interval
+       )
+    """
+    # Class attributes
+    _attrlist = SERIES_NAMES
+
+    def __init__(self):
+        """Constructor
+
+           Initialize object's private data.
+        """
+        for name in SERIES_NAMES:
+            setattr(self, name, array.array("d"))
+
+    def add(self, name, slot, value):
+        """Add value to the interval given by slot
+
+           name:
+               Name of the array, e.g., "reads"
+           slot:
+               Interval index
+           value:
+               Value to add
+        """
+        items = getattr(self, name)
+        if slot >= len(items):
+            items.extend([0.0] * (slot + 1 - len(items)))
+        items[slot] += value
+
+    def shift(self, count):
+        """Insert the given number of empty intervals at the start"""
+        for name in SERIES_NAMES:
+            items = array.array("d", [0.0] * count)
+            items.extend(getattr(self, name))
+            setattr(self, name, items)
+
+    def merge(self, series, offset=0):
+        """Add all values of the given series
+
+           series:
+               Series object
+           offset:
+               Interval index of the first interval of the given series
+               [default: 0]
+        """
+        for name in SERIES_NAMES:
+            src = getattr(series, name)
+            if not src:
+                continue
+            items = getattr(self, name)
+            size = offset + len(src)
+            if size > len(items):
+                items.extend([0.0] * (size - len(items)))
+            for slot, value in enumerate(src, offset):
+                items[slot] += value
+
+class Timeline(CallTracker):
+    """Throughput timeline object
+
+       Usage:
+           from packet.pkttime import Timeline
+
+           x = Timeline(interval=0.5)
+
+           # Process all packets in the trace file
+           x.run("/traces/tracefile.cap")
+
+           # Or process the packets given by a packet trace object
+           pktt = Pktt("/traces/tracefile.cap", lazy=True)
+           for pkt in pktt:
+               x.add(pkt, pktt)
+
+           # Bytes written per second for each interval
+           values = x.series("writes")
+
+           # Operations per second for each interval of a client
+           values = x.series("ops", "clients", "192.168.0.20")
+
+           # Check write throughput is at least 10MB/s on all intervals
+           # but the first and last
+           assert min(x.series("writes")[1:-1]) >= 10*1024*1024
+
+           # Add the timeline of another trace file
+           y = Timeline(interval=0.5).run("/traces/tracefile2.cap")
+           x.merge(y)
+
+           # Display the timeline
+           print x.report()
+
+       Object definition:
+
+       Timeline(
+           interval  = float,  # Interval length in seconds
+           start     = float,  # Timestamp of the first interval
+           slots     = int,    # Number of intervals
+           calls     = int,    # Number of calls
+           replies   = int,    # Number of replies matched to a call
+           unmatched = int,    # Number of replies without a call
+           expired   = int,    # Number of calls dropped without a reply
+           pending   = int,    # Number of calls waiting for a reply
+           total     = Series, # Timeline of all calls
+           clients   = dict,   # Series for each client address
+           servers   = dict,   # Series for each server address
+           ds        = dict,   # Series for each data server address
+       )
+    """
+    # Class attributes
+    _attrlist = ("interval", "start", "slots", "calls", "replies",
+                 "unmatched", "expired", "pending", "total", "clients",
+                 "servers", "ds")
+
+    def __init__(self, interval=INTERVAL, dslist=None, timeout=PENDING_TIMEOUT, max_pending=PENDING_MAX):
+        """Constructor
+
+           Initialize object's private data.
+
+           interval:
+               Interval length in seconds [default: INTERVAL]
+           dslist:
+               List of data server addresses, data servers are also
+               identified by their EXCHANGE_ID replies [default: None]
+           timeout:
+               Seconds of trace time to wait for the reply of a call
+               [default: PENDING_TIMEOUT]
+           max_pending:
+               Maximum number of calls waiting for a reply
+               [default: PENDING_MAX]
+        """
+        self._step = int(round(interval * 1000000))
+        if self._step <= 0:
+            raise ValueError("Interval must be at least one microsecond")
+        CallTracker.__init__(self, timeout, max_pending)
+        self.interval = self._step / 1000000.0
+        self.slots    = 0
+        self.total    = Series()
+        self.clients  = {}
+        self.servers  = {}
+
+        # Absolute interval number of the first interval
+        self._base = None
+        # Set of data server addresses
+        self._dsaddrs = set(dslist or [])
+
+    @property
+    def start(self):
+        """Timestamp of the first interval"""
+        if self._base is None:
+            return None
+        return self._base * self._step / 1000000.0
+
+    @property
+    def ds(self):
+        """Series for each data server address"""
+        return dict((x, y) for x, y in self.servers.items() if x in self._dsaddrs)
+
+    def _all_series(self):
+        """Return the list of all Series objects"""
+        return [self.total] + self.clients.values() + self.servers.values()
+
+    def _slot(self, usecs):
+        """Return the interval index of the given timestamp in microseconds,
+           intervals are inserted at the start if the timestamp is before
+           the first interval
+        """
+        number = usecs // self._step
+        if self._base is None:
+            self._base = number
+        slot = number - self._base
+        if slot < 0:
+            for series in self._all_series():
+                series.shift(-slot)
+            self.slots -= slot
+            self._base = number
+            slot = 0
+        if slot >= self.slots:
+            self.slots = slot + 1
+        return slot
+
+    def _get_series(self, gmap, addr):
+        """Return the Series object for the given address"""
+        series = gmap.get(addr)
+        if series is None:
+            series = Series()
+            gmap[addr] = series
+        return series
+
+    def _call_kind(self, pkt, rpc):
+        """Return the type of I/O of the RPC call: "reads", "writes",
+           "exchange_id" for an NFSv4 EXCHANGE_ID or None
+        """
+        if rpc.program != 100003:
+            return None
+        if rpc.version == 3:
+            return _NFS3_IO.get(rpc.procedure)
+        if rpc.version == 4 and rpc.procedure == 1:
+            nfs = pkt.nfs
+            if not isinstance(nfs, NFSbase):
+                return None
+            item = nfs.main_op()
+            if item is None:
+                return None
+            if item.op == nfs4_const.OP_EXCHANGE_ID:
+                return "exchange_id"
+            return _NFS4_IO.get(item.op)
+        return None
+
+    def _add_inflight(self, serlist, start, end):
+        """Add the time the call has been outstanding to each interval
+
+           serlist:
+               List of Series objects of the call
+           start:
+               Timestamp of the call in microseconds
+           end:
+               Timestamp of the reply in microseconds
+        """
+        step = self._step
+        slot = self._slot(start)
+        self._slot(end)
+        while start < end:
+            span = min(end, (start // step + 1) * step) - start
+            for series in serlist:
+                series.add("inflight", slot, span)
+            start += span
+            slot += 1
+
+    def _call(self, pkt, rpc, usecs):
+        """Add the call to its interval, return the type of I/O and the
+           list of Series objects of the call
+        """
+        ip = pkt.ip
+        serlist = [
+            self.total,
+            self._get_series(self.clients, str(ip.src)),
+            self._get_series(self.servers, str(ip.dst)),
+        ]
+        slot = self._slot(usecs)
+        for series in serlist:
+            series.add("ops", slot, 1)
+        return (self._call_kind(pkt, rpc), serlist)
+
+    def _reply(self, pkt, rpc, usecs, ctime, data):
+        """Add the I/O of the reply and the time the call has been
+           outstanding to the series of the call
+        """
+        kind, serlist = data
+        if kind is not None:
+            nfs = pkt.nfs
+            if isinstance(nfs, NFSbase):
+                nfs = nfs.main_op()
+            if nfs is not None and getattr(nfs, "status", None) == 0:
+                if kind == "exchange_id":
+                    flags = getattr(nfs, "flags", None) or 0
+                    if flags & nfs4_const.EXCHGID4_FLAG_USE_PNFS_DS:
+                        self._dsaddrs.add(str(pkt.ip.src))
+                else:
+                    count = getattr(nfs, "count", None)
+                    if isinstance(count, (int, long)):
+                        slot = self._slot(usecs)
+                        for series in serlist:
+                            series.add(kind, slot, count)
+        self._add_inflight(serlist, ctime, max(ctime, usecs))
+
+    def merge(self, timeline):
+        """Add all values of the given timeline, both timelines must have
+           the same interval length
+
+           timeline:
+               Timeline object
+        """
+        if timeline._step != self._step:
+            raise ValueError("Unable to merge timelines with different intervals")
+        if timeline._base is None:
+            return
+        # Make sure all intervals of the given timeline are included
+        self._slot(timeline._base * self._step)
+        self._slot((timeline._base + timeline.slots - 1) * self._step)
+        offset = timeline._base - self._base
+        self.total.merge(timeline.total, offset)
+        for name in ("clients", "servers"):
+            gmap = getattr(self, name)
+            for addr, series in getattr(timeline, name).items():
+                self._get_series(gmap, addr).merge(series, offset)
+        self._dsaddrs.update(timeline._dsaddrs)
+        self.calls     += timeline.calls
+        self.replies   += timeline.replies
+        self.unmatched += timeline.unmatched
+        self.retrans   += timeline.retrans
+        self.expired   += timeline.expired
+
+    def series(self, name, group="total", addr=None):
+        """Return the values of the given series for every interval: bytes
+           per second for "reads" and "writes", calls per second for "ops"
+           and average number of outstanding calls for "inflight". The
+           values are given as a NumPy array if NumPy is available,
+           otherwise as a list.
+
+           name:
+               Name of the series: "reads", "writes", "ops" or "inflight"
+           group:
+               Name of the group: "total", "clients", "servers" or "ds"
+               [default: "total"]
+           addr:
+               Address of the client or server, this is required if
+               group is not "total"
+        """
+        if group == "total":
+            series = self.total
+        else:
+            series = getattr(self, group).get(addr)
+        if series is None:
+            raise KeyError("Address not found in %s: %s" % (group, addr))
+        items = getattr(series, name)
+        if name == "inflight":
+            scale = 1.0 / self._step
+        else:
+            scale = 1.0 / self.interval
+        if numpy is not None:
+            values = numpy.zeros(self.slots)
+            if items:
+                values[:len(items)] = numpy.frombuffer(items, dtype=numpy.float64) * scale
+            return values
+        return [x * scale for x in items] + [0.0] * (self.slots - len(items))
+
+    def report(self, group="total", addr=None):
+        """Return the timeline as a table with a row for each interval
+
+           group:
+               Name of the group: "total", "clients", "servers" or "ds"
+               [default: "total"]
+           addr:
+               Address of the client or server, this is required if
+               group is not "total"
+        """
+        columns = [self.series(x, group, addr) for x in SERIES_NAMES]
+        fmt = "%12s %12s %12s %10s %12s"
+        out = [fmt % ("TIME", "READ MB/s", "WRITE MB/s", "OPS/s", "OUTSTANDING")]
+        for slot in xrange(self.slots):
+            reads, writes, ops, inflight = [x[slot] for x in columns]
+            out.append(fmt % ("%.3f" % (slot * self.interval), "%.3f" % (reads / 1048576.0),
+                              "%.3f" % (writes / 1048576.0), "%.1f" % ops, "%.2f" % inflight))
+        return "\n".join(out)
+
+if __name__ == '__main__':
+    usage = "%prog [options] <tracefile> [<tracefile> ...]"
+    parser = OptionParser(usage=usage, version="%prog " + __version__)
+    parser.add_option("-i", "--interval", type="float", default=INTERVAL,
+                      help="Interval length in seconds [default: %default]")
+    parser.add_option("-c", "--clients", action="store_true", default=False,
+                      help="Display the timeline of each client")
+    parser.add_option("-s", "--servers", action="store_true", default=False,
+                      help="Display the timeline of each server")
+    parser.add_option("-d", "--ds", action="append", default=[],
+                      help="Address of data server, this option can be given multiple times")
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error("No trace file given")
+
+    # Process each trace file on its own and merge all timelines
+    timeline = Timeline(opts.interval, opts.ds)
+    for tfile in args:
+        timeline.merge(Timeline(opts.interval, opts.ds).run(tfile))
+    if timeline.start is None:
+        print "No RPC packets found"
+        exit(0)
+    start = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timeline.start))
+    print "Timeline starting at %s, %d calls, %d replies, %d unmatched, %d expired" % \
+          (start, timeline.calls, timeline.replies, timeline.unmatched, timeline.expired)
+    print timeline.report()
+    for group in ("clients", "servers", "ds"):
+        if group == "ds" and not timeline.ds:
+            continue
+        if group == "ds" or getattr(opts, group):
+            for addr in sorted(getattr(timeline, group)):
+                print
+                print "%s %s" % (group.upper(), addr)
+                print timeline.report(group, addr)
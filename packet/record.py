@@ -17,9 +17,9 @@ Record module
 Provides the object for a record and the string representation of the record
 in a tcpdump trace file.
 """
-import struct
 import time
 
+from packet.unpack import get_struct
 from utilites.baseobj import BaseObj
 
 # Module constants
@@ -65,10 +65,16 @@ class Record(BaseObj):
                Packet trace object (packet.pktt.Pktt) so this layer has
                access to the parent layers.
            data:
-               Raw packet data for this layer.
+               Raw packet data for this layer or the record header
+               already decoded as a tuple (seconds, usecs, length_inc,
+               length_orig).
         """
         # Decode record header
-        ulist = struct.unpack(pktt.header_rec, data)
+        if isinstance(data, tuple):
+            # Record header has already been decoded, e.g., pcapng file
+            ulist = data
+        else:
+            ulist = get_struct(pktt.header_rec).unpack(data)
         self.frame       = pktt.frame
         self.index       = pktt.index
         self.seconds     = ulist[0]
@@ -15,15 +15,40 @@
 TCP module
 
 Decode TCP layer.
+
+RPC records are reassembled on a per-stream buffer using the relative
+sequence numbers so re-transmitted and out-of-order segments are handled
+and multiple RPC records on a single segment are decoded without reading
+the record from the trace file again.
 """
 from packet.application.rpc import RPC
+from packet.unpack import Unpack, get_struct
 from utilites.baseobj import BaseObj
 
 # Module constants
 __author__    = "Jorge Mora" 
 __copyright__ = "Copyright (C) 2012 NetApp, Inc."
 __license__   = "GPL v2"
-__version__   = "1.2"
+__version__   = "1.3"
+
+# Maximum number of bytes held on the reassembly buffer of a TCP stream
+# waiting for an RPC record to be complete
+STREAM_MAX_SIZE = 16*1024*1024
+# Maximum number of out-of-order segments held on a TCP stream waiting
+# for the missing data, if more segments are received the missing data
+# is considered lost in the capture
+STREAM_MAX_OOO = 16
+# Maximum number of ranges of missing data remembered on a TCP stream,
+# a segment received late filling one of these ranges is decoded on its own
+STREAM_MAX_HOLES = 16
+# Data already decoded is removed from the reassembly buffer when its
+# size is larger than this value
+STREAM_COMPACT_SIZE = 65536
+
+# Precompiled struct for the TCP header
+_TCP_st = get_struct("!HHIIHHHH")
+# Precompiled struct for the RPC fragment header
+_FRAG_st = get_struct("!I")
 
 _TCP_map = {
     0x001:'FIN',
@@ -37,6 +62,101 @@ _TCP_map = {
     0x100:'NS',
 }
 
+def _new_stream(seq_base):
+    """Return a new TCP stream state
+
+       buffer:
+           Reassembly buffer holding the data of RPC records not yet decoded
+       boffset:
+           Offset of the next RPC record in the reassembly buffer
+       trunc:
+           Data in the reassembly buffer has been truncated in the capture
+       seq_next:
+           Relative sequence number of the next byte expected
+       ooo:
+           Out-of-order segments keyed by relative sequence number
+       ooo_size:
+           Number of bytes held by the out-of-order segments
+       holes:
+           List of ranges of relative sequence numbers skipped when the
+           stream was re-synced
+       seq_wrap:
+           Offset added to relative sequence numbers, it is increased by
+           2**32 every time the sequence number wraps around
+       seq_base:
+           Absolute sequence number of the first packet of the stream,
+           or of the latest SYN, relative sequence numbers start here
+    """
+    return {
+        'buffer':   bytearray(),
+        'boffset':  0,
+        'trunc':    False,
+        'seq_next': None,
+        'ooo':      {},
+        'ooo_size': 0,
+        'holes':    [],
+        'seq_wrap': 0,
+        'seq_base': seq_base,
+    }
+
+def _reset_stream(stream):
+    """Discard all data in the reassembly buffer of the TCP stream"""
+    del stream['buffer'][:]
+    stream['boffset'] = 0
+    stream['trunc']   = False
+
+def _add_hole(stream, start, end):
+    """Add the range of missing data given by the relative sequence
+       numbers to the TCP stream
+    """
+    holes = stream['holes']
+    holes.append((start, end))
+    if len(holes) > STREAM_MAX_HOLES:
+        # Forget about the oldest missing data
+        holes.pop(0)
+
+def _fill_hole(stream, seq, size):
+    """Remove the segment given by the relative sequence number and size
+       from the missing data of the TCP stream. Return True if the whole
+       segment was missing.
+    """
+    holes = stream['holes']
+    end = seq + size
+    for index in range(len(holes)):
+        hstart, hend = holes[index]
+        if hstart <= seq and end <= hend:
+            # Split missing data range
+            items = []
+            if hstart < seq:
+                items.append((hstart, seq))
+            if end < hend:
+                items.append((end, hend))
+            holes[index:index+1] = items
+            return True
+    return False
+
+def _record_size(data, offset):
+    """Return the size of the RPC record starting at the given offset
+       including all its fragment headers, None if the RPC record is not
+       complete or -1 if the fragment headers are not valid
+    """
+    dsize = len(data)
+    rsize = 0
+    while True:
+        if offset + 4 > dsize:
+            return None
+        psize = _FRAG_st.unpack_from(data, offset)[0]
+        size = psize & 0x7FFFFFFF
+        if size == 0 or size > STREAM_MAX_SIZE:
+            return -1
+        rsize  += 4 + size
+        offset += 4 + size
+        if offset > dsize:
+            return None
+        if psize >> 31:
+            # Last fragment
+            return rsize
+
 class Flags(BaseObj):
     """Flags object"""
     # Class attributes
@@ -100,6 +220,7 @@ class TCP(BaseObj):
     _attrlist = ("src_port", "dst_port", "seq_number", "ack_number", "hl",
                  "header_size", "flags_raw", "flags", "window_size",
                  "checksum", "urgent_ptr", "options", "data")
+    _slotlist = ("seq", "length")
 
     def __init__(self, pktt):
         """Constructor
@@ -112,7 +233,7 @@ class TCP(BaseObj):
         """
         # Decode the TCP layer header
         unpack = pktt.unpack
-        ulist = unpack.unpack(20, "!HHIIHHHH")
+        ulist = unpack.unpack_struct(_TCP_st)
         self.src_port    = ulist[0]
         self.dst_port    = ulist[1]
         self.seq_number  = ulist[2]
@@ -132,24 +253,19 @@ class TCP(BaseObj):
         streamid = "%s:%d-%s:%d" % (ip.src, self.src_port, ip.dst, self.dst_port)
 
         if streamid not in pktt._tcp_stream_map:
-            # msfrag: Keep track of RPC packets spanning multiple TCP packets
-            # frag_off: Keep track of multiple RPC packets within
-            #           a single TCP packet
-            pktt._tcp_stream_map[streamid] = {
-                'msfrag':   '',
-                'frag_off': 0,
-                'last_seq': 0,
-                'seq_wrap': 0,
-                'seq_base': self.seq_number,
-            }
+            pktt._tcp_stream_map[streamid] = _new_stream(self.seq_number)
 
         # De-reference stream map
         stream = pktt._tcp_stream_map[streamid]
 
         if self.flags.SYN:
-            # Reset seq_base on SYN
+            # Reset seq_base on SYN, this is a new connection
             stream['seq_base'] = self.seq_number
-            stream['last_seq'] = stream['seq_wrap']
+            stream['seq_next'] = None
+            stream['ooo'].clear()
+            stream['ooo_size'] = 0
+            del stream['holes'][:]
+            _reset_stream(stream)
 
         # Convert sequence numbers to relative numbers
         seq = self.seq_number - stream['seq_base'] + stream['seq_wrap']
@@ -166,15 +282,8 @@ class TCP(BaseObj):
         # Save length of TCP segment
         self.length = unpack.size()
 
-        if seq < stream['last_seq']:
-            # This is a re-transmission, do not process
-            return
-
         self._decode_payload(pktt, stream)
 
-        if self.length > 0:
-            stream['last_seq'] = seq
-
     def __str__(self):
         """String representation of object
 
@@ -204,89 +313,190 @@ class TCP(BaseObj):
         return out
 
     def _decode_payload(self, pktt, stream):
-        """Decode TCP payload."""
-        rpc = None
+        """Decode TCP payload.
+
+           The payload is added to the reassembly buffer of the stream
+           using the relative sequence number, re-transmitted data is
+           discarded and out-of-order segments are held until the missing
+           data is received. The first complete RPC record in the buffer
+           is decoded on this packet.
+        """
         pkt = pktt.pkt
-        unpack = pktt.unpack
-        if stream['frag_off'] > 0 and len(stream['msfrag']) == 0:
-            # This RPC packet lies within previous TCP packet,
-            # Re-position the offset of the data
-            unpack.seek(unpack.tell() + stream['frag_off'])
-
-        # Get the total size
-        sid = unpack.save_state()
-        size = unpack.size()
-
-        # Try decoding the RPC header before using the msfrag data
-        # to re-sync the stream
-        if len(stream['msfrag']) > 0:
-            rpc = RPC(pktt, proto=6)
-            if not rpc:
-                unpack.restore_state(sid)
-                sid = unpack.save_state()
-
-        if rpc or (size == 0 and len(stream['msfrag']) > 0 and self.flags_raw != 0x10):
-            # There has been some data lost in the capture,
-            # to continue decoding next packets, reset stream
-            # except if this packet is just a TCP ACK (flags = 0x10)
-            stream['msfrag'] = ''
-            stream['frag_off'] = 0
+        size = self.length
+        if size == 0:
+            if stream['buffer'] and self.flags_raw != 0x10:
+                # There has been some data lost in the capture,
+                # to continue decoding next packets, reset stream
+                # except if this packet is just a TCP ACK (flags = 0x10)
+                _reset_stream(stream)
+            return
 
-        if not rpc:
-            if len(stream['msfrag']):
-                # Concatenate previous fragment
-                unpack.insert(stream['msfrag'])
-            ldata = unpack.size() - 4
+        # Number of bytes of the segment not included in the trace
+        truncbytes = pkt.record.length_orig - pkt.record.length_inc
+
+        seq = self.seq
+        if stream['seq_next'] is None:
+            # First segment with data on this stream
+            stream['seq_next'] = seq
+        seq_next = stream['seq_next']
+
+        if seq + size + truncbytes <= seq_next:
+            if not _fill_hole(stream, seq, size + truncbytes):
+                # This is a re-transmission, do not process
+                return
+            # Out-of-order segment received after the stream has been
+            # re-synced, decode it on its own
+            hstream = _new_stream(0)
+            hstream['seq_next'] = seq
+            self._add_data(pktt, hstream, pktt.unpack.getbytes(), truncbytes)
+            self._decode_rpc(pktt, hstream)
+            return
+
+        data = pktt.unpack.getbytes()
+        if seq < seq_next:
+            # Partial re-transmission, discard data already received
+            data = data[seq_next - seq:]
+            seq = seq_next
+
+        ooo = stream['ooo']
+        if seq > seq_next and self._rpc_start(pktt, data):
+            # Data is missing and this segment starts with an RPC record,
+            # the missing data has most likely been lost in the capture so
+            # re-sync the stream on this segment, the missing data is
+            # decoded on its own if it is received later
+            _reset_stream(stream)
+            _add_hole(stream, seq_next, seq)
+            for oseq in [item for item in ooo if item < seq]:
+                stream['ooo_size'] -= len(ooo.pop(oseq)[0])
+            stream['seq_next'] = seq
+            self._add_data(pktt, stream, data, truncbytes)
+        elif seq > seq_next:
+            # Out-of-order segment, hold it until the missing data is
+            # received unless there are too many segments already held
+            ooo[seq] = (data, truncbytes)
+            stream['ooo_size'] += len(data)
+            if truncbytes == 0 and len(ooo) <= STREAM_MAX_OOO and \
+               stream['ooo_size'] <= STREAM_MAX_SIZE:
+                return
+            # The missing data has been lost in the capture,
+            # re-sync the stream on the first out-of-order segment
+            _reset_stream(stream)
+            seq = min(ooo)
+            _add_hole(stream, stream['seq_next'], seq)
+            stream['seq_next'] = seq
+        else:
+            self._add_data(pktt, stream, data, truncbytes)
+
+        while ooo:
+            # Add all out-of-order segments which are now in sequence
+            seq = min(ooo)
+            seq_next = stream['seq_next']
+            if seq > seq_next:
+                break
+            data, trunc = ooo.pop(seq)
+            stream['ooo_size'] -= len(data)
+            if seq + len(data) + trunc <= seq_next:
+                continue
+            self._add_data(pktt, stream, data[seq_next - seq:], trunc)
+
+        self._decode_rpc(pktt, stream)
+
+    def _add_data(self, pktt, stream, data, truncbytes):
+        """Add in-sequence data to the reassembly buffer of the stream"""
+        stream['seq_next'] += len(data) + truncbytes
+        buffer = stream['buffer']
+        if not buffer:
+            # Data must start with an RPC record, if the RPC record is
+            # complete the RPC header is validated when it is decoded
+            if _record_size(data, 0) is None and not self._rpc_start(pktt, data):
+                # Not the start of an RPC record, discard data
+                return
+        elif stream['trunc']:
+            # Data is missing from the buffer, re-sync the stream
+            _reset_stream(stream)
+            self._add_data(pktt, stream, data, 0)
+            return
+        buffer.extend(data)
+        if truncbytes:
+            stream['trunc'] = True
+        elif len(buffer) - stream['boffset'] > STREAM_MAX_SIZE and \
+             _record_size(buffer, stream['boffset']) is None:
+            # Buffer has reached its limit without having a complete
+            # RPC record, discard all data and re-sync the stream
+            self.dprint('PKT1', "TCP stream buffer limit reached, %d bytes discarded" % len(buffer))
+            _reset_stream(stream)
+
+    def _rpc_start(self, pktt, data):
+        """Return True if data starts with a valid RPC header"""
+        save_unpack = pktt.unpack
+        pktt.unpack = Unpack(data)
+        try:
+            rpc = RPC(pktt, proto=6, state=False)
+        except Exception:
+            rpc = None
+        pktt.unpack = save_unpack
+        return bool(rpc)
+
+    def _decode_rpc(self, pktt, stream):
+        """Decode next RPC record in the reassembly buffer of the stream.
+           If there are more complete RPC records in the buffer, the next
+           packet returned by the packet trace object is created from the
+           same segment without reading the trace file again.
+        """
+        pkt = pktt.pkt
+        buffer = stream['buffer']
+        offset = stream['boffset']
+        rsize = _record_size(buffer, offset)
+        if rsize is None:
+            if not stream['trunc']:
+                # An RPC fragment is missing to decode RPC payload
+                return
+            # Segment has been truncated, decode as much as possible
+            rsize = len(buffer) - offset
+        if rsize < 0:
+            # Invalid RPC record, discard all data
+            _reset_stream(stream)
+            return
 
-            # Get RPC header
-            rpc = RPC(pktt, proto=6)
+        # Use a copy of the RPC record to decode the RPC layer
+        pktt.unpack = Unpack(memoryview(buffer)[offset:offset+rsize].tobytes())
+        offset += rsize
+        if offset >= len(buffer) or stream['trunc']:
+            _reset_stream(stream)
+        elif offset > STREAM_COMPACT_SIZE:
+            # Remove all the data already decoded from the buffer
+            del buffer[:offset]
+            stream['boffset'] = 0
         else:
-            ldata = size - 4
+            stream['boffset'] = offset
 
+        # Get RPC header
+        rpc = RPC(pktt, proto=6)
         if not rpc:
+            # Not an RPC record, discard all data
+            _reset_stream(stream)
             return
 
-        rpcsize = rpc.fragment_hdr.size
+        # Save RPC layer on packet object
+        pkt.rpc = rpc
+        if rpc.type:
+            # Remove packet call from the xid map since reply has
+            # already been decoded
+            pktt._rpc_xid_map.pop(pktt.rpc_key(pktt.pkt, rpc), None)
 
-        truncbytes = pkt.record.length_orig - pkt.record.length_inc
-        if truncbytes == 0 and ldata < rpcsize:
-            # An RPC fragment is missing to decode RPC payload
-            unpack.restore_state(sid)
-            stream['msfrag'] += unpack.getbytes()
+        # Decode NFS layer
+        if pktt.lazy:
+            rpc.defer_payload()
         else:
-            if len(stream['msfrag']) > 0 or ldata == rpcsize:
-                stream['frag_off'] = 0
-            stream['msfrag'] = ''
-            # Save RPC layer on packet object
-            pkt.rpc = rpc
-            if rpc.type:
-                # Remove packet call from the xid map since reply has
-                # already been decoded
-                pktt._rpc_xid_map.pop(rpc.xid, None)
-
-            # Decode NFS layer
-            rpcload = rpc.decode_payload()
-            rpcbytes = ldata - unpack.size()
-            if not rpcload and rpcbytes != rpcsize:
-                pass
-            elif unpack.size():
-                # Save the offset of next RPC packet within this TCP packet
-                # Data offset is cumulative
-                stream['frag_off'] += size - unpack.size()
-                sid = unpack.save_state()
-                ldata = unpack.size() - 4
-                try:
-                    rpc_header = RPC(pktt, proto=6, state=False)
-                except Exception:
-                    rpc_header = None
-                if not rpc_header or ldata < rpc_header.fragment_hdr.size:
-                    # Part of next RPC packet is within this TCP packet
-                    # Save the multi-span fragment data
-                    unpack.restore_state(sid)
-                    stream['msfrag'] += unpack.getbytes()
-                else:
-                    # Next RPC packet is entirely within this TCP packet
-                    # Re-position the file pointer to the current offset
-                    pktt.seek(pktt.boffset)
+            rpc.decode_payload()
+
+        if stream['buffer']:
+            rsize = _record_size(buffer, stream['boffset'])
+            if rsize is None:
+                return
+            if rsize > 0:
+                # Next RPC record is entirely within the buffer
+                pktt._tcp_pending = (pkt, stream)
             else:
-                stream['frag_off'] = 0
+                # Invalid RPC record, discard all data
+                _reset_stream(stream)
@@ -17,6 +17,7 @@ UDP module
 Decode UDP layer.
 """
 from packet.application.rpc import RPC
+from packet.unpack import get_struct
 from utilites.baseobj import BaseObj
 
 # Module constants
@@ -25,6 +26,9 @@ __copyright__ = "Copyright (C) 2014 NetApp, Inc."
 __license__   = "GPL v2"
 __version__   = '1.0'
 
+# Precompiled struct for the UDP header
+_UDP_st = get_struct("!HHHH")
+
 class UDP(BaseObj):
     """UDP object
 
@@ -60,7 +64,7 @@ class UDP(BaseObj):
         unpack = pktt.unpack
 
         # Decode the UDP layer header
-        ulist = unpack.unpack(8, "!HHHH")
+        ulist = unpack.unpack_struct(_UDP_st)
         self.src_port = ulist[0]
         self.dst_port = ulist[1]
         self.length   = ulist[2]
@@ -80,7 +84,10 @@ class UDP(BaseObj):
             if rpc.type:
                 # Remove packet call from the xid map since reply has
                 # already been decoded
-                pktt._rpc_xid_map.pop(rpc.xid, None)
+                pktt._rpc_xid_map.pop(pktt.rpc_key(pktt.pkt, rpc), None)
 
             # Decode NFS layer
-            rpc.decode_payload()
+            if pktt.lazy:
+                rpc.defer_payload()
+            else:
+                rpc.decode_payload()
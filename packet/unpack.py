@@ -23,11 +23,42 @@ import conf as c
 __author__    = "Jorge Mora" 
 __copyright__ = "Copyright (C) 2012 NetApp, Inc."
 __license__   = "GPL v2"
-__version__   = "2.4"
+__version__   = "2.5"
 
 # Module variables
 UNPACK_ERROR = False  # Raise unpack error when True
 
+# Registry of precompiled struct.Struct objects keyed by format string
+_struct_map = {}
+# Maximum number of batched formats (e.g., "!12I") kept in the registry
+_STRUCT_MAX = 4096
+
+def get_struct(fmt):
+    """Return the precompiled struct.Struct object for the given format.
+       The format is compiled only the first time it is requested.
+
+       fmt:
+           Format string, see struct module
+    """
+    st = _struct_map.get(fmt)
+    if st is None:
+        if len(_struct_map) >= _STRUCT_MAX:
+            # Keep memory bounded when many batched formats are used
+            _struct_map.clear()
+        st = struct.Struct(fmt)
+        _struct_map[fmt] = st
+    return st
+
+# Precompiled structs for the basic types
+ST_CHAR   = get_struct("!b")
+ST_UCHAR  = get_struct("!B")
+ST_SHORT  = get_struct("!h")
+ST_USHORT = get_struct("!H")
+ST_INT    = get_struct("!i")
+ST_UINT   = get_struct("!I")
+ST_INT64  = get_struct("!q")
+ST_UINT64 = get_struct("!Q")
+
 class Unpack(object):
     """Unpack object
 
@@ -77,6 +108,11 @@ class Unpack(object):
            # Unpack an 'unsigned short' (2 bytes in network order)
            short_int = x.unpack(2, '!H')[0]
 
+           # Unpack using a precompiled struct, the struct for each format
+           # is compiled only once and it is shared by all decoders
+           st = get_struct('!HH')
+           sport, dport = x.unpack_struct(st)
+
            # Unpack different basic types
            char      = x.unpack_char()
            uchar     = x.unpack_uchar()
@@ -100,7 +136,8 @@ class Unpack(object):
            # Get string padded to a 4 byte boundary, discard padding bytes
            buffer = x.unpack_string(pad=4)
 
-           # Get an array of unsigned integers
+           # Get an array of unsigned integers, arrays of 32 and 64 bit
+           # integers are decoded in a single batched unpack
            alist = x.unpack_array()
            # Get a fixed length array of unsigned integers
            alist = x.unpack_array(ltype=10)
@@ -244,39 +281,57 @@ class Unpack(object):
            fmt:
                Format string on how to process data
         """
-        return struct.unpack(fmt, self.read(size))
+        return get_struct(fmt).unpack(self.read(size))
+
+    def unpack_struct(self, st):
+        """Get the number of bytes given by the precompiled struct from
+           the working buffer and process it according to its format.
+           Return a tuple of unpack items, see struct.Struct.unpack.
+
+           st:
+               Precompiled struct.Struct object, see get_struct()
+        """
+        offset = self._offset
+        self._offset = offset + st.size
+        try:
+            return st.unpack(self._data[offset:self._offset])
+        except struct.error:
+            # Not enough data, move the offset pointer to the end of the
+            # working buffer as it is done by read()
+            self._offset = len(self._data)
+            raise
 
     def unpack_char(self):
         """Get a signed char"""
-        return self.unpack(1, '!b')[0]
+        return self.unpack_struct(ST_CHAR)[0]
 
     def unpack_uchar(self):
         """Get an unsigned char"""
-        return self.unpack(1, '!B')[0]
+        return self.unpack_struct(ST_UCHAR)[0]
 
     def unpack_short(self):
         """Get a signed short integer"""
-        return self.unpack(2, '!h')[0]
+        return self.unpack_struct(ST_SHORT)[0]
 
     def unpack_ushort(self):
         """Get an unsigned short integer"""
-        return self.unpack(2, '!H')[0]
+        return self.unpack_struct(ST_USHORT)[0]
 
     def unpack_int(self):
         """Get a signed integer"""
-        return self.unpack(4, '!i')[0]
+        return self.unpack_struct(ST_INT)[0]
 
     def unpack_uint(self):
         """Get an unsigned integer"""
-        return self.unpack(4, '!I')[0]
+        return self.unpack_struct(ST_UINT)[0]
 
     def unpack_int64(self):
         """Get a signed 64 bit integer"""
-        return self.unpack(8, '!q')[0]
+        return self.unpack_struct(ST_INT64)[0]
 
     def unpack_uint64(self):
         """Get an unsigned 64 bit integer"""
-        return self.unpack(8, '!Q')[0]
+        return self.unpack_struct(ST_UINT64)[0]
 
     def unpack_opaque(self, maxcount=0):
         """Get a variable length opaque up to a maximum length of maxcount"""
@@ -326,6 +381,11 @@ class Unpack(object):
         slen = self._get_ltype(ltype)
         if maxcount > 0 and slen > maxcount:
             raise Exception, "Array exceeds maximum length"
+        if not islist and not uargs and slen > 0:
+            # Unpack an array of scalars in a single batched unpack
+            item = _array_fmt.get(getattr(unpack_item, "im_func", unpack_item))
+            if item is not None and slen*item[1] <= self.size():
+                return list(self.unpack(slen*item[1], "!%d%s" % (slen, item[0])))
         while slen > 0:
             try:
                 # Unpack each item in the array
@@ -376,11 +436,145 @@ class Unpack(object):
         """Unpack an array of unsigned integers and convert array into
            a single long integer
         """
-        bitmask = 0
-        nshift = 0
         # Unpack array of uint32
         blist = self.unpack_array()
+        count = len(blist)
+        if count == 1:
+            return blist[0]
+        elif count == 2:
+            # Most common bitmap length, e.g., NFSv4 attribute mask
+            return blist[0] | (blist[1] << 32)
+        bitmask = 0
+        nshift = 0
         for bint in blist:
-            bitmask += bint << nshift
+            bitmask |= bint << nshift
             nshift += 32
         return bitmask
+
+# Format and size of the scalar items which are decoded in a single batched
+# unpack by unpack_array(), keyed by the item unpack function
+_array_fmt = {
+    Unpack.unpack_int.im_func:    ("i", 4),
+    Unpack.unpack_uint.im_func:   ("I", 4),
+    Unpack.unpack_int64.im_func:  ("q", 8),
+    Unpack.unpack_uint64.im_func: ("Q", 8),
+}
+
+class UnpackView(Unpack):
+    """Unpack object working on a view of the record buffer
+
+       The working buffer is not copied, it could be any object
+       supporting the buffer interface, e.g., a buffer over a memory map.
+
+       Usage:
+           from packet.unpack import UnpackView
+
+           x = UnpackView(buffer(mmap_obj, offset, size))
+
+           # Same methods as the Unpack object
+           data = x.read(32)
+           uint = x.unpack_uint()
+    """
+    def __init__(self, data):
+        """Constructor
+
+           Initialize object's private data.
+
+           data:
+               Raw packet data
+        """
+        if isinstance(data, bytearray):
+            data = memoryview(data)
+        self._isview = isinstance(data, memoryview)
+        Unpack.__init__(self, data)
+
+    def _bytes(self, start, end=None):
+        """Return a real string from the working buffer"""
+        data = self._data[start:end]
+        if self._isview:
+            return data.tobytes()
+        return data
+
+    def append(self, data):
+        """Append data to the working buffer."""
+        self._data = self._bytes(0) + data
+        self._isview = False
+
+    def insert(self, data):
+        """Insert data to the beginning of the current working buffer."""
+        if len(self._state):
+            # Save working buffer in the saved state since the buffer
+            # will be overwritten
+            state = self._state[-1]
+            if len(state) == 2:
+                state.append(self._data)
+        self._data = data + self._bytes(self._offset)
+        self._offset = 0
+        self._isview = False
+
+    def restore_state(self, sid):
+        """Restore state given by the state id"""
+        Unpack.restore_state(self, sid)
+        self._isview = isinstance(self._data, memoryview)
+
+    def getbytes(self, offset=None):
+        """Get the number of bytes given from the working buffer.
+           Do not move the offset pointer.
+
+           offset:
+               Starting offset of data to return [default: current offset]
+        """
+        if offset is None:
+            return self._bytes(self._offset)
+        return self._bytes(offset)
+
+    def read(self, size, pad=0):
+        """Get the number of bytes given from the working buffer.
+           Move the offset pointer.
+
+           size:
+               Length of data to get
+           pad:
+               Get and discard padding bytes [default: 0]
+               If given, data is padded to this byte boundary
+        """
+        buf = self._bytes(self._offset, self._offset+size)
+        if pad > 0:
+            # Discard padding bytes
+            size += (size+pad-1)/pad*pad - size
+        self._offset += size
+        dlen = len(self._data)
+        if self._offset > dlen:
+            self._offset = dlen
+        return buf
+
+    def unpack(self, size, fmt):
+        """Process the number of bytes given from the working buffer
+           according to the given format without copying the data.
+           Return a tuple of unpack items, see struct.unpack.
+
+           size:
+               Length of data to process
+           fmt:
+               Format string on how to process data
+        """
+        return self.unpack_struct(get_struct(fmt))
+
+    def unpack_struct(self, st):
+        """Process the number of bytes given by the precompiled struct
+           from the working buffer without copying the data.
+           Return a tuple of unpack items, see struct.Struct.unpack.
+
+           st:
+               Precompiled struct.Struct object, see get_struct()
+        """
+        offset = self._offset
+        try:
+            ret = st.unpack_from(self._data, offset)
+        except struct.error:
+            # Not enough data, move the offset pointer to the end of the
+            # working buffer as it is done by read()
+            self._offset = len(self._data)
+            raise
+        self._offset = offset + st.size
+        return ret
@@ -22,13 +22,15 @@ class to be used as a base class for an RPC payload object.
 This module also includes some module variables to change how certain
 objects are displayed.
 """
+from collections import Mapping, OrderedDict
 from utilites.baseobj import BaseObj
+from packet.unpack import Unpack, get_struct, _array_fmt
 
 # Module constants
 __author__    = 'Jorge Mora' 
 __copyright__ = "Copyright (C) 2014 NetApp, Inc."
 __license__   = "GPL v2"
-__version__   = '1.1'
+__version__   = '1.3'
 
 # RPC type constants
 RPC_CALL  = 0
@@ -48,6 +50,9 @@ LOAD_body  = True  # Display the body of layer/procedure/operation
 # Module variables for Enum
 ENUM_CHECK = True
 
+# Module variables for bitmap_dict
+BITMAP_LAZY = False  # Decode bitmap values on first access if size is known
+
 class IntHex(int):
     """Integer object which is displayed in hex"""
     def __str__(self):
@@ -67,43 +72,311 @@ class EnumInval(Exception):
     """Exception for an invalid enum value"""
     pass
 
+class EnumMeta(type):
+    """Metaclass for Enum
+
+       Each Enum class is given an intern table with an instance for every
+       value in the mapping dictionary so decoding a valid value does not
+       create a new object, and a table of all the string names already
+       stripped of the first _offset characters.
+    """
+    def __init__(cls, name, bases, cdict):
+        super(EnumMeta, cls).__init__(name, bases, cdict)
+        cls._enumobjs = {}
+        cls._enumstrs = {}
+        for value, sname in cls._enumdict.iteritems():
+            cls._enumobjs[value] = int.__new__(cls, value)
+            cls._enumstrs[value] = sname[cls._offset:]
+
 class Enum(int):
     """Enum base object
        This should only be used as a base class where the class attributes
        should be initialized
     """
+    __metaclass__ = EnumMeta
     _offset = 0    # Strip the first bytes from the string name after conversion
     _enumdict = {} # Enum mapping dictionary to convert integer to string name
 
     def __new__(cls, unpack):
-        """Constructor which checks if integer is a valid enum value"""
+        """Constructor which checks if integer is a valid enum value,
+           the same instance is returned for every valid value
+        """
         if isinstance(unpack, int):
             # Value is given as an integer
             value = unpack
         else:
             # Unpack integer
             value = unpack.unpack_int()
-        # Instantiate base class (integer class)
-        obj = super(Enum, cls).__new__(cls, value)
-        if ENUM_CHECK and obj._enumdict.get(value) is None:
-            raise EnumInval, "value=%s not in enum '%s'" % (value, obj.__class__.__name__)
+        obj = cls._enumobjs.get(value)
+        if obj is None:
+            if ENUM_CHECK:
+                raise EnumInval, "value=%s not in enum '%s'" % (value, cls.__name__)
+            # Instantiate base class (integer class)
+            obj = super(Enum, cls).__new__(cls, value)
         return obj
 
     def __str__(self):
         """Informal string representation, display value using the mapping
            dictionary provided as a class attribute
         """
-        value = self._enumdict.get(self)
+        value = self._enumstrs.get(self)
         if value is None:
             return super(Enum, self).__str__()
         else:
-            return value[self._offset:]
+            return value
 
 class BitmapInval(Exception):
     """Exception for an invalid bit number"""
     pass
 
-def bitmap_dict(unpack, bitmap, func_map, name_map=None):
+# Maximum number of decoding plans kept by bitmap_dict()
+BITMAP_PLAN_MAX = 1024
+
+# Decoding plans keyed by (id(func_map), id(name_map), bitmap) in least
+# recently used order, see _bitmap_plan()
+_bitmap_plan_map = OrderedDict()
+
+def _fixed_fmt(func):
+    """Return a tuple (fmt, conv) if the decoding function unpacks a single
+       fixed size integer, where fmt is the struct format of the integer and
+       conv is the function to convert the integer into the decoded value
+       (None if no conversion is needed). Return None otherwise.
+    """
+    item = _array_fmt.get(getattr(func, "im_func", None))
+    if item is not None:
+        return (item[0], None)
+    if isinstance(func, type) and issubclass(func, Enum):
+        # Enum is decoded from a signed integer
+        return ("i", func)
+    return None
+
+def _bitmap_plan(bitmap, func_map, name_map):
+    """Return the decoding plan for the given bitmap: a list of steps in
+       the order the values are decoded. A step is a tuple (key, func) for
+       a value decoded by calling the function or a tuple (keys, st, convs)
+       for consecutive fixed size values decoded by a single precompiled
+       struct, where convs is the list of conversion functions or None if
+       no value needs conversion.
+    """
+    plan = []
+    fixed = []  # List of (key, fmt, conv) to be decoded in a single struct
+
+    def add_fixed():
+        if fixed:
+            keys  = tuple(x[0] for x in fixed)
+            st    = get_struct("!" + "".join(x[1] for x in fixed))
+            convs = [x[2] for x in fixed]
+            if not any(convs):
+                convs = None
+            plan.append((keys, st, convs))
+            del fixed[:]
+
+    bitnum = 0
+    while bitmap > 0:
+        # Check if bit is set
+        if bitmap & 0x01 == 1:
+            # Get decoding function for this bit number
+            func = func_map.get(bitnum)
+            if func is None:
+                raise BitmapInval, "decoding function not found for bit number %d" % bitnum
+            if name_map:
+                # Use the bit number name instead of the bit number
+                # for the key
+                key = name_map.get(bitnum, bitnum)
+            else:
+                key = bitnum
+            item = _fixed_fmt(func)
+            if item is None:
+                add_fixed()
+                plan.append((key, func))
+            else:
+                fixed.append((key, item[0], item[1]))
+        bitmap = bitmap >> 1
+        bitnum += 1
+    add_fixed()
+    return plan
+
+def _get_plan(bitmap, func_map, name_map):
+    """Return a tuple (plan, keymap) for the given bitmap where keymap
+       maps every key to the index of its step in the plan, the plan is
+       taken from the cache if it has already been computed
+    """
+    pkey = (id(func_map), id(name_map), bitmap)
+    item = _bitmap_plan_map.get(pkey)
+    if item is None or item[0] is not func_map or item[1] is not name_map:
+        plan = _bitmap_plan(bitmap, func_map, name_map)
+        keymap = {}
+        for index, step in enumerate(plan):
+            if len(step) == 2:
+                keymap[step[0]] = index
+            else:
+                for key in step[0]:
+                    keymap[key] = index
+        item = (func_map, name_map, plan, keymap)
+        if len(_bitmap_plan_map) >= BITMAP_PLAN_MAX:
+            # Discard least recently used plan
+            _bitmap_plan_map.popitem(last=False)
+    else:
+        # Move plan to the most recently used position
+        del _bitmap_plan_map[pkey]
+    _bitmap_plan_map[pkey] = item
+    return item[2], item[3]
+
+def _fixed_values(ret, step, values):
+    """Add the values decoded by the struct of a fixed size step"""
+    keys, st, convs = step
+    if convs is None:
+        ret.update(zip(keys, values))
+    else:
+        for key, conv, value in zip(keys, convs, values):
+            ret[key] = value if conv is None else conv(value)
+
+class LazyBitmap(Mapping):
+    """Read only dictionary returned by bitmap_dict() where the values
+       are decoded on first access
+
+       The raw bytes of all values are kept together with the decoding plan.
+       Values are laid out one after the other so a value is decoded when
+       it is accessed for the first time together with all the values of
+       variable size before it, every decoded value is saved. Fixed size
+       values are skipped over until accessed.
+
+       Membership and length are given by the bitmap without decoding any
+       values, all values are decoded when the whole dictionary is used,
+       e.g., keys(), items(), dict(), str() or repr(). This is not a dict
+       subclass since copying a dict subclass with dict() or update() reads
+       the dict storage directly and it would miss the values not decoded.
+    """
+    __slots__ = ("_values", "_data", "_unpack", "_plan", "_keymap", "_offsets")
+
+    def __init__(self, data, plan, keymap):
+        """Constructor
+
+           Initialize object's private data.
+
+           data:
+               Raw bytes of all values
+           plan:
+               Decoding plan, see _bitmap_plan()
+           keymap:
+               Dictionary mapping every key to its step in the plan
+        """
+        self._values  = {}  # Values decoded so far
+        self._data    = data
+        self._unpack  = Unpack(data)
+        self._plan    = plan
+        self._keymap  = keymap
+        self._offsets = []  # Offset of every step reached so far
+
+    def _decode(self, index):
+        """Decode the step given by index in the decoding plan"""
+        unpack = self._unpack
+        offsets = self._offsets
+        plan = self._plan
+        if index < len(offsets):
+            # Step has already been reached, it is a fixed size step
+            step = plan[index]
+            _fixed_values(self._values, step, step[1].unpack_from(self._data, offsets[index]))
+            return
+        while len(offsets) <= index:
+            step = plan[len(offsets)]
+            offset = unpack.tell()
+            offsets.append(offset)
+            if len(step) == 2:
+                self._values[step[0]] = step[1](unpack)
+            elif len(offsets) <= index:
+                # Skip over fixed size values
+                unpack.seek(offset + step[1].size)
+            else:
+                _fixed_values(self._values, step, unpack.unpack_struct(step[1]))
+
+    def _decode_all(self):
+        """Decode all values not decoded yet and return the dictionary
+           of all values
+        """
+        if self._unpack is not None:
+            values = self._values
+            for key, index in self._keymap.iteritems():
+                if key not in values:
+                    self._decode(index)
+            # Insert all values in the same order as they are decoded
+            # by bitmap_dict() so the dictionary is displayed the same
+            items = []
+            for step in self._plan:
+                keys = (step[0],) if len(step) == 2 else step[0]
+                for key in keys:
+                    items.append((key, values[key]))
+            self._values = dict(items)
+            # Raw bytes are not needed anymore
+            self._data    = None
+            self._unpack  = None
+            self._offsets = None
+        return self._values
+
+    def __getitem__(self, key):
+        values = self._values
+        if key not in values:
+            index = self._keymap.get(key)
+            if index is None:
+                raise KeyError(key)
+            self._decode(index)
+        return values[key]
+
+    def get(self, key, default=None):
+        if key in self._keymap:
+            return self[key]
+        return default
+
+    def __contains__(self, key):
+        return key in self._keymap
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._keymap)
+
+    def keys(self):
+        return self._decode_all().keys()
+
+    def iterkeys(self):
+        return self._decode_all().iterkeys()
+    __iter__ = iterkeys
+
+    def values(self):
+        return self._decode_all().values()
+
+    def itervalues(self):
+        return self._decode_all().itervalues()
+
+    def items(self):
+        return self._decode_all().items()
+
+    def iteritems(self):
+        return self._decode_all().iteritems()
+
+    def copy(self):
+        return self._decode_all().copy()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyBitmap):
+            other = other._decode_all()
+        elif not isinstance(other, Mapping):
+            return False
+        return self._decode_all() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return str(self._decode_all())
+
+    def __repr__(self):
+        return repr(self._decode_all())
+
+    def __reduce__(self):
+        # Pickle and copy as a regular dictionary
+        return (dict, (self.copy(),))
+
+def bitmap_dict(unpack, bitmap, func_map, name_map=None, size=None):
     """Returns a dictionary where the key is the bit number given by bitmap
        and the value is the decoded value by evaluating the function used
        for that specific bit number
@@ -121,25 +394,32 @@ def bitmap_dict(unpack, bitmap, func_map, name_map=None):
            Dictionary which maps a bit number to a bit name. If this is given
            the resulting dictionary will have a bit name for a key instead
            of the bit number
+       size:
+           Number of bytes of all values. If this is given and BITMAP_LAZY
+           is set, the values are not decoded here but on first access,
+           see LazyBitmap [default: None]
+
+       The list of decoding functions for every distinct bitmap is computed
+       only once and it is kept in a bounded cache so the bitmap is not
+       walked one bit at a time on every call. Consecutive values having
+       a fixed size are decoded in a single unpack.
     """
+    plan, keymap = _get_plan(bitmap, func_map, name_map)
+    if BITMAP_LAZY and size is not None:
+        return LazyBitmap(unpack.read(size, pad=4), plan, keymap)
+
     ret = {}
-    bitnum = 0
-    while bitmap > 0:
-        # Check if bit is set
-        if bitmap & 0x01 == 1:
-            # Get decoding function for this bit number
-            func = func_map.get(bitnum)
-            if func is None:
-                raise BitmapInval, "decoding function not found for bit number %d" % bitnum
+    for step in plan:
+        if len(step) == 2:
+            ret[step[0]] = step[1](unpack)
+        else:
+            keys, st, convs = step
+            values = unpack.unpack_struct(st)
+            if convs is None:
+                ret.update(zip(keys, values))
             else:
-                if name_map:
-                    # Use the bit number name instead of the bit number
-                    # for the key
-                    ret[name_map.get(bitnum, bitnum)] = func(unpack)
-                else:
-                    ret[bitnum] = func(unpack)
-        bitmap = bitmap >> 1
-        bitnum += 1
+                for key, conv, value in zip(keys, convs, values):
+                    ret[key] = value if conv is None else conv(value)
     return ret
 
 class RPCload(BaseObj):
@@ -149,6 +429,7 @@ class RPCload(BaseObj):
     # Class attributes
     _pindex  = 0    # Discard this number of characters from the procedure name
     _strname = None # Name to display in object's debug representation level=1
+    _slotlist = ("_rpc",) # RPC layer of this payload
 
     def rpc_str(self, name=None):
         """Display RPC string"""
@@ -190,3 +471,48 @@ class RPCload(BaseObj):
             return out
         else:
             return BaseObj.__str__(self)
+
+if __name__ == '__main__':
+    # Self test of module
+    import struct
+    func_map = {
+        0: Unpack.unpack_uint,
+        1: Unpack.unpack_opaque,
+        2: Unpack.unpack_uint64,
+        4: Unpack.unpack_uint,
+    }
+    name_map = {0: "type", 1: "owner", 2: "size", 4: "mode"}
+    data = struct.pack("!II8sQI", 1, 5, "owner\0\0\0", 4096, 0644)
+    BITMAP_LAZY = True
+    ntests = 7
+
+    tcount = 0
+    attrs = bitmap_dict(Unpack(data), 0x17, func_map, name_map, size=len(data))
+    expected = bitmap_dict(Unpack(data), 0x17, func_map, name_map)
+    if isinstance(attrs, LazyBitmap) and not isinstance(expected, LazyBitmap):
+        tcount += 1
+    if dict(attrs) == expected:
+        tcount += 1
+    attrs = bitmap_dict(Unpack(data), 0x17, func_map, name_map, size=len(data))
+    ret = {}
+    ret.update(attrs)
+    if ret == expected:
+        tcount += 1
+    attrs = bitmap_dict(Unpack(data), 0x17, func_map, name_map, size=len(data))
+    if dict(**attrs) == expected:
+        tcount += 1
+    attrs = bitmap_dict(Unpack(data), 0x17, func_map, name_map, size=len(data))
+    if attrs["size"] == 4096 and repr(attrs) == repr(expected):
+        tcount += 1
+    attrs = bitmap_dict(Unpack(data), 0x17, func_map, name_map, size=len(data))
+    if attrs == expected and expected == attrs and dict(attrs) == attrs:
+        tcount += 1
+    if "mode" in attrs and "other" not in attrs and len(attrs) == 4:
+        tcount += 1
+
+    if tcount == ntests:
+        print "All tests passed!"
+        exit(0)
+    else:
+        print "%d tests failed" % (ntests-tcount)
+        exit(1)
@@ -1,10 +1,12 @@
+import os
 import re
 import time
 import conf as c
 from pprint import pformat
+from collections import Mapping
 from formatstr import FormatStr
 
-__version__   = '1.0'
+__version__   = '1.1'
 
 # Module variables
 _dindent = ""
@@ -15,6 +17,10 @@ _strsize = 0
 _logfh = None
 _tstamp = True
 _tstampfmt = "{0:date:%H:%M:%S.%q - }"
+# Compact mode: every class defining _attrlist has its attributes stored
+# in slots instead of the instance dictionary, it must be enabled before
+# any of these classes is defined
+_compact = os.environ.get("NFSTEST_COMPACT", "0") not in ("", "0")
 
 # Simple verbose level names
 _debug_map = {
@@ -39,6 +45,58 @@ _init_debug()
 # Instantiate FormatStr object
 fstrobj = FormatStr()
 
+def compact_mode(enable=None):
+    """Return or set compact mode. When setting compact mode, return
+       compact mode before setting it. Only the classes defined after
+       compact mode is set are affected so this must be called before
+       importing any of the modules defining the classes, e.g., before
+       importing packet.pktt. Compact mode is enabled as well by setting
+       the environment variable NFSTEST_COMPACT=1. Changing it afterwards
+       is safe, the classes already defined keep their own storage.
+
+       enable:
+           Enable compact mode if True, disable it if False
+    """
+    global _compact
+    ret = _compact
+    if enable is not None:
+        _compact = enable
+    return ret
+
+def _slot_values(obj):
+    """Return a dictionary of all attributes of object stored in slots"""
+    ret = {}
+    for cls in type(obj).__mro__:
+        for attr in cls.__dict__.get("__slots__", ()):
+            if attr != "__dict__" and attr not in ret and hasattr(obj, attr):
+                ret[attr] = getattr(obj, attr)
+    return ret
+
+class BaseMeta(type):
+    """Metaclass for BaseObj
+
+       In compact mode, a class defining _attrlist is given the slots
+       for all the attributes listed in _attrlist and _slotlist so these
+       attributes are not stored in the instance dictionary. The instance
+       dictionary is still available for any other attribute but it is
+       created on the first attribute not listed, so most of the objects
+       do not have any instance dictionary.
+    """
+    def __new__(mcs, name, bases, cdict):
+        if _compact and "__slots__" not in cdict and \
+           (cdict.get("_attrlist") is not None or cdict.get("_slotlist") is not None):
+            slots = []
+            for attr in tuple(cdict.get("_attrlist") or ()) + tuple(cdict.get("_slotlist") or ()):
+                # Skip attributes already defined by this class or any of
+                # the base classes, e.g., class attributes, properties or
+                # slots of the base class
+                if attr not in cdict and attr not in slots and \
+                   not any(hasattr(base, attr) for base in bases):
+                    slots.append(attr)
+            cdict["__slots__"] = tuple(slots)
+            cdict["_slotted"] = True
+        return type.__new__(mcs, name, bases, cdict)
+
 class BaseObj(object):
     """Base class so objects will inherit the methods providing the string
        representation of the object and a simple debug printing and logging
@@ -146,7 +204,18 @@ class BaseObj(object):
            # Print debug message only if OPTS bitmap matches the current
            # debug level mask
            x.dprint("OPTS", "This is an OPTS debug message")
+
+           # Compact mode: store the attributes listed in _attrlist and
+           # _slotlist of every class in slots, must be enabled before
+           # defining any class, e.g., before importing packet.pktt
+           from baseobj import compact_mode
+           compact_mode(True)
     """
+    __metaclass__ = BaseMeta
+    if _compact:
+        # Instance dictionary is only created when needed
+        __slots__ = ("__dict__",)
+
     # Class attributes
     _attrlist = None # List of attributes to display in order
     _eqattr   = None # Comparison attribute
@@ -154,6 +223,9 @@ class BaseObj(object):
                      # a reference to another attribute given by its value
     _fattrs   = None # Make the object attributes of each of the attributes
                      # listed part of the attributes of the current object
+    _slotlist = None # List of attributes not displayed which are stored
+                     # in slots as well in compact mode
+    _slotted  = None # Class or any of its base classes has slots
     _strfmt1  = None # String format for verbose level 1
     _strfmt2  = None # String format for verbose level 2
     _globals  = {}   # Attributes share by all instances
@@ -168,15 +240,24 @@ class BaseObj(object):
         keys = None
         for item in kwts:
             if type(item) == dict:
-                self.__dict__.update(item)
+                self._set_attrs(item.iteritems())
             elif type(item) == list or type(item) == tuple:
                 if keys is None:
                     keys = item
                 else:
-                    self.__dict__.update(zip(keys,item))
+                    self._set_attrs(zip(keys,item))
                     keys = None
         # Process named arguments: x = BaseObj(a=1, b=2)
-        self.__dict__.update(kwds)
+        self._set_attrs(kwds.iteritems())
+
+    def _set_attrs(self, items):
+        """Set all (name, value) items as object attributes"""
+        if self._slotted:
+            # Attributes could be stored in slots
+            for name, value in items:
+                setattr(self, name, value)
+        else:
+            self.__dict__.update(items)
 
     def __getattr__(self, attr):
         """Return the attribute value for which the lookup has not found
@@ -265,7 +346,7 @@ class BaseObj(object):
         # Representation of object with proper indentation
         out = []
         if self._attrlist is None:
-            attrlist = sorted(self.__dict__.keys())
+            attrlist = sorted(self._obj_dict().keys())
         else:
             attrlist = self._attrlist
         for key in attrlist:
@@ -273,6 +354,9 @@ class BaseObj(object):
                 val = getattr(self, key, None)
                 if val != None:
                     if isrepr:
+                        if not isinstance(val, dict) and isinstance(val, Mapping):
+                            # Display any other mapping as a dictionary
+                            val = dict(val)
                         value = pformat(val, indent=0)
                         out.append("%s%s = %s,\n" % (_sindent, key, value.replace("\n", "\n"+_sindent)))
                     else:
@@ -294,7 +378,7 @@ class BaseObj(object):
             for item in value:
                 out.append(self._str_value(item))
             return '[' + ', '.join(out) + ']'
-        elif isinstance(value, dict):
+        elif isinstance(value, (dict, Mapping)):
             # Display dictionary
             out = []
             for key,val in value.iteritems():
@@ -307,6 +391,14 @@ class BaseObj(object):
         else:
             return str(value)
 
+    def _obj_dict(self):
+        """Return a new dictionary of all object attributes"""
+        if self._slotted:
+            ret = _slot_values(self)
+            ret.update(self.__dict__)
+            return ret
+        return self.__dict__.copy()
+
     def set_attrlist(self, attr):
         """Add list of attribute names in object to display by str() or repr()
 
@@ -440,6 +532,18 @@ class BaseObj(object):
             _dlevel = level
         return _dlevel
 
+    def debug_enabled(self, level):
+        """Return True if the given debug level is enabled by the verbose
+           level given in debug_level().
+
+           level:
+               Debug level, this could be a number or a name defined by
+               debug_map()
+        """
+        if type(level) == str:
+            level = _debug_map[level.lower()]
+        return (level & _dlevel) != 0
+
     @staticmethod
     def debug_map(bitmap, name='', disp=''):
         """Add a debug mapping.
@@ -549,7 +653,7 @@ class BaseObj(object):
             # named arguments using object's own dictionary
             if self._attrlist is not None:
                 kwts = (getattr(self, attr) for attr in self._attrlist)
-            kwds = self.__dict__.copy()
+            kwds = self._obj_dict()
             if self._globals:
                 # Include the shared attributes as named attributes
                 kwds.update(self._globals)